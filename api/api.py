@@ -1,4 +1,12 @@
 from lib import *
+from migrations import run_migrations
+import io
+import json
+from contextlib import asynccontextmanager
+from fastapi import Query
+from fastapi.exception_handlers import http_exception_handler
+from fastapi.responses import FileResponse, StreamingResponse
+from pydantic import ValidationError
 # ---------------------------
 # Modelos Pydantic para request/response
 # ---------------------------
@@ -34,6 +42,13 @@ class GroupedDataRequest(StrictBaseModel):
     group: Optional[str] = None
     init_time : datetime = None
     end_time : datetime = None
+    format: str = "records"
+    max_points: Optional[int] = None
+    downsample: str = "lttb"
+    breakdown_by: Optional[List[str]] = None
+    layout: str = "long"
+    weighted: bool = False
+    approximate: bool = False
 
 
 class PredictRequest(StrictBaseModel):
@@ -41,32 +56,87 @@ class PredictRequest(StrictBaseModel):
     place: Optional[List[str]] = None
     group: str = ""
     steps: int = 6
+    format: str = "records"
+    weighted: bool = False
+
+class KpiRequest(StrictBaseModel):
+    crime: Optional[List[str]] = None
+    place: Optional[List[str]] = None
+    group: str = "mes"
+    init_time: Optional[datetime] = None
+    end_time: Optional[datetime] = None
 
 class DeleteRequest(StrictBaseModel):
     email: EmailStr
 # ---------------------------
 # FastAPI: Endpoints y Autenticación
 # ---------------------------
-app = FastAPI(title="Foresee")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """ Arranque: migraciones pendientes (salvo las manuales) y, si están activos, motor columnar y buffer de ingesta. """
+    eng = get_async_engine()
+    await run_migrations(eng)
+    if COLUMNAR_ENABLED:
+        await columnar_snapshot.refresh(eng)
+    if INGEST_BUFFER_ENABLED:
+        await ingest_buffer.start(eng)
+    yield
+    await live_updates.stop()
+    if INGEST_BUFFER_ENABLED:
+        await ingest_buffer.stop()
+    await eng.dispose()
+
+
+app = FastAPI(title="Foresee", lifespan=lifespan)
+
+
+app.add_middleware(ProfilingMiddleware)
+
+
+@app.middleware("http")
+async def pool_checkouts_header(request: Request, call_next):
+    """ Expone en X-Pool-Checkouts cuántas conexiones pidió al pool la petición. """
+    counter = CheckoutCounter()
+    REQUEST_CHECKOUTS.set(counter)
+    response = await call_next(request)
+    response.headers["X-Pool-Checkouts"] = str(counter.checkouts)
+    return response
+
+
+@app.exception_handler(sa.exc.DBAPIError)
+async def database_error(request: Request, exc: sa.exc.DBAPIError):
+    """ Una sentencia cancelada por statement_timeout agotó el plazo de la petición: 504 en lugar de 500. """
+    if is_query_canceled(exc):
+        return await http_exception_handler(request, deadline_exceeded())
+    raise exc
 
-TOKENS = {}
 
 # ---------------------------
 # Funciones de autenticación y verificación
 # ---------------------------
 
-def authenticate_user(email: str, password: str, eng: Engine ) -> str:
-    data_components = DataComponents(eng)
-    if data_components.verify_login(email, password):
-        token = str(uuid.uuid4())
-        TOKENS[token] = email
-        return token
+async def get_unit_of_work(eng: AsyncEngine = Depends(get_async_engine)):
+    """ Conexiones compartidas por todas las consultas de la petición; se devuelven al pool al terminar. """
+    uow = UnitOfWork(eng)
+    try:
+        yield uow
+    finally:
+        await uow.close()
+
+
+async def get_data_components(uow: UnitOfWork = Depends(get_unit_of_work)) -> AsyncDataComponents:
+    return AsyncDataComponents(uow.engine, uow)
+
+
+async def authenticate_user(email: str, password: str, data_components: AsyncDataComponents) -> str:
+    if await data_components.verify_login(email, password):
+        return await data_components.create_session(email)
     raise HTTPException(status_code=401, detail="Credenciales inválidas")
 
-def get_current_user(
+async def get_current_user(
     request: Request,
     x_token: Optional[str] = Header(None),
-    eng: Engine = Depends(get_engine)
+    data_components: AsyncDataComponents = Depends(get_data_components)
 ) -> User:
     token = None
 
@@ -79,16 +149,74 @@ def get_current_user(
         if cookie_token and cookie_token.startswith("Bearer "):
             token = cookie_token.split("Bearer ")[1]
 
-    if not token or token not in TOKENS:
+    # Las sesiones viven en Postgres: cualquier worker reconoce un token creado por otro
+    session = await data_components.get_session(token) if token else None
+    if session is None:
         raise HTTPException(status_code=401, detail="Token inválido")
 
-    email = TOKENS[token]
-    data_components = DataComponents(eng)
-    user = data_components.get_user(email)
+    # Las lecturas de esta petición se enrutan según las escrituras recientes de esta sesión
+    email, wrote_recently = session
+    READ_SESSION.set(email)
+    WROTE_RECENTLY.set(wrote_recently)
+    user = await data_components.get_user(email)
     if user is None:
         raise HTTPException(status_code=404, detail="Usuario no encontrado")
+    await allow_profile(email, data_components)
     return user
 
+
+async def allow_profile(email: str, data_components: AsyncDataComponents):
+    """ Solo un administrador puede perfilar una petición; el perfil se guarda si se permite. """
+    profile = CURRENT_PROFILE.get()
+    if profile is None or profile.allowed:
+        return
+    if "ADMIN" not in await data_components.get_user_roles(email):
+        raise HTTPException(status_code=403, detail="Solo un administrador puede perfilar peticiones")
+    profile.allowed = True
+    profile.user = email
+    profile.start()
+
+# ---------------------------
+# Control de admisión por clase de endpoint
+# ---------------------------
+
+def admission(endpoint_class: str, authenticated: bool = True):
+    """
+    Dependencia que fija el plazo de la petición y reserva un hueco en el controlador de la clase
+    de endpoint. Las lecturas y los pronósticos se cancelan si el cliente se desconecta; el hueco
+    no se libera hasta que terminan los hilos de CPU que la petición dejó en marcha.
+    """
+    controller = ADMISSION[endpoint_class]
+    cancellable = endpoint_class in CANCEL_ON_DISCONNECT
+
+    @asynccontextmanager
+    async def admitted(request: Request, priority: int):
+        REQUEST_DEADLINE.set(time.monotonic() + DEADLINES[endpoint_class])
+        await controller.acquire(priority)
+        slot = AdmissionSlot(controller)
+        ADMISSION_SLOT.set(slot)
+        try:
+            if cancellable:
+                async with cancel_on_disconnect(request):
+                    yield
+            else:
+                yield
+        finally:
+            slot.release()
+
+    async def admit_user(request: Request, user: User = Depends(get_current_user),
+                         data_components: AsyncDataComponents = Depends(get_data_components)):
+        email = user.email[0] if isinstance(user.email, pd.Series) else user.email
+        roles = await data_components.get_user_roles(email)
+        async with admitted(request, priority_for_roles(roles)):
+            yield
+
+    async def admit_anonymous(request: Request):
+        async with admitted(request, PRIORITY_NORMAL):
+            yield
+
+    return admit_user if authenticated else admit_anonymous
+
 # ---------------------------
 # Endpoints de la API
 # ---------------------------
@@ -113,9 +241,10 @@ def get_current_user(
 
 
 """
-@app.post("/login")
-def login(request: LoginRequest, response: Response, eng: Engine = Depends(get_engine)):
-    token = authenticate_user(request.email, request.password, eng)
+@app.post("/login", dependencies=[Depends(admission("auth", authenticated=False))])
+async def login(request: LoginRequest, response: Response,
+                data_components: AsyncDataComponents = Depends(get_data_components)):
+    token = await authenticate_user(request.email, request.password, data_components)
     # Guardamos el token en la cookie
     response.set_cookie(key="Authorization", value=f"Bearer {token}", httponly=True)
     return {"token": token}
@@ -134,12 +263,11 @@ def login(request: LoginRequest, response: Response, eng: Engine = Depends(get_e
 }
 
 """
-@app.get("/permissions")
-def permissions(user: User = Depends(get_current_user), eng: Engine = Depends(get_engine)):
-    data_components = DataComponents(eng)
+@app.get("/permissions", dependencies=[Depends(admission("read"))])
+async def permissions(user: User = Depends(get_current_user), data_components: AsyncDataComponents = Depends(get_data_components)):
     email = user.email.iloc[0] if isinstance(user.email, pd.Series) else user.email
 
-    perms = data_components.get_user_permissions(email)
+    perms = await data_components.get_user_permissions(email)
     return {"permissions": perms}
 
 # Endpoint para cerrar sesión (eliminar la cookie)
@@ -154,11 +282,12 @@ def permissions(user: User = Depends(get_current_user), eng: Engine = Depends(ge
 }
 """
 @app.post("/logout")
-def logout(request: Request, response: Response):
+async def logout(request: Request, response: Response,
+                 data_components: AsyncDataComponents = Depends(get_data_components)):
     x_token = request.cookies.get("Authorization")
     if x_token and x_token.startswith("Bearer "):
         token = x_token.split("Bearer ")[1]
-        TOKENS.pop(token, None)
+        await data_components.delete_session(token)
     # Eliminamos la cookie
     response.delete_cookie("Authorization")
     return {"message": "Sesión cerrada exitosamente"}
@@ -185,19 +314,103 @@ def logout(request: Request, response: Response):
   "Authorization": "Bearer <token>"
 }
 """
-@app.get("/secure-places")
-def secure_places(see: str, user: User = Depends(get_current_user), eng: Engine = Depends(get_engine)):
-    data_components = DataComponents(eng)
-    places = data_components.get_secure_unique_places(user.email, see)
+@app.get("/secure-places", dependencies=[Depends(admission("read"))])
+async def secure_places(see: str, user: User = Depends(get_current_user), data_components: AsyncDataComponents = Depends(get_data_components)):
+    places = await data_components.get_secure_unique_places(user.email, see)
     return {"places": places}
 
+# Endpoint para obtener el rango de fechas disponible
+"""
+:returns
+{
+  "min_date": "2020-01-01",
+  "max_date": "2025-04-08"
+}
+
+:headers
+{
+  "Authorization": "Bearer <token>"
+}
+"""
+@app.get("/date-range", dependencies=[Depends(admission("read"))])
+async def date_range(user: User = Depends(get_current_user),
+                     data_components: AsyncDataComponents = Depends(get_data_components)):
+    min_date, max_date = await data_components.get_date_range()
+    return {"min_date": min_date, "max_date": max_date}
+
+
+def restrict_places(chosen_place, see_perms: str, places: List[str]):
+    """
+    Sin lugares explícitos, limita la consulta a los lugares permitidos del usuario. Una lista vacía
+    de permitidos no puede quedar como "sin filtro": se rechaza.
+    """
+    if chosen_place or see_perms == "SEE_ALL":
+        return chosen_place
+    if not places:
+        raise HTTPException(status_code=403, detail="No tienes lugares autorizados para consultar")
+    return places
+
+
+def parse_grouped_request(request: GroupedDataRequest, see_perms: str, places: List[str]):
+    """ Valida una petición de datos agrupados y la traduce a (crímenes, lugares, frecuencia). """
+    check_response_format(request.format)
+    if (request.init_time is None) != (request.end_time is None):
+        raise HTTPException(status_code=400,
+                            detail="Incluye la fecha de inicio y de final, o ninguna para todo el rango")
+    check_downsampling(request.max_points, request.downsample)
+    check_breakdown(request.breakdown_by, request.layout)
+    if request.approximate and (request.weighted or request.layout == "wide" or request.group is None):
+        raise HTTPException(status_code=400,
+                            detail="approximate requiere una frecuencia de agrupación, sin weighted y con layout long")
+    crimes = request.crime[0].replace("'", "").split(",") if request.crime else None
+    if request.place and any(place not in places for place in request.place):
+        raise HTTPException(status_code=403, detail="No autorizado para acceder a este lugar")
+    chosen_place = request.place
+    if request.breakdown_by:
+        # Un desglose sin lugares explícitos se limita a los lugares permitidos del usuario
+        chosen_place = restrict_places(chosen_place, see_perms, places)
+
+    freq  = freqmap[request.group][0] if request.group in freqmap.keys() else request.group
+    return crimes, chosen_place, freq
+
+
+def grouped_response(df, request: GroupedDataRequest):
+    """ Aplica desglose, reducción y formato a un resultado de datos agrupados. """
+    if df is None:
+        return empty_response(request.format)
+
+    with profile_span("pandas"):
+        if request.breakdown_by and request.layout == "wide":
+            df = widen_breakdown(df, request.breakdown_by)
+
+        if request.max_points and 'period' in df.columns and request.breakdown_by:
+            df = downsample_breakdown(df, request.breakdown_by, request.max_points, request.downsample, request.layout)
+        elif request.max_points and 'period' in df.columns and 'count' in df.columns:
+            df = downsample(df, 'period', 'count', request.max_points, request.downsample)
+
+        if 'period' in df.columns:
+            df['period'] = pd.to_datetime(df['period']).dt.date
+
+    return format_response(df, request.format)
+
+
 # Endpoint para obtener datos agrupados según filtros
 """
 :body
 {
   "chosen_crime": ["Robo", "Homicidio"],
   "chosen_place": ["COMUNA 1"],
-  "frequency": "Por mes"
+  "frequency": "Por mes",
+  "init_time": "2023-01-01T00:00:00",  # Opcional junto con end_time: sin ninguna, todo el rango disponible
+  "end_time": "2024-01-01T00:00:00",
+  "format": "records",  # O "columns" para una respuesta compacta {"period": [...], "count": [...]}
+  "max_points": 500,    # Opcional: reduce la serie agrupada a como mucho 500 puntos
+  "downsample": "lttb", # O "minmax": mínimo y máximo por bucket
+  "breakdown_by": ["areaname"],  # Opcional: "areaname" y/o "crimecodedesc", conteos por miembro en una consulta
+  "layout": "long",     # O "wide": una columna por miembro del desglose
+  "weighted": true,     # Opcional: conteos ponderados por pond, con el mismo total que sin ponderar
+  "approximate": true   # Opcional (sin weighted): vista previa rápida desde una muestra de main; cada fila añade
+                        # "margin", el margen de error al 95 % de count (0 si la respuesta es exacta)
 }
 
 :headers
@@ -210,40 +423,142 @@ def secure_places(see: str, user: User = Depends(get_current_user), eng: Engine
   "Authorization": "Bearer <token>"
 }
 """
+@app.post("/retrieve-data", dependencies=[Depends(admission("read"))])
+async def get_grouped_data(request: GroupedDataRequest,
+                           user: User = Depends(get_current_user),
+                           data_components: AsyncDataComponents = Depends(get_data_components)):
+    email = user.email[0] if isinstance(user.email, pd.Series) else user.email
+    perms = await data_components.get_user_permissions(email)
+    see_perms = [perm for perm in perms if "SEE" in perm][0]
+    places = await data_components.get_secure_unique_places(email, see_perms)
+    crimes, chosen_place, freq = parse_grouped_request(request, see_perms, places)
+
+    df = await data_components.secure_fetch_grouped_data(
+        crimes, chosen_place,
+        freq,
+        request.init_time, request.end_time,
+        scope=tuple(places),
+        breakdown_by=request.breakdown_by,
+        weighted=request.weighted,
+        approximate=request.approximate
+    )
+    return grouped_response(df, request)
 
 
-@app.post("/retrieve-data")
-def get_grouped_data(request: GroupedDataRequest,
-                     user: User = Depends(get_current_user),
-                     eng: Engine = Depends(get_engine)):
-    data_components = DataComponents(eng)
-    if not request.init_time or not request.end_time:
-        raise HTTPException(status_code=400,
-                            detail="Incluye la fecha de inicio y de final para continuar con la consulta")
-    crimes = request.crime[0].replace("'", "").split(",") if request.crime else None
+# Deltas en vivo de la serie agrupada (Server-Sent Events) a medida que se ingresan incidentes
+"""
+:query
+?group=mes&crime=BURGLARY&crime=ROBBERY&place=COMUNA 1
+
+:returns
+event: ready          -> la suscripción está activa: pide ahora la serie con /retrieve-data
+data: {}
+
+event: delta          -> conteos a sumar a la serie, por periodo
+data: [{"period": "2025-04-01", "count": 3}]
+
+event: resync         -> se perdieron deltas: vuelve a pedir la serie con /retrieve-data
+data: {}
+
+:headers
+{
+  "Authorization": "Bearer <token>"
+}
+
+:cookie
+{
+  "Authorization": "Bearer <token>"
+}
+"""
+@app.get("/retrieve-data/live")
+async def live_grouped_data(request: Request,
+                            group: str = "mes",
+                            crime: Optional[List[str]] = Query(None),
+                            place: Optional[List[str]] = Query(None),
+                            user: User = Depends(get_current_user),
+                            data_components: AsyncDataComponents = Depends(get_data_components)):
     email = user.email[0] if isinstance(user.email, pd.Series) else user.email
-    perms = data_components.get_user_permissions(email)
+    perms = await data_components.get_user_permissions(email)
     see_perms = [perm for perm in perms if "SEE" in perm][0]
-    places = data_components.get_secure_unique_places(email, see_perms)
-    crime_cond, place_cond = build_conditions(crimes, request.place)
-    if request.place and any(place not in places for place in request.place):
+    places = await data_components.get_secure_unique_places(email, see_perms)
+    if place and any(chosen not in places for chosen in place):
         raise HTTPException(status_code=403, detail="No autorizado para acceder a este lugar")
+    # Sin lugares explícitos, solo se reciben los deltas de los lugares permitidos
+    chosen_place = restrict_places(place, see_perms, places)
+    freq = freqmap[group][0] if group in freqmap.keys() else group
+    if freq not in LIVE_FREQUENCIES:
+        raise HTTPException(status_code=400, detail="Frecuencia no válida o no soportada")
+    build_conditions(crime, chosen_place)  # Valida los crímenes
+
+    subscription = await live_updates.subscribe(data_components.engine, crime, chosen_place, freq)
+
+    async def events():
+        try:
+            yield "event: ready\ndata: {}\n\n"
+            while True:
+                try:
+                    delta = await asyncio.wait_for(subscription.queue.get(), LIVE_HEARTBEAT)
+                except asyncio.TimeoutError:
+                    if await request.is_disconnected():
+                        break
+                    # Comentario SSE para que los proxies no cierren la conexión inactiva
+                    yield ": keepalive\n\n"
+                    continue
+                if delta is LIVE_RESYNC:
+                    yield "event: resync\ndata: {}\n\n"
+                else:
+                    yield f"event: delta\ndata: {json.dumps(delta)}\n\n"
+        finally:
+            live_updates.unsubscribe(subscription)
+
+    return StreamingResponse(events(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+# Endpoint para obtener varias consultas agrupadas en una sola petición (como máximo BATCH_MAX_SPECS)
+"""
+:body
+[
+  {"crime": ["BURGLARY"], "place": ["COMUNA 1"], "group": "mes",
+   "init_time": "2023-01-01T00:00:00", "end_time": "2024-01-01T00:00:00"},
+  {"group": "semana", "init_time": "2023-01-01T00:00:00", "end_time": "2024-01-01T00:00:00"}
+]
 
+:returns
+{
+  "0": [{"period": "2023-01-01", "count": 12}, ...],
+  "1": [{"period": "2023-01-02", "count": 85}, ...]
+}
 
-    freq  = freqmap[request.group][0] if request.group in freqmap.keys() else request.group
-    df = data_components.secure_fetch_grouped_data(
-        crime_cond, place_cond,
-        freq,
-        request.init_time, request.end_time
-    )
-
-    if df is None:
-        return []
+:headers
+{
+  "Authorization": "Bearer <token>"
+}
+"""
+@app.post("/retrieve-data/batch", dependencies=[Depends(admission("read"))])
+async def get_grouped_data_batch(requests: List[GroupedDataRequest],
+                                 user: User = Depends(get_current_user),
+                                 data_components: AsyncDataComponents = Depends(get_data_components)):
+    if not requests:
+        raise HTTPException(status_code=400, detail="Incluye al menos una consulta")
+    if len(requests) > BATCH_MAX_SPECS:
+        raise HTTPException(status_code=400, detail=f"Como máximo {BATCH_MAX_SPECS} consultas por lote")
+    # Autenticación y permisos se resuelven una sola vez para todo el lote
+    email = user.email[0] if isinstance(user.email, pd.Series) else user.email
+    perms = await data_components.get_user_permissions(email)
+    see_perms = [perm for perm in perms if "SEE" in perm][0]
+    places = await data_components.get_secure_unique_places(email, see_perms)
 
-    if 'period' in df.columns:
-        df['period'] = pd.to_datetime(df['period']).dt.date
+    specs = []
+    for request in requests:
+        crimes, chosen_place, freq = parse_grouped_request(request, see_perms, places)
+        specs.append({"chosen_crime": crimes, "chosen_place": chosen_place, "freq": freq,
+                      "init_time": request.init_time, "end_time": request.end_time,
+                      "breakdown_by": request.breakdown_by, "weighted": request.weighted,
+                      "approximate": request.approximate})
 
-    return df.to_dict(orient="records")
+    results = await data_components.secure_fetch_grouped_batch(specs, scope=tuple(places))
+    return {str(i): grouped_response(df, request) for i, (df, request) in enumerate(zip(results, requests))}
 
 
 # Endpoint para predecir datos
@@ -254,7 +569,7 @@ def get_grouped_data(request: GroupedDataRequest,
   "chosen_place": ["COMUNA 1"],
   "frequency": "mes",
   "n_steps": 6,
-  "ponder": true
+  "weighted": true
 }
 
 :headers
@@ -267,10 +582,10 @@ def get_grouped_data(request: GroupedDataRequest,
   "Authorization": "Bearer <token>"
 }
 """
-@app.post("/predict")
-def predict_data(request: PredictRequest,
-                 user: User = Depends(get_current_user),
-                 eng: Engine = Depends(get_engine)):
+@app.post("/predict", dependencies=[Depends(admission("forecast"))])
+async def predict_data(request: PredictRequest,
+                       user: User = Depends(get_current_user),
+                       data_components: AsyncDataComponents = Depends(get_data_components)):
 
     chosen_crime = request.crime
     chosen_place = request.place
@@ -278,28 +593,99 @@ def predict_data(request: PredictRequest,
     n_steps = request.steps
     if frequency is None or n_steps is None:
         raise HTTPException(status_code=400, detail="Rellena los campos necesarios (frecuencia y steps)")
+    check_response_format(request.format)
 
-    data_components = DataComponents(eng)
-    perms = data_components.get_user_permissions(user.email[0] if isinstance(user.email, pd.Series) else user.email)
+    email = user.email[0] if isinstance(user.email, pd.Series) else user.email
+    perms = await data_components.get_user_permissions(email)
     if "PREDICT SI" not in perms:
         raise HTTPException(status_code=403, detail="No autorizado para predecir datos")
+    see_perms = [perm for perm in perms if "SEE" in perm][0]
+    places = await data_components.get_secure_unique_places(email, see_perms)
+    if chosen_place and any(place not in places for place in chosen_place):
+        raise HTTPException(status_code=403, detail="No autorizado para acceder a este lugar")
 
     crimes = chosen_crime[0].replace("'", "").split(",") if chosen_crime else None
-    crime_cond, place_cond = build_conditions(crimes, chosen_place)
 
     if frequency not in freqmap.keys():
         raise HTTPException(status_code=400, detail="Frecuencia no válida")
-    df = data_components.secure_fetch_grouped_data(crime_cond, place_cond, freqmap[frequency][0])
+    scope = tuple(places)
+    # Con weighted la serie ponderada sale ya de SQL y se usa tal cual como entrada de Prophet
+    df = await data_components.secure_fetch_grouped_data(crimes, chosen_place, freqmap[frequency][0], scope=scope,
+                                                         weighted=request.weighted)
 
     df['period'] = pd.to_datetime(df['period']).dt.date
-    forecast = forecast_data(df, freqmap[frequency], n_steps)
+    # El ajuste de Prophet no consulta la base: sus conexiones no se quedan ociosas durante el ajuste
+    await data_components.release_connections()
+    forecast = await cached_forecast(df, freqmap[frequency], n_steps)
 
     forecast = forecast[forecast['tipo']=="Predicción"]
     forecast['ds'] = pd.to_datetime(forecast['ds']).dt.date
     forecast['yhat'] = forecast['yhat'].round(0).astype(int)
     forecast['yhat_lower'] = forecast['yhat_lower'].round(0).astype(int)
     forecast['yhat_upper'] = forecast['yhat_upper'].round(0).astype(int)
-    return forecast[['ds', 'yhat', 'yhat_lower', 'yhat_upper']].to_dict(orient='records')
+    return format_response(forecast[['ds', 'yhat', 'yhat_lower', 'yhat_upper']], request.format)
+
+# Endpoint de KPIs de una serie agrupada (requiere permiso "KPI SI")
+"""
+:body
+{
+  "crime": ["BURGLARY"],
+  "place": ["COMUNA 1"],
+  "group": "mes",
+  "init_time": "2023-01-01T00:00:00",
+  "end_time": "2024-01-01T00:00:00"
+}
+
+:returns
+{
+  "total": 1520,
+  "mean": 126.67,
+  "periods": 12,
+  "peak_period": "2023-07-01",
+  "peak_label": "Jul 2023",
+  "peak_count": 171,
+  "lowest_period": "2023-02-01",
+  "lowest_label": "Feb 2023",
+  "lowest_count": 98
+}
+
+:headers
+{
+  "Authorization": "Bearer <token>"
+}
+"""
+@app.post("/kpis", dependencies=[Depends(admission("read"))])
+async def kpis(request: KpiRequest,
+               user: User = Depends(get_current_user),
+               data_components: AsyncDataComponents = Depends(get_data_components)):
+    if request.group not in freqmap.keys():
+        raise HTTPException(status_code=400, detail="Frecuencia no válida")
+    if (request.init_time is None) != (request.end_time is None):
+        raise HTTPException(status_code=400,
+                            detail="Incluye la fecha de inicio y de final, o ninguna para todo el rango")
+
+    email = user.email[0] if isinstance(user.email, pd.Series) else user.email
+    perms = await data_components.get_user_permissions(email)
+    if "KPI SI" not in perms:
+        raise HTTPException(status_code=403, detail="No autorizado para consultar KPIs")
+    see_perms = [perm for perm in perms if "SEE" in perm][0]
+    places = await data_components.get_secure_unique_places(email, see_perms)
+    if request.place and any(place not in places for place in request.place):
+        raise HTTPException(status_code=403, detail="No autorizado para acceder a este lugar")
+    # Sin lugares explícitos, los KPIs se limitan a los lugares permitidos del usuario
+    chosen_place = restrict_places(request.place, see_perms, places)
+
+    crimes = request.crime[0].replace("'", "").split(",") if request.crime else None
+    freq = freqmap[request.group]
+    result = await data_components.get_kpis(crimes, chosen_place, freq[0], request.init_time, request.end_time,
+                                            scope=tuple(places))
+    for kpi in ("peak", "lowest"):
+        period = result[f"{kpi}_period"]
+        result[f"{kpi}_period"] = period.date() if period is not None else None
+        result[f"{kpi}_label"] = format_period(period, freq)
+    result["total"] = int(result["total"])
+    result["mean"] = round(float(result["mean"]), 2)
+    return result
 
 # Endpoint para ingresar nuevos datos (requiere rol "Nuevos datos SI")
 """
@@ -314,6 +700,11 @@ def predict_data(request: PredictRequest,
 {
   "status": "success"
 }
+o, con INGEST_BUFFER=1, en cuanto el incidente queda en el registro local:
+{
+  "status": "accepted",
+  "seq": 48222
+}
 
 :headers
 {
@@ -325,33 +716,84 @@ def predict_data(request: PredictRequest,
   "Authorization": "Bearer <token>"
 }
 """
-@app.post("/new-data")
-def new_data(record: NewCrime,
-             user: User = Depends(get_current_user),
-             eng: Engine = Depends(get_engine)):
-    data_components = DataComponents(eng)
-    perms = data_components.get_user_permissions(user.email[0] if isinstance(user.email, pd.Series) else user.email)
+@app.post("/new-data", dependencies=[Depends(admission("ingest"))])
+async def new_data(record: NewCrime,
+                   user: User = Depends(get_current_user),
+                   data_components: AsyncDataComponents = Depends(get_data_components)):
+    perms = await data_components.get_user_permissions(user.email[0] if isinstance(user.email, pd.Series) else user.email)
     if "Nuevos datos SI" not in perms:
         raise HTTPException(status_code=403, detail="No autorizado para ingresar datos")
+    if record.crime not in category_map:
+        raise HTTPException(status_code=400, detail="Crimen no válido")
 
-    try:
-        with eng.connect() as conn:
-            recdf = pd.DataFrame([{
+    if INGEST_BUFFER_ENABLED:
+        # Se confirma al quedar en el registro local; el volcador lo inserta en main por lotes
+        try:
+            seq = await ingest_buffer.submit({
                 "date": record.date,
                 "crimecodedesc": category_map[record.crime],
                 "areaname": record.area
-            }])
-            recdf = apply_pond(recdf)
-            recdf.to_sql(
-                'main',
-                conn,
-                if_exists='append',
-                index=False
-            )
-            conn.commit()
-            return {"status": "success"}
+            })
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=f"Incidente no válido: {e}")
+        except OSError as e:
+            raise HTTPException(status_code=503, detail=f"No se pudo registrar el incidente: {e}")
+        # Sin marca de escritura: el incidente llega a main en el siguiente volcado, ni el primario lo ve antes
+        return {"status": "accepted", "seq": seq}
+
+    try:
+        recdf = pd.DataFrame([{
+            "date": record.date,
+            "crimecodedesc": category_map[record.crime],
+            "areaname": record.area
+        }])
+        recdf = apply_pond(recdf)
+        async with data_components.begin() as conn:
+            await insert_incidents(conn, recdf)
+        dimension_catalog.invalidate()
+        columnar_snapshot.mark_stale()
+        dataset_version.bump()
+        await data_components.note_write()
+        return {"status": "success"}
     except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+        raise server_error(e)
+
+# Estado del buffer de ingesta (requiere rol "Nuevos datos SI")
+"""
+:returns
+{
+  "enabled": true,
+  "log": "ingest-0",
+  "depth": 12,
+  "replayed": 0,
+  "flushed_rows": 48210,
+  "flushed_seq": 48210,
+  "dead_letters": 0,    # registros rechazados por main y apartados en INGEST_DEAD_LETTER_DIR
+  "last_flush_at": "2025-04-08T10:15:02",
+  "flush_ms_p50": 14.2,
+  "flush_ms_max": 61.8,
+  "last_error": null
+}
+
+:headers
+{
+  "Authorization": "Bearer <token>"
+}
+
+:cookie
+{
+  "Authorization": "Bearer <token>"
+}
+"""
+@app.get("/new-data/stats", dependencies=[Depends(admission("read"))])
+async def new_data_stats(user: User = Depends(get_current_user),
+                         data_components: AsyncDataComponents = Depends(get_data_components)):
+    perms = await data_components.get_user_permissions(user.email[0] if isinstance(user.email, pd.Series) else user.email)
+    if "Nuevos datos SI" not in perms:
+        raise HTTPException(status_code=403, detail="No autorizado para ver la ingesta")
+    if not INGEST_BUFFER_ENABLED:
+        return {"enabled": False}
+    return {"enabled": True, **ingest_buffer.stats()}
 
 # Endpoint para registrar un nuevo usuario (requiere rol "Nuevos usuarios SI")
 """
@@ -368,6 +810,7 @@ def new_data(record: NewCrime,
 {
   "status": "Usuario creado"
 }
+(409 si el usuario ya existe)
 
 :headers
 {
@@ -379,35 +822,102 @@ def new_data(record: NewCrime,
   "Authorization": "Bearer <token>"
 }
 """
-@app.post("/register")
-def register_user(new_user: RegisterUser,
-                  user: User = Depends(get_current_user),
-                  eng: Engine = Depends(get_engine)):
-    data_components = DataComponents(eng)
-    perms = data_components.get_user_permissions(user.email[0] if isinstance(user.email, pd.Series) else user.email)
+@app.post("/register", dependencies=[Depends(admission("ingest"))])
+async def register_user(new_user: RegisterUser,
+                        user: User = Depends(get_current_user),
+                        data_components: AsyncDataComponents = Depends(get_data_components)):
+    perms = await data_components.get_user_permissions(user.email[0] if isinstance(user.email, pd.Series) else user.email)
     if "Nuevos usuarios SI" not in perms:
         raise HTTPException(status_code=403, detail="No autorizado para crear usuarios")
-    if data_components.get_user(new_user.email):
-        raise HTTPException(status_code=400, detail="El usuario ya existe")
-    success = data_components.create_user(new_user.email, new_user.name, new_user.area, new_user.password, new_user.role)
+    if await data_components.get_user(new_user.email) is not None:
+        raise HTTPException(status_code=409, detail="El usuario ya existe")
+    try:
+        success = await data_components.create_user(new_user.email, new_user.name, new_user.area, new_user.password, new_user.role)
+    except sa.exc.IntegrityError:
+        # Otro registro del mismo email se confirmó entre la comprobación y el INSERT
+        raise HTTPException(status_code=409, detail="El usuario ya existe")
     if success:
         return {"status": "Usuario creado"}
     raise HTTPException(status_code=500, detail="Error al crear usuario")
 
 
-@app.delete("/delete-user")
-def delete_user(request: DeleteRequest,
-                user: User = Depends(get_current_user),
-                eng: Engine = Depends(get_engine)):
-    data_components = DataComponents(eng)
+# Endpoint para registrar usuarios en bloque (requiere rol "Nuevos usuarios SI")
+"""
+:body (application/json)
+[
+  {"email": "nuevo@mail.com", "name": "Nuevo Usuario", "area": "COMUNA 1", "password": "clave123", "role": "READER"},
+  ...
+]
+
+:body (text/csv)
+email,name,area,password,role
+nuevo@mail.com,Nuevo Usuario,COMUNA 1,clave123,READER
+
+:returns (un resultado por fila, en el orden de la carga; como máximo BULK_REGISTER_MAX_USERS filas)
+{
+  "created": 1,
+  "results": [{"email": "nuevo@mail.com", "status": "creado", "detail": null}]
+}
+
+:headers
+{
+  "Authorization": "Bearer <token>"
+}
+"""
+@app.post("/register/bulk", dependencies=[Depends(admission("ingest"))])
+async def register_users_bulk(request: Request,
+                              user: User = Depends(get_current_user),
+                              data_components: AsyncDataComponents = Depends(get_data_components)):
+    perms = await data_components.get_user_permissions(user.email[0] if isinstance(user.email, pd.Series) else user.email)
+    if "Nuevos usuarios SI" not in perms:
+        raise HTTPException(status_code=403, detail="No autorizado para crear usuarios")
+
+    body = await request.body()
+    try:
+        if request.headers.get("content-type", "").startswith("text/csv"):
+            rows = pd.read_csv(io.StringIO(body.decode("utf-8")), dtype=str).fillna("").to_dict(orient="records")
+        else:
+            rows = json.loads(body)
+    except (ValueError, pd.errors.ParserError):
+        raise HTTPException(status_code=400, detail="El cuerpo debe ser una lista JSON o un CSV de usuarios")
+    if not isinstance(rows, list) or not rows:
+        raise HTTPException(status_code=400, detail="El cuerpo debe ser una lista JSON o un CSV de usuarios")
+
+    if len(rows) > BULK_REGISTER_MAX_USERS:
+        raise HTTPException(status_code=400,
+                            detail=f"Como máximo {BULK_REGISTER_MAX_USERS} usuarios por carga")
+
+    # Cada resultado ocupa la posición de su fila en la carga, sea válida o no
+    results, users = [], []
+    for row in rows:
+        try:
+            users.append(RegisterUser(**row).model_dump())
+            results.append(None)
+        except (ValidationError, TypeError) as e:
+            email = row.get("email") if isinstance(row, dict) else None
+            results.append({"email": email, "status": "error", "detail": str(e)})
+
+    try:
+        created = iter(await data_components.create_users_bulk(users) if users else [])
+    except Exception as e:
+        raise server_error(e, f"Error al crear usuarios, no se creó ninguno: {e}")
+    results = [result if result is not None else next(created) for result in results]
+    return {"created": sum(result["status"] == "creado" for result in results),
+            "results": results}
+
+
+@app.delete("/delete-user", dependencies=[Depends(admission("ingest"))])
+async def delete_user(request: DeleteRequest,
+                      user: User = Depends(get_current_user),
+                      data_components: AsyncDataComponents = Depends(get_data_components)):
     email = request.email
     # Verificar permisos
-    perms = data_components.get_user_permissions(user.email[0] if isinstance(user.email, pd.Series) else user.email)
+    perms = await data_components.get_user_permissions(user.email[0] if isinstance(user.email, pd.Series) else user.email)
     if "Nuevos usuarios SI" not in perms:
         raise HTTPException(status_code=403, detail="No autorizado para eliminar usuarios")
 
     # Verificar si el usuario existe
-    if data_components.get_user(email) is None:
+    if await data_components.get_user(email) is None:
         raise HTTPException(status_code=404, detail="Usuario no encontrado")
 
     # Eliminar usuario
@@ -420,11 +930,6 @@ def delete_user(request: DeleteRequest,
         JOIN roles r ON ur.role_id = r.id 
         WHERE usuarios.email = :email
         """
-        with eng.connect() as conn:
-            result = conn.execute(text(admin_check_query), {"email": email}).fetchall()
-            if any(row[0] == "ADMIN" for row in result):
-                raise HTTPException(status_code=403, detail="No se puede eliminar un usuario administrador")
-
         # Eliminar el usuario si no es administrador
         query = """
         DELETE FROM usuarios 
@@ -434,20 +939,61 @@ def delete_user(request: DeleteRequest,
         AND ur.role_id = r.id 
         AND r.name != 'ADMIN'
         """
-        with eng.connect() as conn:
-            conn.execute(text(query), {"email": email})
-            conn.commit()
+        # Comprobación y borrado en la misma transacción
+        async with data_components.begin() as conn:
+            result = (await conn.execute(text(admin_check_query), {"email": email})).fetchall()
+            if any(row[0] == "ADMIN" for row in result):
+                raise HTTPException(status_code=403, detail="No se puede eliminar un usuario administrador")
+            await conn.execute(text(query), {"email": email})
+        await data_components.note_write()
         return {"status": "Usuario eliminado"}
     except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+        raise server_error(e)
+
+# Descarga de un perfil guardado (requiere rol ADMIN); el id llega en la cabecera X-Profile-Id
+"""
+:returns
+Fichero JSON adjunto:
+{
+  "id": "3f2b...",
+  "path": "/predict",
+  "total_ms": 2380.4,
+  "breakdown_ms": {"prophet": 2104.9, "pandas": 12.3, "serialization": 4.1, "db": 188.2, "otros": 70.9},
+  "sql": [{"statement": "SELECT ...", "ms": 181.7, "rows": 120}],
+  "samples": 410,
+  "stacks": {"run (lib.py:...);forecast_data (lib.py:...);fit (forecaster.py:...)": 388}
+}
+
+:headers
+{
+  "Authorization": "Bearer <token>"
+}
+
+:cookie
+{
+  "Authorization": "Bearer <token>"
+}
+"""
+@app.get("/profiles/{profile_id}")
+async def download_profile(profile_id: str,
+                           user: User = Depends(get_current_user),
+                           data_components: AsyncDataComponents = Depends(get_data_components)):
+    email = user.email[0] if isinstance(user.email, pd.Series) else user.email
+    if "ADMIN" not in await data_components.get_user_roles(email):
+        raise HTTPException(status_code=403, detail="No autorizado para ver perfiles")
+    if not PROFILE_ID_PATTERN.match(profile_id) or not os.path.exists(profile_path(profile_id)):
+        raise HTTPException(status_code=404, detail="Perfil no encontrado")
+    return FileResponse(profile_path(profile_id), media_type="application/json",
+                        filename=f"profile-{profile_id}.json")
 
 # Endpoint raíz para verificar si el API está corriendo
 @app.get("/")
-def root():
+async def root():
     return {"message": "Crime Data API is running"}
 
 # ---------------------------
 # Iniciar el servidor Uvicorn
 # ---------------------------
+# Modo desarrollo (un proceso con recarga automática); en producción: python server.py
 if __name__ == "__main__":
     uvicorn.run("api:app", host="0.0.0.0", port=8000, reload=True)
@@ -0,0 +1,163 @@
+"""
+Archivado de incidentes antiguos de main en Parquet.
+
+Los incidentes anteriores al corte se escriben en ARCHIVE_DIR, comprimidos con zstd y particionados
+por año y mes, junto con sus conteos diarios por crimen y área. Después se borran de main en la misma
+transacción que registra la ejecución en archive_runs. La API une archivo y main cuando un rango de
+fechas cruza el corte. Uso:
+    python archive.py --before 2020-01-01
+    python archive.py --keep-years 5 --vacuum
+"""
+import argparse
+import asyncio
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from lib import *
+from migrations import run_migrations
+
+# Clave del advisory lock que impide dos archivados a la vez
+ARCHIVE_LOCK = 7_260_002
+ARCHIVE_CHUNK_ROWS = int(os.getenv("ARCHIVE_CHUNK_ROWS", 200_000))
+
+ARCHIVE_ROWS_QUERY = """
+    SELECT main.date, crime_types.name AS crimecodedesc, areas.name AS areaname, main.rawpond, main.pond
+    FROM main
+    LEFT JOIN crime_types ON crime_types.id = main.crime_id
+    LEFT JOIN areas ON areas.id = main.area_id
+    WHERE main.date < :cutoff
+"""
+
+ROWS_SCHEMA = pa.schema([("date", pa.timestamp("us")), ("crimecodedesc", pa.string()), ("areaname", pa.string()),
+                         ("rawpond", pa.float64()), ("pond", pa.float64())])
+COUNTS_SCHEMA = pa.schema([("date", pa.timestamp("us")), ("crimecodedesc", pa.string()), ("areaname", pa.string()),
+                           ("count", pa.int64()), ("pond_sum", pa.float64())])
+
+
+def daily_counts(frame):
+    """ Conteo y suma de pond por día, crimen y área. """
+    return (frame.assign(date=frame['date'].dt.normalize())
+            .groupby(['date', 'crimecodedesc', 'areaname'], dropna=False, as_index=False)
+            .agg(count=('pond', 'size'), pond_sum=('pond', 'sum')))
+
+
+def publish(tmp_path, path):
+    """ Lleva a disco un fichero escrito aparte y lo publica con un rename atómico. """
+    with open(tmp_path, "rb") as file:
+        os.fsync(file.fileno())
+    os.replace(tmp_path, path)
+
+
+def remove_orphans(cutoffs):
+    """ Borra ficheros de ejecuciones que no llegaron a registrarse en archive_runs. """
+    committed = {f"part-{cutoff}.parquet" for cutoff in cutoffs}
+    for path in glob.glob(os.path.join(ARCHIVE_DIR, "**", "part-*"), recursive=True):
+        if os.path.basename(path) not in committed:
+            os.remove(path)
+
+
+class PartitionWriters:
+    """ Un ParquetWriter por mes; cada fichero se publica al cerrar, cuando ya está completo. """
+    def __init__(self, cutoff):
+        self.cutoff = cutoff
+        self.writers = {}
+
+    def write(self, frame):
+        for (year, month), part in frame.groupby([frame['date'].dt.year, frame['date'].dt.month]):
+            path = archive_rows_path(self.cutoff, year, month)
+            if path not in self.writers:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                self.writers[path] = pq.ParquetWriter(path + ".tmp", ROWS_SCHEMA, compression="zstd")
+            self.writers[path].write_table(pa.Table.from_pandas(part, schema=ROWS_SCHEMA, preserve_index=False))
+
+    def close(self):
+        for path, writer in self.writers.items():
+            writer.close()
+            publish(path + ".tmp", path)
+        return len(self.writers)
+
+
+async def archive_before(engine, cutoff):
+    """ Archiva los incidentes anteriores a cutoff; devuelve cuántos se movieron. """
+    async with engine.connect() as lock_conn:
+        locked = (await lock_conn.execute(text("SELECT pg_try_advisory_lock(:key)"), {'key': ARCHIVE_LOCK})).scalar()
+        if not locked:
+            raise RuntimeError("Ya hay un archivado en curso")
+        try:
+            return await _archive_before(engine, cutoff)
+        finally:
+            await lock_conn.execute(text("SELECT pg_advisory_unlock(:key)"), {'key': ARCHIVE_LOCK})
+
+
+async def _archive_before(engine, cutoff):
+    async with engine.connect() as conn:
+        cutoffs = [row[0] for row in (await conn.execute(text(ARCHIVE_RUNS_QUERY))).fetchall()]
+    if cutoffs and cutoff <= cutoffs[-1]:
+        print(f"Nada que archivar: el corte actual ya es {cutoffs[-1]}")
+        return 0
+    remove_orphans(cutoffs)
+
+    writers = PartitionWriters(cutoff)
+    counts = []
+    archived = 0
+    async with engine.connect() as conn:
+        result = await conn.stream(text(ARCHIVE_ROWS_QUERY), {'cutoff': as_datetime(cutoff)})
+        async for rows in result.partitions(ARCHIVE_CHUNK_ROWS):
+            frame = pd.DataFrame(rows, columns=ROWS_SCHEMA.names)
+            frame['date'] = pd.to_datetime(frame['date'])
+            writers.write(frame)
+            counts.append(daily_counts(frame))
+            archived += len(frame)
+    if not archived:
+        print(f"No hay incidentes anteriores a {cutoff}")
+        return 0
+    partitions = writers.close()
+
+    counts = (pd.concat(counts, ignore_index=True)
+              .groupby(['date', 'crimecodedesc', 'areaname'], dropna=False, as_index=False)[['count', 'pond_sum']].sum())
+    counts_path = archive_counts_path(cutoff)
+    os.makedirs(os.path.dirname(counts_path), exist_ok=True)
+    pq.write_table(pa.Table.from_pandas(counts, schema=COUNTS_SCHEMA, preserve_index=False),
+                   counts_path + ".tmp", compression="zstd")
+    publish(counts_path + ".tmp", counts_path)
+
+    # Borrado y registro en una transacción: la API ve el corte nuevo y main sin esas filas a la vez
+    async with engine.begin() as conn:
+        deleted = (await conn.execute(text("DELETE FROM main WHERE date < :cutoff"),
+                                      {'cutoff': as_datetime(cutoff)})).rowcount
+        if deleted != archived:
+            # Entraron incidentes antiguos mientras se escribía el archivo; no se borra nada
+            raise RuntimeError(f"Se archivaron {archived} filas pero hay {deleted} anteriores a {cutoff}; reintenta")
+        await conn.execute(text("INSERT INTO archive_runs (cutoff, archived_rows) VALUES (:cutoff, :rows)"),
+                           {'cutoff': cutoff, 'rows': archived})
+    print(f"{archived:,} incidentes anteriores a {cutoff} archivados en {partitions} particiones "
+          f"y {len(counts):,} conteos diarios")
+    return archived
+
+
+async def vacuum_main(engine):
+    """ Recupera el espacio de las filas borradas y actualiza las estadísticas del planificador. """
+    async with engine.connect() as conn:
+        conn = await conn.execution_options(isolation_level="AUTOCOMMIT")
+        await conn.execute(text("VACUUM (ANALYZE) main"))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Archiva en Parquet los incidentes anteriores a un corte")
+    cutoff_group = parser.add_mutually_exclusive_group(required=True)
+    cutoff_group.add_argument("--before", type=lambda value: datetime.strptime(value, "%Y-%m-%d").date(),
+                              help="Primer día que se queda en main (AAAA-MM-DD)")
+    cutoff_group.add_argument("--keep-years", type=int, help="Años completos, además del actual, que se quedan en main")
+    parser.add_argument("--vacuum", action="store_true", help="VACUUM (ANALYZE) main al terminar")
+    args = parser.parse_args()
+    cutoff = args.before or datetime.now().date().replace(year=datetime.now().year - args.keep_years, month=1, day=1)
+
+    async def main():
+        engine = get_async_engine()
+        await run_migrations(engine)
+        if await archive_before(engine, cutoff) and args.vacuum:
+            await vacuum_main(engine)
+        await engine.dispose()
+
+    asyncio.run(main())
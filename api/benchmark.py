@@ -0,0 +1,309 @@
+"""
+Benchmarks de carga para la API.
+
+Uso:
+    python benchmark.py db --requests 200 --concurrency 50 --group mes
+    python benchmark.py login --logins 100 --workers 4 --time-cost 1 2 3 --memory-cost 19456 65536
+    python benchmark.py columnar --rows 1000000 10000000 50000000
+    python benchmark.py parity --group mes semana
+    DB_REPLICAS=postgresql://u:p@localhost:5433/db python benchmark.py replicas --reads 100
+    python benchmark.py ingest --records 2000 --concurrency 50
+"""
+import argparse
+import asyncio
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from lib import *
+
+# Tamaño por defecto del threadpool de Starlette (anyio) para endpoints síncronos
+STARLETTE_THREADPOOL = 40
+# Fecha fuera del rango real para reconocer y borrar los incidentes del benchmark de ingesta
+INGEST_BENCH_DATE = datetime(2100, 1, 1)
+
+
+def summarize(name, latencies, elapsed):
+    """ Imprime throughput y latencias de una corrida. """
+    latencies = sorted(latencies)
+    p95 = latencies[int(len(latencies) * 0.95) - 1] if len(latencies) > 1 else latencies[0]
+    print(f"{name:<18} {len(latencies) / elapsed:>10.1f} req/s  "
+          f"p50={statistics.median(latencies) * 1000:>8.1f} ms  "
+          f"p95={p95 * 1000:>8.1f} ms  total={elapsed:.2f} s")
+
+
+def bench_sync(n_requests, concurrency, freq):
+    """ Ruta síncrona: DataComponents bloqueante sobre el threadpool. """
+    data_components = DataComponents(get_engine())
+    crime_cond, place_cond = build_conditions(None, None)
+
+    def call():
+        start = time.perf_counter()
+        data_components.secure_fetch_grouped_data(crime_cond, place_cond, freq)
+        return time.perf_counter() - start
+
+    with ThreadPoolExecutor(max_workers=min(concurrency, STARLETTE_THREADPOOL)) as pool:
+        start = time.perf_counter()
+        latencies = list(pool.map(lambda _: call(), range(n_requests)))
+        elapsed = time.perf_counter() - start
+    summarize("sync", latencies, elapsed)
+
+
+async def bench_async(n_requests, concurrency, freq):
+    """ Ruta asíncrona: AsyncDataComponents sobre asyncpg. """
+    engine = get_async_engine()
+    data_components = AsyncDataComponents(engine)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def call(i):
+        async with semaphore:
+            start = time.perf_counter()
+            # Un alcance distinto por llamada para medir la capa de datos sin coalescencia
+            await data_components.secure_fetch_grouped_data(None, None, freq, scope=i)
+            return time.perf_counter() - start
+
+    start = time.perf_counter()
+    latencies = await asyncio.gather(*(call(i) for i in range(n_requests)))
+    elapsed = time.perf_counter() - start
+    await engine.dispose()
+    summarize("async", latencies, elapsed)
+
+
+def bench_db(args):
+    freq = freqmap[args.group][0]
+    print(f"{args.requests} consultas agrupadas por {freq}, concurrencia {args.concurrency}")
+    bench_sync(args.requests, args.concurrency, freq)
+    asyncio.run(bench_async(args.requests, args.concurrency, freq))
+
+
+def bench_login(args):
+    """ Throughput de verificación de contraseñas para cada combinación de parámetros de Argon2. """
+    print(f"{args.logins} logins por configuración, {args.workers} hilos de hashing")
+    for time_cost in args.time_cost:
+        for memory_cost in args.memory_cost:
+            hasher = PasswordHasher(time_cost=time_cost, memory_cost=memory_cost, parallelism=args.parallelism)
+            stored_hash = hasher.hash("benchmark-password")
+            with ThreadPoolExecutor(max_workers=args.workers) as pool:
+                async def run():
+                    async def call():
+                        start = time.perf_counter()
+                        await run_cpu_bound(hasher.verify, stored_hash, "benchmark-password", executor=pool)
+                        return time.perf_counter() - start
+
+                    start = time.perf_counter()
+                    latencies = await asyncio.gather(*(call() for _ in range(args.logins)))
+                    return latencies, time.perf_counter() - start
+
+                latencies, elapsed = asyncio.run(run())
+            summarize(f"t={time_cost} m={memory_cost // 1024}MiB", latencies, elapsed)
+
+
+def synthetic_state(n_rows, n_crimes, n_areas, n_days, seed=0):
+    """ Foto columnar sintética con la cardinalidad de main, para medir sin depender del tamaño real. """
+    rng = np.random.default_rng(seed)
+    crimes = ColumnDictionary(list(category_map.values())[:n_crimes]
+                              + [f"CRIME {i}" for i in range(max(n_crimes - len(category_map), 0))])
+    areas = ColumnDictionary([f"AREA {i}" for i in range(n_areas)])
+    first_day = (np.datetime64('2015-01-01', 'D') - np.datetime64(0, 'D')).astype(np.int32)
+    return ColumnarState(rng.integers(first_day, first_day + n_days, n_rows, dtype=np.int32),
+                         rng.integers(0, n_crimes, n_rows, dtype=np.int16),
+                         rng.integers(0, n_areas, n_rows, dtype=np.int16),
+                         crimes, areas, watermark=n_rows)
+
+
+def bench_columnar(args):
+    """ Latencia de agregados sobre la foto columnar para distintos tamaños de main. """
+    for n_rows in args.rows:
+        state = synthetic_state(n_rows, len(category_map), args.areas, args.days)
+        init_time, end_time = state.date_range()
+        crime = list(category_map.keys())[:2]
+        area = state.areas.values[:3]
+        print(f"{n_rows:,} filas ({(state.days.nbytes + state.crime_codes.nbytes + state.area_codes.nbytes) / 2**20:.0f} MiB)")
+        cases = {
+            "mes": (None, None, "month", None),
+            "semana+filtro": (crime, area, "week", None),
+            "día": (None, None, "day", None),
+            "mes x área": (None, None, "month", ["areaname"]),
+            "total": (crime, None, "Custom", None),
+        }
+        for name, (chosen_crime, chosen_place, freq, breakdown_by) in cases.items():
+            latencies = []
+            start = time.perf_counter()
+            for _ in range(args.repeat):
+                call_start = time.perf_counter()
+                state.query(chosen_crime, chosen_place, freq, init_time, end_time, breakdown_by)
+                latencies.append(time.perf_counter() - call_start)
+            summarize(name, latencies, time.perf_counter() - start)
+
+
+async def check_parity(groups):
+    """ Compara la ruta SQL con la columnar sobre la misma base de datos y mide ambas. """
+    engine = get_async_engine()
+    data_components = AsyncDataComponents(engine)
+    await columnar_snapshot.refresh(engine)
+    state = columnar_snapshot.state
+    print(f"Foto cargada: {len(state):,} filas, marca de agua {state.watermark}")
+    init_time, end_time = state.date_range()
+    crimes = list(category_map.keys())
+    places = state.areas.values
+
+    specs = []
+    for group in groups:
+        freq = freqmap[group][0]
+        specs += [(None, None, freq, None), (crimes[:2], None, freq, None), (None, places[:2], freq, None),
+                  (crimes[:3], places[:1], freq, ["areaname"]), (None, None, freq, ["areaname", "crimecodedesc"])]
+    specs += [(None, None, "Custom", None), (crimes[:1], places[:2], "Custom", ["areaname"])]
+
+    mismatches = 0
+    sql_latencies, columnar_latencies = [], []
+    for chosen_crime, chosen_place, freq, breakdown_by in specs:
+        start = time.perf_counter()
+        expected = await data_components._fetch_grouped_data_sql(chosen_crime, chosen_place, freq,
+                                                                 None, None, breakdown_by)
+        sql_latencies.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        actual = await run_cpu_bound(state.query, chosen_crime, chosen_place, freq, init_time, end_time, breakdown_by)
+        columnar_latencies.append(time.perf_counter() - start)
+
+        try:
+            if expected is None or actual is None:
+                assert expected is None and actual is None
+            else:
+                order = [column for column in expected.columns if column != 'count']
+                expected = expected.sort_values(order).reset_index(drop=True) if order else expected
+                actual = actual.sort_values(order).reset_index(drop=True) if order else actual
+                if 'period' in expected.columns:
+                    expected['period'] = pd.to_datetime(expected['period'])
+                pd.testing.assert_frame_equal(expected, actual[expected.columns], check_dtype=False)
+        except AssertionError as e:
+            mismatches += 1
+            print(f"DISTINTO {freq} crimen={chosen_crime} lugar={chosen_place} desglose={breakdown_by}: {e}")
+
+    await engine.dispose()
+    summarize("sql", sql_latencies, sum(sql_latencies))
+    summarize("columnar", columnar_latencies, sum(columnar_latencies))
+    print(f"{len(specs) - mismatches}/{len(specs)} consultas idénticas")
+
+
+def bench_parity(args):
+    asyncio.run(check_parity(args.group))
+
+
+async def check_replicas(n_reads):
+    """ Reparto de lecturas entre primario y réplicas, y lectura de las propias escrituras. """
+    engine = get_async_engine()
+    data_components = AsyncDataComponents(engine)
+    served = {}
+    latencies = []
+    start = time.perf_counter()
+    for _ in range(n_reads):
+        call_start = time.perf_counter()
+        reader = await data_components.read_engine()
+        async with reader.connect() as conn:
+            await conn.execute(text(DATE_RANGE_QUERY))
+        latencies.append(time.perf_counter() - call_start)
+        name = reader.url.render_as_string(hide_password=True)
+        served[name] = served.get(name, 0) + 1
+    summarize("lecturas", latencies, time.perf_counter() - start)
+    for name, count in served.items():
+        print(f"  {count:>5} en {name}")
+    for replica in replica_router.stats():
+        print(f"  {'sana' if replica['healthy'] else 'NO sana':<8} {replica['replica']}")
+
+    READ_SESSION.set("benchmark@foresee")
+    replica_router.note_write()
+    on_primary = await data_components.read_engine() is engine
+    print(f"Tras escribir, la sesión lee del primario: {'sí' if on_primary else 'NO'}")
+    for replica_engine in (engine, *get_replica_engines()):
+        await replica_engine.dispose()
+
+
+def bench_replicas(args):
+    asyncio.run(check_replicas(args.reads))
+
+
+async def check_ingest(n_records, concurrency):
+    """ Ingesta de un incidente por petición: inserción directa frente al buffer write-behind. """
+    engine = get_async_engine()
+    data_components = AsyncDataComponents(engine)
+    await dimension_catalog.get(engine)
+    crime = next(iter(category_map.values()))
+    area = dimension_catalog.places()[0]
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def direct(_):
+        async with semaphore:
+            start = time.perf_counter()
+            recdf = apply_pond(pd.DataFrame([{"date": INGEST_BENCH_DATE, "crimecodedesc": crime, "areaname": area}]))
+            async with data_components.begin() as conn:
+                await insert_incidents(conn, recdf)
+            return time.perf_counter() - start
+
+    async def buffered(_):
+        async with semaphore:
+            start = time.perf_counter()
+            await ingest_buffer.submit({"date": INGEST_BENCH_DATE, "crimecodedesc": crime, "areaname": area})
+            return time.perf_counter() - start
+
+    start = time.perf_counter()
+    latencies = await asyncio.gather(*(direct(i) for i in range(n_records)))
+    summarize("directa", latencies, time.perf_counter() - start)
+
+    await ingest_buffer.start(engine)
+    start = time.perf_counter()
+    latencies = await asyncio.gather(*(buffered(i) for i in range(n_records)))
+    summarize("buffer (ack)", latencies, time.perf_counter() - start)
+    await ingest_buffer.flush()
+    summarize("buffer (volcado)", ingest_buffer.flush_seconds, time.perf_counter() - start)
+    await ingest_buffer.stop()
+    # Los incidentes de prueba no se quedan en main
+    async with engine.begin() as conn:
+        await conn.execute(text("DELETE FROM main WHERE date = :date"), {'date': INGEST_BENCH_DATE})
+    await engine.dispose()
+
+
+def bench_ingest(args):
+    asyncio.run(check_ingest(args.records, args.concurrency))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks de Foresee")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    db_parser = subparsers.add_parser("db", help="Throughput de la capa de datos síncrona vs asíncrona")
+    db_parser.add_argument("--requests", type=int, default=200)
+    db_parser.add_argument("--concurrency", type=int, default=50)
+    db_parser.add_argument("--group", choices=list(freqmap.keys()), default="mes")
+    db_parser.set_defaults(func=bench_db)
+
+    login_parser = subparsers.add_parser("login", help="Throughput de login según los parámetros de Argon2")
+    login_parser.add_argument("--logins", type=int, default=100)
+    login_parser.add_argument("--workers", type=int, default=int(os.getenv("HASH_WORKERS", 2)))
+    login_parser.add_argument("--time-cost", type=int, nargs="+", default=[1, 2, 3])
+    login_parser.add_argument("--memory-cost", type=int, nargs="+", default=[19456, 65536],
+                              help="KiB de memoria por hash")
+    login_parser.add_argument("--parallelism", type=int, default=1)
+    login_parser.set_defaults(func=bench_login)
+
+    columnar_parser = subparsers.add_parser("columnar", help="Latencia del motor columnar según el tamaño de main")
+    columnar_parser.add_argument("--rows", type=int, nargs="+", default=[1_000_000, 10_000_000, 50_000_000])
+    columnar_parser.add_argument("--areas", type=int, default=21)
+    columnar_parser.add_argument("--days", type=int, default=3650)
+    columnar_parser.add_argument("--repeat", type=int, default=20)
+    columnar_parser.set_defaults(func=bench_columnar)
+
+    parity_parser = subparsers.add_parser("parity", help="Paridad y latencia de la ruta SQL frente a la columnar")
+    parity_parser.add_argument("--group", choices=list(freqmap.keys()), nargs="+", default=list(freqmap.keys()))
+    parity_parser.set_defaults(func=bench_parity)
+
+    replicas_parser = subparsers.add_parser("replicas", help="Enrutado de lecturas a las réplicas de DB_REPLICAS")
+    replicas_parser.add_argument("--reads", type=int, default=100)
+    replicas_parser.set_defaults(func=bench_replicas)
+
+    ingest_parser = subparsers.add_parser("ingest", help="Ingesta directa frente al buffer write-behind")
+    ingest_parser.add_argument("--records", type=int, default=2000)
+    ingest_parser.add_argument("--concurrency", type=int, default=50)
+    ingest_parser.set_defaults(func=bench_ingest)
+
+    args = parser.parse_args()
+    args.func(args)
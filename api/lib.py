@@ -1,31 +1,188 @@
+import asyncio
+import contextvars
+import fcntl
+import functools
+import glob
+import hashlib
+import heapq
+import itertools
+import json
+import re
+import sys
+import threading
+import urllib.parse
+from contextlib import asynccontextmanager, contextmanager
+import time
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 import pandas as pd
+import pyarrow.dataset as pa_dataset
+from downsampling import DOWNSAMPLE_METHODS, downsample
 from prophet import Prophet
 import sqlalchemy as sa
-from sqlalchemy import text, Engine
+from sqlalchemy import text, bindparam, Engine
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncEngine
 import uuid
 from argon2 import PasswordHasher
+from argon2.exceptions import VerificationError, InvalidHashError
 import uvicorn
 from typing import List, Optional
 from fastapi import FastAPI, HTTPException, Depends, Header, Response, Request
 
 from pydantic import BaseModel, EmailStr,Extra
 import uuid
-from datetime import datetime
+from datetime import datetime, timedelta
 import dotenv
 import os
 
 
-def get_engine():
+def get_database_url():
     # Si no está definida la variable, cargamos el archivo .env, útil solo en desarrollo
     if not os.getenv("DB"):
         dotenv.load_dotenv()  # Esto busca un archivo .env en la raíz
     db_url = os.getenv("DB")
     if not db_url:
         raise RuntimeError("La variable de entorno DB no está definida.")
-    return sa.engine.create_engine(db_url, pool_pre_ping=True)
+    return db_url
+
+
+def get_engine():
+    return sa.engine.create_engine(get_database_url(), pool_pre_ping=True)
+
+
+# Contador de checkouts del pool de la petición en curso (lo fija el middleware de la API)
+REQUEST_CHECKOUTS = contextvars.ContextVar("request_checkouts", default=None)
+
+
+class CheckoutCounter:
+    def __init__(self):
+        self.checkouts = 0
+
+
+# Perfil de la petición en curso; solo existe si un administrador pidió perfilarla
+CURRENT_PROFILE = contextvars.ContextVar("current_profile", default=None)
+
+
+def count_pool_checkouts(engine: AsyncEngine):
+    """
+    Suma cada checkout del pool del engine al contador de la petición en curso, si lo hay,
+    y anota la duración de cada sentencia en el perfil de la petición, si se está perfilando.
+    """
+    def on_checkout(dbapi_connection, connection_record, connection_proxy):
+        counter = REQUEST_CHECKOUTS.get()
+        if counter is not None:
+            counter.checkouts += 1
+
+    def before_execute(conn, cursor, statement, parameters, context, executemany):
+        if CURRENT_PROFILE.get() is not None:
+            context.profile_started = time.perf_counter()
+
+    def after_execute(conn, cursor, statement, parameters, context, executemany):
+        profile = CURRENT_PROFILE.get()
+        if profile is not None and hasattr(context, "profile_started"):
+            profile.add_statement(statement, time.perf_counter() - context.profile_started, cursor.rowcount)
+
+    sa.event.listen(engine.sync_engine, "checkout", on_checkout)
+    sa.event.listen(engine.sync_engine, "before_cursor_execute", before_execute)
+    sa.event.listen(engine.sync_engine, "after_cursor_execute", after_execute)
+    return engine
+
+
+@functools.lru_cache(maxsize=None)
+def get_async_engine() -> AsyncEngine:
+    """ Engine asíncrono (asyncpg) compartido por todo el proceso. """
+    url = sa.engine.make_url(get_database_url()).set(drivername="postgresql+asyncpg")
+    return count_pool_checkouts(create_async_engine(
+        url,
+        pool_pre_ping=True,
+        pool_size=int(os.getenv("DB_POOL_SIZE", 10)),
+        max_overflow=int(os.getenv("DB_MAX_OVERFLOW", 20)),
+    ))
+
+
+@functools.lru_cache(maxsize=None)
+def get_replica_engines():
+    """ Engines de solo lectura, uno por URL en DB_REPLICAS (separadas por comas); vacío si no hay réplicas. """
+    urls = [url.strip() for url in os.getenv("DB_REPLICAS", "").split(",") if url.strip()]
+    return tuple(count_pool_checkouts(create_async_engine(
+        sa.engine.make_url(url).set(drivername="postgresql+asyncpg"),
+        pool_pre_ping=True,
+        pool_size=int(os.getenv("DB_POOL_SIZE", 10)),
+        max_overflow=int(os.getenv("DB_MAX_OVERFLOW", 20)),
+    )) for url in urls)
+
+
+def build_password_hasher():
+    """ PasswordHasher con los costes de Argon2 configurables por entorno (ARGON2_*). """
+    params = {}
+    for env, param in (("ARGON2_TIME_COST", "time_cost"),
+                       ("ARGON2_MEMORY_COST", "memory_cost"),
+                       ("ARGON2_PARALLELISM", "parallelism")):
+        if os.getenv(env):
+            params[param] = int(os.getenv(env))
+    return PasswordHasher(**params)
+
+
+ph = build_password_hasher()
+
+# Pool para el trabajo de CPU (Prophet) fuera del event loop
+CPU_POOL = ThreadPoolExecutor(max_workers=int(os.getenv("CPU_WORKERS", os.cpu_count() or 1)),
+                              thread_name_prefix="cpu")
+
+
+async def run_cpu_bound(func, *args, executor=None):
+    """ Ejecuta una función bloqueante en un pool de hilos sin bloquear el event loop. """
+    ctx = contextvars.copy_context()
+    cancelled = threading.Event()
+    ctx.run(CPU_CANCELLED.set, cancelled)
+    profile = CURRENT_PROFILE.get()
+    if profile is not None:
+        func = profile.sampled(func)
+    future = (executor or CPU_POOL).submit(ctx.run, func, *args)
+    slot = ADMISSION_SLOT.get()
+    if slot is not None:
+        slot.track(future)
+    try:
+        return await asyncio.wrap_future(future)
+    except asyncio.CancelledError:
+        # El hilo no se puede interrumpir: la función se detiene en su siguiente check_cancelled()
+        cancelled.set()
+        raise
+
+
+# Aviso de cancelación del trabajo que run_cpu_bound ejecuta en el hilo actual
+CPU_CANCELLED = contextvars.ContextVar("cpu_cancelled", default=None)
+
+
+class WorkCancelled(Exception):
+    """ El trabajo en un hilo se abandonó porque ya nadie esperaba su resultado. """
 
 
-ph = PasswordHasher()
+def check_cancelled():
+    """ Punto de control para funciones largas ejecutadas con run_cpu_bound. """
+    cancelled = CPU_CANCELLED.get()
+    if cancelled is not None and cancelled.is_set():
+        raise WorkCancelled()
+
+
+# Pool acotado y dedicado a Argon2, para que una ráfaga de logins no compita con las consultas
+HASH_POOL = ThreadPoolExecutor(max_workers=int(os.getenv("HASH_WORKERS", 2)), thread_name_prefix="argon2")
+# Las altas en bloque hashean en su propio pool, para que una carga grande no deje sin hilos a los logins
+BULK_HASH_POOL = ThreadPoolExecutor(max_workers=int(os.getenv("BULK_HASH_WORKERS", 1)), thread_name_prefix="argon2-bulk")
+BULK_REGISTER_MAX_USERS = int(os.getenv("BULK_REGISTER_MAX_USERS", 500))
+
+
+async def hash_password(password, executor=HASH_POOL):
+    return await run_cpu_bound(ph.hash, password, executor=executor)
+
+
+async def verify_password(stored_hash, plain_password):
+    """ Verifica la contraseña en el pool de hashing; devuelve False si no coincide. """
+    try:
+        return await run_cpu_bound(ph.verify, stored_hash, plain_password, executor=HASH_POOL)
+    except (VerificationError, InvalidHashError):
+        return False
 
 # Mapas de categorías y configuraciones de frecuencia
 category_map = {
@@ -85,13 +242,13 @@ class DataComponents:
     def get_secure_unique_places(_self, email, see_permissions):
         """ Obtiene las áreas disponibles según los permisos del usuario. """
         if see_permissions == 'SEE_LOCAL':
-            area_conditions = f"areaname = '{_self.get_user_area(email)}'"
+            area_conditions = f"name = '{_self.get_user_area(email)}'"
         elif see_permissions == 'SEE_ALL':
             area_conditions = "1=1"
         else:
             area_conditions = "1=0"
 
-        query = f"SELECT DISTINCT areaname FROM main WHERE {area_conditions}"
+        query = f"SELECT name FROM areas WHERE {area_conditions} ORDER BY name"
         with _self.engine.connect() as conn:
             result = conn.execute(text(query))
         rows = result.fetchall()
@@ -99,48 +256,11 @@ class DataComponents:
 
     def secure_fetch_grouped_data(_self, crime_conditions, place_conditions, freq, init_time=None, end_time=None):
         """ Obtiene datos agrupados según los permisos del usuario. """
-
-        query_min_max = "SELECT MIN(date) AS min_date, MAX(date) AS max_date FROM main"
         with _self.engine.connect() as conn:
-                result = conn.execute(text(query_min_max)).fetchone()
+                result = conn.execute(text(DATE_RANGE_QUERY)).fetchone()
 
-        if init_time is None or end_time is None:
-            init_time = result[0]
-            end_time = result[1]
-        else:
-            init_time = init_time.date()
-            end_time = end_time.date()
-
-        if init_time > end_time:
-            raise HTTPException(status_code=400, detail="La fecha inicial no puede ser mayor que la fecha final")
-        if end_time > result[1]:
-            raise HTTPException(status_code=400, detail=f"La fecha final no puede ser mayor que la fecha máxima ({result[1]})")
-        if init_time < result[0]:
-            raise HTTPException(status_code=400, detail=f"La fecha inicial no puede ser menor que la fecha mínima ({result[0]})")
-
-        date_filter = f"AND date BETWEEN '{init_time}' AND '{end_time}'"
-        if freq in['month', 'week', 'quarter', 'day']:
-            query = f"""
-                SELECT DATE_TRUNC('{freq}', date) AS period, COUNT(*) AS count
-                FROM main
-                WHERE ({crime_conditions}) AND ({place_conditions}) {date_filter}
-                GROUP BY period
-                ORDER BY period
-            """
-        elif freq == "Custom" and init_time is not None and end_time is not None:
-            query = f"""
-                SELECT COUNT(*) AS count
-                FROM main
-                WHERE ({crime_conditions}) AND ({place_conditions}) {date_filter}
-            """
-        elif freq is None and init_time is not None and end_time is not None:
-            query = f"""
-                SELECT date AS period, crimecodedesc, areaname
-                FROM main
-                WHERE ({crime_conditions}) AND ({place_conditions}) {date_filter}
-                ORDER BY period"""
-        else:
-            raise HTTPException(status_code=400, detail="Frecuencia no válida o no soportada")
+        init_time, end_time = validate_date_range(init_time, end_time, result[0], result[1])
+        query = grouped_data_query(crime_conditions, place_conditions, freq, init_time, end_time)
 
         with _self.engine.connect() as conn:
             result = conn.execute(text(query))
@@ -215,23 +335,2455 @@ class DataComponents:
         stored_hash = row[0]
         return ph.verify(stored_hash, plain_password,)
 
+class AsyncDataComponents:
+    """
+    Variante asíncrona de DataComponents sobre el engine asyncpg. Con una unidad de trabajo
+    (uow), todas sus consultas comparten las conexiones de la petición en lugar de pedir una al pool cada vez.
+    """
+    def __init__(self, engine: AsyncEngine, uow=None):
+        self.engine = engine
+        self.uow = uow
+
+    async def read_engine(self):
+        """ Engine para lecturas: una réplica sana, salvo que la sesión haya escrito hace poco. """
+        if self.uow is not None:
+            return await self.uow.reader()
+        return await replica_router.reader(self.engine)
+
+    @asynccontextmanager
+    async def connect(self, engine=None):
+        """ Conexión para consultas: la de la petición si hay unidad de trabajo, o una propia del pool. """
+        engine = engine or self.engine
+        if self.uow is None:
+            async with engine.connect() as conn:
+                yield conn
+        else:
+            async with self.uow.use(engine) as conn:
+                yield conn
+
+    @asynccontextmanager
+    async def begin(self):
+        """ Transacción de escritura en el primario, limitada al plazo de la petición; se confirma al salir del bloque. """
+        if self.uow is None:
+            async with self.engine.begin() as conn:
+                await apply_deadline(conn)
+                yield conn
+        else:
+            async with self.uow.transaction() as conn:
+                await apply_deadline(conn)
+                yield conn
+
+    async def release_connections(self):
+        """ Devuelve al pool las conexiones de la petición antes de un trabajo largo sin consultas. """
+        if self.uow is not None:
+            await self.uow.close()
+
+    async def get_user_permissions(self, email):
+        """ Obtiene los permisos de un usuario en función de sus roles """
+        async with self.connect(await self.read_engine()) as conn:
+            result = await conn.execute(text(PERMISSIONS_QUERY), {'email': email})
+        return [row[0] for row in result.fetchall()]
+
+    async def get_user_area(self, email):
+        """ Obtiene el área asignada a un usuario """
+        async with self.connect(await self.read_engine()) as conn:
+            result = await conn.execute(text("SELECT area FROM usuarios WHERE email = :email"), {'email': email})
+        return [row[0] for row in result.fetchall()][0]
+
+    async def get_secure_unique_places(self, email, see_permissions):
+        """ Obtiene las áreas disponibles según los permisos del usuario. """
+        catalog = await dimension_catalog.get(await self.read_engine())
+        if see_permissions == 'SEE_LOCAL':
+            area = await self.get_user_area(email)
+            return [area] if area in catalog.areas else []
+        elif see_permissions == 'SEE_ALL':
+            return catalog.places()
+        return []
+
+    async def get_date_range(self):
+        """ Fechas mínima y máxima disponibles en main y en el archivo histórico. """
+        async with self.connect(await self.read_engine()) as conn:
+            result = (await conn.execute(text(DATE_RANGE_QUERY))).fetchone()
+        archive = await archive_tier.refresh(self.engine)
+        if archive.cutoff is None:
+            return result[0], result[1]
+        return combine_date_ranges((result[0], result[1]), archive.date_range())
+
+    async def secure_fetch_grouped_data(self, chosen_crime, chosen_place, freq, init_time=None, end_time=None,
+                                        scope=None, breakdown_by=None, weighted=False, approximate=False):
+        """
+        Obtiene datos agrupados según los permisos del usuario. Las peticiones concurrentes
+        idénticas (misma consulta normalizada y mismo alcance de permisos) comparten una sola ejecución.
+        Con approximate, los conteos pueden salir de una muestra y llevan su margen de error (0 si son exactos).
+        """
+        reader = await self.read_engine()
+        # Una sesión que debe leer del primario no se suma a una ejecución que va a una réplica
+        key = (grouped_data_key(chosen_crime, chosen_place, freq, init_time, end_time, scope, breakdown_by, weighted),
+               reader is self.engine, approximate)
+        return await grouped_data_flight.do(key, self._fetch_grouped_data,
+                                            chosen_crime, chosen_place, freq, init_time, end_time, breakdown_by, reader,
+                                            weighted, approximate)
+
+    async def _fetch_grouped_data(self, chosen_crime, chosen_place, freq, init_time, end_time, breakdown_by,
+                                  reader=None, weighted=False, approximate=False):
+        archive = await archive_tier.refresh(self.engine)
+        if archive.covers(init_time):
+            df = await self._fetch_grouped_data_tiered(archive, chosen_crime, chosen_place, freq, init_time, end_time,
+                                                       breakdown_by, reader, weighted, approximate)
+        else:
+            df = await self._fetch_grouped_data_hot(chosen_crime, chosen_place, freq, init_time, end_time,
+                                                    breakdown_by, reader, weighted, approximate=approximate)
+        if df is None:
+            return None
+        if approximate and 'margin' not in df.columns:
+            df['margin'] = 0
+        return (await dimension_catalog.get(reader or self.engine)).categorize(df)
+
+    async def _fetch_grouped_data_hot(self, chosen_crime, chosen_place, freq, init_time, end_time, breakdown_by,
+                                      reader=None, weighted=False, pond_sums=False, max_rows=None, approximate=False):
+        df = NotImplemented
+        # La foto columnar no guarda pond: las series ponderadas siempre van a SQL
+        if COLUMNAR_ENABLED and not weighted and not pond_sums:
+            df = await columnar_snapshot.query(self.engine, chosen_crime, chosen_place, freq,
+                                               init_time, end_time, breakdown_by)
+        if df is NotImplemented:
+            df = await self._fetch_grouped_data_sql(chosen_crime, chosen_place, freq, init_time, end_time,
+                                                    breakdown_by, reader, weighted, pond_sums, max_rows, approximate)
+        return df
+
+    async def _fetch_grouped_data_tiered(self, archive, chosen_crime, chosen_place, freq, init_time, end_time,
+                                         breakdown_by, reader=None, weighted=False, approximate=False):
+        """ Rango que cruza el corte: lo anterior sale del archivo, lo posterior de main, y se unen. """
+        build_conditions(chosen_crime, chosen_place)  # Misma validación de crímenes que la ruta SQL
+        archive.require()
+        if freq is None and breakdown_by:
+            raise HTTPException(status_code=400, detail="breakdown_by requiere una frecuencia de agrupación")
+        if freq is None and weighted:
+            raise HTTPException(status_code=400, detail="weighted requiere una frecuencia de agrupación")
+        reader = reader or self.engine
+        async with reader.connect() as conn:
+            await apply_deadline(conn)
+            hot_range = (await conn.execute(text(DATE_RANGE_QUERY))).fetchone()
+        min_date, max_date = combine_date_ranges(hot_range, archive.date_range())
+        if min_date is None:
+            return None
+        init_time, end_time = validate_date_range(init_time, end_time, min_date, max_date)
+
+        archived_end = min(end_time, archive.cutoff - timedelta(days=1))
+        max_rows = RAW_EXPORT_MAX_ROWS
+        if freq is None:
+            # Los conteos diarios del archivo dan el número exacto de filas antes de leer el Parquet
+            archived = await run_cpu_bound(archive.state.query, chosen_crime, chosen_place, 'Custom',
+                                           init_time, archived_end)
+            max_rows -= int(archived['count'].sum())
+            if max_rows < 0:
+                raise export_too_large(RAW_EXPORT_MAX_ROWS - max_rows)
+            parts = [await run_cpu_bound(read_archived_rows, archive.cutoffs, chosen_crime, chosen_place,
+                                         init_time, archived_end)]
+        else:
+            parts = [await run_cpu_bound(archive.state.query, chosen_crime, chosen_place, freq,
+                                         init_time, archived_end, breakdown_by)]
+        if hot_range[0] is not None:
+            hot_init = max(init_time, archive.cutoff, as_date(hot_range[0]))
+            if hot_init <= end_time:
+                parts.append(await self._fetch_grouped_data_hot(
+                    chosen_crime, chosen_place, freq, as_datetime(hot_init), as_datetime(end_time), breakdown_by,
+                    reader, pond_sums=weighted, max_rows=max_rows, approximate=approximate))
+        return await run_cpu_bound(merge_tiers, parts, freq, breakdown_by, weighted)
+
+    async def _fetch_grouped_data_sql(self, chosen_crime, chosen_place, freq, init_time, end_time, breakdown_by,
+                                      reader=None, weighted=False, pond_sums=False, max_rows=None, approximate=False):
+        # Ejecución compartida entre peticiones: usa su propia conexión, no la de ninguna petición
+        reader = reader or self.engine
+        crime_conditions, place_conditions = build_conditions(chosen_crime, chosen_place)
+        async with reader.connect() as conn:
+            await apply_deadline(conn)
+            date_range = (await conn.execute(text(DATE_RANGE_QUERY))).fetchone()
+            init_time, end_time = validate_date_range(init_time, end_time, date_range[0], date_range[1])
+            fraction = None
+            if approximate and not weighted and not pond_sums and freq is not None:
+                fraction = await sample_fraction(conn, crime_conditions, place_conditions, init_time, end_time)
+            if fraction is not None:
+                query = approximate_grouped_query(crime_conditions, place_conditions, freq, init_time, end_time,
+                                                  breakdown_by, fraction)
+            else:
+                query = grouped_data_query(crime_conditions, place_conditions, freq, init_time, end_time,
+                                           breakdown_by, weighted, pond_sums)
+            if freq is None:
+                await check_export_size(conn, query, max_rows)
+            result = await conn.execute(text(query))
+        rows = result.fetchall()
+        columns = result.keys()
+        with profile_span("pandas"):
+            return pd.DataFrame(rows, columns=columns) if rows else None
+
+    async def secure_fetch_grouped_batch(self, specs, scope=None):
+        """
+        Resuelve varias consultas agrupadas. Las compatibles (agregados por periodo o totales, sin desglose)
+        se compilan en una sola sentencia con GROUPING SETS sobre un único recorrido de main;
+        el resto se ejecuta por separado, como mucho BATCH_CONCURRENCY a la vez. Devuelve un resultado
+        por especificación, en el mismo orden.
+        """
+        results = [None] * len(specs)
+        concurrency = asyncio.Semaphore(BATCH_CONCURRENCY)
+        archive = await archive_tier.refresh(self.engine)
+        # Las que cruzan el corte del archivo se resuelven por separado, uniendo archivo y main
+        compatible = [i for i, spec in enumerate(specs)
+                      if spec['freq'] in BATCH_FREQUENCIES and not spec['breakdown_by'] and not spec['weighted']
+                      and not spec.get('approximate') and not archive.covers(spec['init_time'])]
+        others = [i for i in range(len(specs)) if i not in compatible]
+
+        async def fetch_compatible():
+            async with self.connect(await self.read_engine()) as conn:
+                await apply_deadline(conn)
+                date_range = (await conn.execute(text(DATE_RANGE_QUERY))).fetchone()
+                compiled = []
+                for i in compatible:
+                    spec = specs[i]
+                    crime_conditions, place_conditions = build_conditions(spec['chosen_crime'], spec['chosen_place'])
+                    init_time, end_time = validate_date_range(spec['init_time'], spec['end_time'],
+                                                              date_range[0], date_range[1])
+                    compiled.append((crime_conditions, place_conditions, spec['freq'], init_time, end_time))
+                result = await conn.execute(text(batch_grouped_query(compiled)))
+            frame = pd.DataFrame(result.fetchall(), columns=result.keys())
+            for position, i in enumerate(compatible):
+                results[i] = split_batch_result(frame, position, specs[i]['freq'])
+
+        async def fetch_other(i):
+            spec = specs[i]
+            async with concurrency:
+                results[i] = await self.secure_fetch_grouped_data(
+                    spec['chosen_crime'], spec['chosen_place'], spec['freq'], spec['init_time'], spec['end_time'],
+                    scope=scope, breakdown_by=spec['breakdown_by'], weighted=spec['weighted'],
+                    approximate=spec.get('approximate', False))
+
+        await asyncio.gather(*([fetch_compatible()] if compatible else []), *(fetch_other(i) for i in others))
+        return results
+
+    async def get_kpis(self, chosen_crime, chosen_place, freq, init_time=None, end_time=None, scope=None):
+        """
+        KPIs de la serie agrupada (total, media, periodo pico y periodo más bajo) calculados en
+        una sola pasada SQL. Se cachean por consulta y versión del conjunto de datos; como esa versión
+        es la del primario, se calculan también en el primario y no en una réplica con retraso.
+        """
+        version = await dataset_version.get(self.engine)
+        key = (grouped_data_key(chosen_crime, chosen_place, freq, init_time, end_time, scope), version)
+        kpis = kpi_cache.get(key)
+        if kpis is None:
+            kpis = await kpi_flight.do(key, self._fetch_kpis, chosen_crime, chosen_place, freq, init_time, end_time)
+            kpi_cache.put(key, kpis)
+        return dict(kpis)
+
+    async def _fetch_kpis(self, chosen_crime, chosen_place, freq, init_time, end_time):
+        crime_conditions, place_conditions = build_conditions(chosen_crime, chosen_place)
+        # Ejecución compartida entre peticiones: usa su propia conexión, no la de ninguna petición
+        archive = await archive_tier.refresh(self.engine)
+        if archive.covers(init_time):
+            kpi_query(crime_conditions, place_conditions, freq, init_time, end_time)  # Valida la frecuencia
+            return series_kpis(await self._fetch_grouped_data(chosen_crime, chosen_place, freq, init_time, end_time,
+                                                              None, self.engine))
+        async with self.engine.connect() as conn:
+            await apply_deadline(conn)
+            date_range = (await conn.execute(text(DATE_RANGE_QUERY))).fetchone()
+            init_time, end_time = validate_date_range(init_time, end_time, date_range[0], date_range[1])
+            result = await conn.execute(text(kpi_query(crime_conditions, place_conditions, freq, init_time, end_time)))
+        return dict(result.mappings().fetchone())
+
+    async def create_user(self, email, full_name, area, password, role):
+        """ Crea un nuevo usuario y le asigna su rol, en una sola transacción. """
+        user_id = uuid.uuid5(uuid.NAMESPACE_DNS, email)
+        password_hash = await hash_password(password)
+
+        async with self.begin() as conn:
+            role_row = (await conn.execute(text("SELECT id FROM roles WHERE name = :role"), {'role': role})).fetchone()
+            if role_row is None:
+                # Se descarta la transacción: no queda un usuario sin rol
+                raise HTTPException(status_code=400, detail=f"Rol no válido: {role}")
+
+            await conn.execute(text("""
+                INSERT INTO usuarios (id, email, full_name,area, password)
+                VALUES (:id, :email, :full_name,:area, :password)
+            """), {
+                'id': str(user_id),
+                'email': email,
+                'full_name': full_name,
+                'area': area,
+                'password': password_hash
+            })
+            await conn.execute(text("""
+                INSERT INTO user_roles (user_id, role_id)
+                VALUES (:user_id, :role_id)
+            """), {'user_id': str(user_id), 'role_id': role_row[0]})
+        await self.note_write()
+        return True
+
+    async def create_users_bulk(self, users):
+        """
+        Crea varios usuarios en una sola transacción. Los roles y los emails existentes se
+        resuelven una vez y las contraseñas se hashean en BULK_HASH_POOL. Devuelve el resultado por usuario;
+        los usuarios inválidos se reportan y el resto se inserta todo o nada.
+        """
+        # Un resultado por posición de la carga: solo las repeticiones posteriores de un email son duplicados
+        results = [None] * len(users)
+        seen = set()
+        for i, user in enumerate(users):
+            if user['email'] in seen:
+                results[i] = "Email duplicado en la carga"
+            seen.add(user['email'])
+
+        async with self.connect() as conn:
+            existing = await conn.execute(
+                text("SELECT email FROM usuarios WHERE email IN :emails").bindparams(bindparam('emails', expanding=True)),
+                {'emails': list(seen)})
+            roles = await conn.execute(
+                text("SELECT name, id FROM roles WHERE name IN :roles").bindparams(bindparam('roles', expanding=True)),
+                {'roles': list({user['role'] for user in users})})
+        existing = {row[0] for row in existing.fetchall()}
+        role_ids = dict(roles.fetchall())
+
+        valid = []
+        for i, user in enumerate(users):
+            if results[i] is not None:
+                continue
+            if user['email'] in existing:
+                results[i] = "El usuario ya existe"
+            elif user['role'] not in role_ids:
+                results[i] = f"Rol no válido: {user['role']}"
+            else:
+                valid.append(user)
+
+        if valid:
+            hashes = await asyncio.gather(*(hash_password(user['password'], executor=BULK_HASH_POOL)
+                                            for user in valid))
+            user_rows = [{
+                'id': str(uuid.uuid5(uuid.NAMESPACE_DNS, user['email'])),
+                'email': user['email'],
+                'full_name': user['name'],
+                'area': user['area'],
+                'password': password_hash
+            } for user, password_hash in zip(valid, hashes)]
+            role_rows = [{'user_id': row['id'], 'role_id': role_ids[user['role']]}
+                         for user, row in zip(valid, user_rows)]
+
+            async with self.begin() as conn:
+                await conn.execute(text("""
+                    INSERT INTO usuarios (id, email, full_name, area, password)
+                    VALUES (:id, :email, :full_name, :area, :password)
+                """), user_rows)
+                await conn.execute(text("""
+                    INSERT INTO user_roles (user_id, role_id)
+                    VALUES (:user_id, :role_id)
+                """), role_rows)
+            await self.note_write()
+
+        return [{"email": user['email'], "status": "creado" if error is None else "error", "detail": error}
+                for user, error in zip(users, results)]
+
+    async def get_user_roles(self, email):
+        """ Obtiene los nombres de los roles de un usuario """
+        query = """
+            SELECT r.name
+            FROM usuarios u
+            JOIN user_roles ur ON u.id = ur.user_id
+            JOIN roles r ON ur.role_id = r.id
+            WHERE u.email = :email
+        """
+        async with self.connect() as conn:
+            result = await conn.execute(text(query), {'email': email})
+        return [row[0] for row in result.fetchall()]
+
+    async def get_user(self, email):
+        """ Obtiene la información de un usuario por email. """
+        async with self.connect() as conn:
+            result = await conn.execute(text("SELECT * FROM usuarios WHERE email = :email"), {'email': email})
+        rows = result.fetchall()
+        columns = result.keys()
+        return pd.DataFrame(rows, columns=columns) if rows else None
+
+    async def verify_login(self, email, plain_password):
+        """ Verifica la contraseña de un usuario. """
+        async with self.connect() as conn:
+            result = await conn.execute(text("SELECT password FROM usuarios WHERE email = :email"), {'email': email})
+        row = result.fetchone()
+        if row is None:
+            print("Usuario no encontrado")
+            return False
+
+        stored_hash = row[0]
+        if not await verify_password(stored_hash, plain_password):
+            return False
+        # Si los parámetros de Argon2 cambiaron, actualizamos el hash aprovechando la contraseña en claro
+        if ph.check_needs_rehash(stored_hash):
+            new_hash = await hash_password(plain_password)
+            async with self.begin() as conn:
+                await conn.execute(text("""
+                    UPDATE usuarios SET password = :new_hash
+                    WHERE email = :email AND password = :old_hash
+                """), {'new_hash': new_hash, 'email': email, 'old_hash': stored_hash})
+        return True
+
+    async def create_session(self, email):
+        """ Abre una sesión para el usuario y devuelve su token; de paso borra las sesiones caducadas. """
+        token = str(uuid.uuid4())
+        async with self.begin() as conn:
+            await conn.execute(text("DELETE FROM sessions WHERE created_at < now() - make_interval(hours => :ttl)"),
+                               {'ttl': SESSION_TTL_HOURS})
+            await conn.execute(text("INSERT INTO sessions (token_hash, email) VALUES (:token_hash, :email)"),
+                               {'token_hash': session_key(token), 'email': email})
+        return token
+
+    async def get_session(self, token):
+        """
+        (email, escribió hace poco) de la sesión del token, o None si no existe o caducó. Siempre del
+        primario: las escrituras recientes de la sesión se ven desde cualquier worker.
+        """
+        async with self.connect() as conn:
+            result = await conn.execute(text("""
+                SELECT email, COALESCE(last_write_at >= now() - make_interval(secs => :window), false)
+                FROM sessions
+                WHERE token_hash = :token_hash AND created_at >= now() - make_interval(hours => :ttl)
+            """), {'token_hash': session_key(token), 'ttl': SESSION_TTL_HOURS, 'window': READ_YOUR_WRITES_SECONDS})
+        return result.fetchone()
+
+    async def note_write(self):
+        """
+        Registra una escritura de la sesión en curso: esta petición y las siguientes de la sesión, en
+        cualquier worker, leen del primario durante READ_YOUR_WRITES_SECONDS. Sin sesión solo afecta a esta petición.
+        """
+        replica_router.note_write()
+        email = READ_SESSION.get()
+        if email is None:
+            return
+        async with self.begin() as conn:
+            await conn.execute(text("UPDATE sessions SET last_write_at = now() WHERE email = :email"), {'email': email})
+
+    async def delete_session(self, token):
+        async with self.begin() as conn:
+            await conn.execute(text("DELETE FROM sessions WHERE token_hash = :token_hash"),
+                               {'token_hash': session_key(token)})
+
+
+# Horas que dura una sesión de login
+SESSION_TTL_HOURS = int(os.getenv("SESSION_TTL_HOURS", 168))
+
+
+def session_key(token):
+    """ Hash con el que se guarda un token: una copia de la tabla no da sesiones válidas. """
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+class SingleFlight:
+    """
+    Agrupa llamadas concurrentes con la misma clave en una sola ejecución compartida. Si todos los
+    que esperan se cancelan (clientes desconectados o plazos agotados), se cancela también la ejecución.
+    """
+    def __init__(self):
+        self._inflight = {}
+        self._waiters = {}
+
+    async def do(self, key, func, *args):
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(func(*args))
+            self._inflight[key] = task
+            self._waiters[task] = 0
+            task.add_done_callback(functools.partial(self._forget, key))
+        self._waiters[task] += 1
+        try:
+            # shield: si un cliente cancela, el resto de los que esperan sigue recibiendo el resultado
+            result = await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if self._waiters.get(task) == 1 and not task.done():
+                task.cancel()
+            raise
+        finally:
+            if task in self._waiters:
+                self._waiters[task] -= 1
+        # Cada llamador recibe su propia copia para poder modificarla sin afectar a los demás
+        return result.copy() if isinstance(result, pd.DataFrame) else result
+
+    def _forget(self, key, task):
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        self._waiters.pop(task, None)
+        if not task.cancelled():
+            task.exception()  # Evita el aviso de excepción no recuperada si nadie esperaba
+
+
+grouped_data_flight = SingleFlight()
+forecast_flight = SingleFlight()
+
+
+class LRUCache:
+    """ Caché en memoria acotada, descarta primero lo usado hace más tiempo. """
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+
+    def get(self, key):
+        if key not in self._data:
+            return None
+        self._data.move_to_end(key)
+        return self._data[key]
+
+    def put(self, key, value):
+        self._data[key] = value
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+
+forecast_cache = LRUCache(int(os.getenv("FORECAST_CACHE_SIZE", 128)))
+kpi_cache = LRUCache(int(os.getenv("KPI_CACHE_SIZE", 512)))
+kpi_flight = SingleFlight()
+
+# Contadores de escritura de main; cambian con cualquier INSERT/UPDATE/DELETE, venga de donde venga
+DATASET_VERSION_QUERY = """
+    SELECT n_tup_ins + n_tup_upd + n_tup_del
+    FROM pg_stat_user_tables
+    WHERE relname = 'main'
+"""
+DATASET_VERSION_TTL = float(os.getenv("DATASET_VERSION_TTL", 2))
+
+
+class DatasetVersion:
+    """
+    Versión del contenido de main: los contadores de escritura de Postgres (que se publican con
+    cierto retraso) más un contador local que se incrementa con cada escritura hecha por esta API.
+    """
+    def __init__(self):
+        self.local = 0
+        self._counters = None
+        self._checked_at = None
+        self._flight = SingleFlight()
+
+    def bump(self):
+        self.local += 1
+        self._checked_at = None
+
+    async def _fetch(self, engine):
+        async with engine.connect() as conn:
+            return (await conn.execute(text(DATASET_VERSION_QUERY))).scalar()
+
+    async def get(self, engine):
+        if self._checked_at is None or time.monotonic() - self._checked_at > DATASET_VERSION_TTL:
+            # Siempre del primario: en una réplica estos contadores no reflejan las escrituras
+            self._counters = await self._flight.do("main", self._fetch, engine)
+            self._checked_at = time.monotonic()
+        return self._counters, self.local
+
+
+dataset_version = DatasetVersion()
+
+
+# Prioridades de admisión: menor valor = se atiende antes
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_ROLES = {"ADMIN": PRIORITY_HIGH, "IT": PRIORITY_HIGH}
+
+
+class AdmissionController:
+    """
+    Limita la concurrencia de una clase de endpoints. Las peticiones que exceden el límite
+    esperan en una cola acotada ordenada por prioridad; si la cola está llena se rechazan con 429
+    y si esperan más de queue_timeout segundos con 503, ambas con Retry-After.
+    """
+    def __init__(self, name, max_concurrent, max_queue, retry_after=1, queue_timeout=30):
+        self.name = name
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.retry_after = retry_after
+        self.queue_timeout = queue_timeout
+        self._active = 0
+        self._waiters = []  # heap de [prioridad, orden de llegada, future]
+        self._seq = itertools.count()
+
+    def _reject(self, status_code):
+        return HTTPException(status_code=status_code,
+                             detail=f"Servidor ocupado ({self.name}), reintente más tarde",
+                             headers={"Retry-After": str(self.retry_after)})
+
+    async def acquire(self, priority=PRIORITY_NORMAL):
+        if self._active < self.max_concurrent and not self._waiters:
+            self._active += 1
+            return
+        if len(self._waiters) >= self.max_queue:
+            # Cola llena: una petición más prioritaria desplaza a la última de menor prioridad
+            victim = max(self._waiters, default=None)
+            if victim is None or victim[0] <= priority:
+                raise self._reject(429)
+            self._waiters.remove(victim)
+            heapq.heapify(self._waiters)
+            victim[2].set_exception(self._reject(429))
+
+        future = asyncio.get_running_loop().create_future()
+        entry = [priority, next(self._seq), future]
+        heapq.heappush(self._waiters, entry)
+        try:
+            await asyncio.wait_for(future, self.queue_timeout)
+        except asyncio.TimeoutError:
+            self._discard(entry)
+            raise self._reject(503)
+        except asyncio.CancelledError:
+            self._discard(entry)
+            # Si el turno ya se había concedido, se lo pasamos al siguiente
+            if future.done() and not future.cancelled() and future.exception() is None:
+                self.release()
+            raise
+
+    def release(self):
+        while self._waiters:
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done():
+                future.set_result(None)  # El hueco pasa directamente al siguiente en la cola
+                return
+        self._active -= 1
+
+    def _discard(self, entry):
+        if entry in self._waiters:
+            self._waiters.remove(entry)
+            heapq.heapify(self._waiters)
+
+    def stats(self):
+        return {"active": self._active, "queued": len(self._waiters),
+                "max_concurrent": self.max_concurrent, "max_queue": self.max_queue}
+
+
+class AdmissionSlot:
+    """
+    Hueco concedido a una petición. Si la petición termina (desconexión o plazo agotado) con trabajo
+    suyo aún en un hilo de run_cpu_bound, el hueco se libera cuando ese trabajo acaba: hasta entonces
+    sigue ocupando CPU y el controlador no debe admitir a otro en su lugar.
+    """
+    def __init__(self, controller):
+        self.controller = controller
+        self._loop = asyncio.get_running_loop()
+        self._running = set()
+        self._closed = False
+
+    def track(self, future):
+        if self._closed:
+            return
+        self._running.add(future)
+        future.add_done_callback(self._done)
+
+    def _done(self, future):
+        # Se llama desde el hilo que ejecutó el trabajo
+        try:
+            self._loop.call_soon_threadsafe(self._finished, future)
+        except RuntimeError:
+            pass  # El event loop ya se cerró
+
+    def _finished(self, future):
+        self._running.discard(future)
+        if self._closed and not self._running:
+            self.controller.release()
+
+    def release(self):
+        if self._closed:
+            return
+        self._closed = True
+        if not self._running:
+            self.controller.release()
+
+
+# Hueco de admisión de la petición en curso, para que run_cpu_bound le asocie sus hilos
+ADMISSION_SLOT = contextvars.ContextVar("admission_slot", default=None)
+
+
+def admission_controller(name, max_concurrent, max_queue, retry_after):
+    """ Crea el controlador de una clase de endpoints, configurable con ADMISSION_<CLASE>="concurrencia,cola,retry_after". """
+    config = os.getenv(f"ADMISSION_{name.upper()}")
+    if config:
+        values = [int(value) for value in config.split(",")]
+        max_concurrent, max_queue = values[0], values[1]
+        retry_after = values[2] if len(values) > 2 else retry_after
+    return AdmissionController(name, max_concurrent, max_queue, retry_after,
+                               queue_timeout=float(os.getenv("ADMISSION_QUEUE_TIMEOUT", 30)))
+
+
+ADMISSION = {
+    "auth": admission_controller("auth", 8, 64, 1),
+    "read": admission_controller("read", 16, 64, 2),
+    "forecast": admission_controller("forecast", os.cpu_count() or 1, 2 * (os.cpu_count() or 1), 10),
+    "ingest": admission_controller("ingest", 8, 128, 2),
+}
+
+
+def priority_for_roles(roles):
+    return min((PRIORITY_ROLES.get(role, PRIORITY_NORMAL) for role in roles), default=PRIORITY_NORMAL)
+
+
+# --------------- PLAZOS Y CANCELACIÓN -----------------#
+
+# Plazo total de cada clase de endpoints en segundos, configurable con DEADLINE_<CLASE>
+DEADLINES = {name: float(os.getenv(f"DEADLINE_{name.upper()}", default))
+             for name, default in (("auth", 10), ("read", 30), ("forecast", 120), ("ingest", 15))}
+# Clases cuyo trabajo se abandona si el cliente se desconecta; las escrituras terminan siempre
+CANCEL_ON_DISCONNECT = ("read", "forecast")
+# Filas estimadas a partir de las cuales se rechaza una exportación sin agrupar
+RAW_EXPORT_MAX_ROWS = int(os.getenv("RAW_EXPORT_MAX_ROWS", 1_000_000))
+# SQLSTATE de Postgres para una sentencia cancelada (statement_timeout o cancelación explícita)
+QUERY_CANCELED = "57014"
+
+# Instante (time.monotonic) en que vence la petición en curso
+REQUEST_DEADLINE = contextvars.ContextVar("request_deadline", default=None)
+
+
+def deadline_exceeded():
+    return HTTPException(status_code=504, detail="Se agotó el plazo de la petición")
+
+
+def remaining_time():
+    """ Segundos que le quedan a la petición en curso, o None si no tiene plazo. """
+    deadline = REQUEST_DEADLINE.get()
+    return None if deadline is None else deadline - time.monotonic()
+
+
+async def apply_deadline(conn):
+    """ Limita las sentencias de la transacción en curso a lo que le queda a la petición. """
+    remaining = remaining_time()
+    if remaining is None:
+        return
+    if remaining <= 0:
+        raise deadline_exceeded()
+    await conn.execute(text("SELECT set_config('statement_timeout', :timeout, true)"),
+                       {'timeout': f"{max(int(remaining * 1000), 1)}ms"})
+
+
+def is_query_canceled(exc):
+    """ La sentencia la canceló Postgres (statement_timeout del plazo o cancelación de la petición). """
+    return isinstance(exc, sa.exc.DBAPIError) and getattr(exc.orig, "sqlstate", None) == QUERY_CANCELED
+
+
+def server_error(exc, detail=None):
+    """ Error para los endpoints que capturan todo: respeta los HTTPException y da 504 si se agotó el plazo. """
+    if isinstance(exc, HTTPException):
+        return exc
+    if is_query_canceled(exc):
+        return deadline_exceeded()
+    return HTTPException(status_code=500, detail=detail or str(exc))
+
+
+async def within_deadline(awaitable):
+    """ Espera como mucho lo que le queda a la petición; si el trabajo es compartido, solo se cancela cuando nadie más lo espera. """
+    remaining = remaining_time()
+    if remaining is None:
+        return await awaitable
+    try:
+        return await asyncio.wait_for(awaitable, max(remaining, 0))
+    except asyncio.TimeoutError:
+        raise deadline_exceeded()
+
+
+def export_too_large(rows):
+    return HTTPException(status_code=400,
+                         detail=f"La exportación devolvería unas {rows:,} filas (máximo {RAW_EXPORT_MAX_ROWS:,}); "
+                                "acota el rango de fechas o los filtros, o agrupa por periodo")
+
+
+async def estimate_rows(conn, query):
+    """ Filas que el planificador estima para query, sin ejecutarla. """
+    plan = (await conn.execute(text(f"EXPLAIN (FORMAT JSON) {query}"))).scalar()
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return int(plan[0]["Plan"]["Plan Rows"])
+
+
+async def check_export_size(conn, query, max_rows=None):
+    """ Rechaza una exportación sin agrupar si el planificador estima más de max_rows (RAW_EXPORT_MAX_ROWS) filas. """
+    max_rows = RAW_EXPORT_MAX_ROWS if max_rows is None else max_rows
+    estimated = await estimate_rows(conn, query)
+    if estimated > max_rows:
+        raise export_too_large(RAW_EXPORT_MAX_ROWS - max_rows + estimated)
+
+
+@asynccontextmanager
+async def cancel_on_disconnect(request: Request):
+    """
+    Cancela la petición en curso si el cliente se desconecta. Al cancelarse la espera, asyncpg envía
+    a Postgres la petición de cancelación de la sentencia en curso y los pronósticos se detienen
+    en su siguiente punto de control (siempre que nadie más espere el mismo resultado).
+    """
+    task = asyncio.current_task()
+
+    async def watch():
+        while (await request.receive())["type"] != "http.disconnect":
+            pass
+        task.cancel()
+
+    watcher = asyncio.create_task(watch())
+    try:
+        yield
+    finally:
+        watcher.cancel()
+
+
+# --------------- CONSULTAS APROXIMADAS -----------------#
+
+# Filas que cumplen los filtros que se quieren en la muestra; el error relativo baja con su raíz
+APPROX_SAMPLE_ROWS = int(os.getenv("APPROX_SAMPLE_ROWS", 100_000))
+# Por encima de esta fracción de bloques muestrear no ahorra lo suficiente y se responde exacto
+APPROX_MAX_FRACTION = float(os.getenv("APPROX_MAX_FRACTION", 0.2))
+# Semilla fija: la misma muestra entre cambios de filtros, así la vista previa no oscila
+APPROX_SEED = int(os.getenv("APPROX_SEED", 0))
+# z del intervalo de confianza del 95 % para el margen de error
+APPROX_Z = 1.96
+
+
+async def sample_fraction(conn, crime_conditions, place_conditions, init_time, end_time):
+    """
+    Fracción de bloques de main a muestrear para que unas APPROX_SAMPLE_ROWS filas cumplan los filtros,
+    según la estimación del planificador; None si conviene la consulta exacta.
+    """
+    matching = await estimate_rows(conn, f"""
+        SELECT 1 FROM main
+        WHERE ({crime_conditions}) AND ({place_conditions}) AND date BETWEEN '{init_time}' AND '{end_time}'
+    """)
+    if matching <= 0:
+        return None
+    fraction = APPROX_SAMPLE_ROWS / matching
+    return fraction if fraction <= APPROX_MAX_FRACTION else None
+
+
+# --------------- DIMENSIONES -----------------#
+
+CATALOG_TTL = float(os.getenv("CATALOG_TTL", 60))
+
+
+class DimensionCatalog:
+    """
+    Catálogo en memoria de las tablas de dimensiones (crime_types y areas): sirve las listas de
+    lugares y crímenes sin recorrer main y los tipos categóricos de los resultados en pandas.
+    """
+    def __init__(self):
+        self.crimes = {}
+        self.areas = {}
+        self._loaded_at = None
+        self._flight = SingleFlight()
+
+    def invalidate(self):
+        self._loaded_at = None
+
+    async def _load(self, engine):
+        async with engine.connect() as conn:
+            crimes = (await conn.execute(text("SELECT name, id FROM crime_types"))).fetchall()
+            areas = (await conn.execute(text("SELECT name, id FROM areas"))).fetchall()
+        self.crimes, self.areas = dict(crimes), dict(areas)
+        self._loaded_at = time.monotonic()
+        return self
+
+    async def get(self, engine):
+        if self._loaded_at is None or time.monotonic() - self._loaded_at > CATALOG_TTL:
+            await self._flight.do("catalog", self._load, engine)
+        return self
+
+    def places(self):
+        return sorted(self.areas)
+
+    def crime_types(self):
+        return sorted(self.crimes)
+
+    def categorize(self, df):
+        """ Convierte las columnas de dimensión a categóricas con las categorías del catálogo. """
+        for dimension, members in (("areaname", self.areas), ("crimecodedesc", self.crimes)):
+            if dimension in df.columns:
+                categories = sorted(set(members) | set(df[dimension].dropna()))
+                df[dimension] = df[dimension].astype(pd.CategoricalDtype(categories))
+        return df
+
+
+dimension_catalog = DimensionCatalog()
+
+
+def insert_dimension_members(table):
+    """
+    Alta de los nombres que aún no están en una tabla de dimensiones. Las claves son SMALLSERIAL y
+    un INSERT que choca con ON CONFLICT gasta igualmente un valor de la secuencia: solo se insertan
+    los que faltan, y ON CONFLICT queda para dos altas simultáneas del mismo nombre.
+    """
+    return f"""
+        INSERT INTO {table} (name)
+        SELECT incoming.name FROM unnest(CAST(:names AS TEXT[])) AS incoming (name)
+        WHERE NOT EXISTS (SELECT 1 FROM {table} WHERE {table}.name = incoming.name)
+        ON CONFLICT (name) DO NOTHING
+    """
+
+
+INSERT_CRIME_TYPES = insert_dimension_members("crime_types")
+INSERT_AREAS = insert_dimension_members("areas")
+INSERT_INCIDENT = """
+    INSERT INTO main (date, crime_id, area_id, rawpond, pond)
+    VALUES (:date,
+            (SELECT id FROM crime_types WHERE name = :crimecodedesc),
+            (SELECT id FROM areas WHERE name = :areaname),
+            :rawpond, :pond)
+"""
+
+
+async def insert_incidents(conn, df):
+    """
+    Inserta filas (date, crimecodedesc, areaname, rawpond, pond) en main, dando de alta antes
+    los crímenes y áreas nuevos. No confirma la transacción: el llamador confirma y, después,
+    invalida dimension_catalog para que los miembros nuevos aparezcan en las listas.
+    """
+    rows = df[['date', 'crimecodedesc', 'areaname', 'rawpond', 'pond']].to_dict(orient="records")
+    new_crimes = set(df['crimecodedesc']) - set(dimension_catalog.crimes)
+    new_areas = set(df['areaname']) - set(dimension_catalog.areas)
+    if new_crimes:
+        await conn.execute(text(INSERT_CRIME_TYPES), {'names': sorted(new_crimes)})
+    if new_areas:
+        await conn.execute(text(INSERT_AREAS), {'names': sorted(new_areas)})
+    await conn.execute(text(INSERT_INCIDENT), rows)
+    # Los suscriptores en vivo reciben los conteos del lote al confirmarse la transacción
+    for payload in incident_count_payloads(df):
+        await conn.execute(text("SELECT pg_notify(:channel, :payload)"), {'channel': LIVE_CHANNEL, 'payload': payload})
+    return len(rows)
+
+
+# --------------- RÉPLICAS DE LECTURA -----------------#
+
+REPLICA_HEALTH_INTERVAL = float(os.getenv("REPLICA_HEALTH_INTERVAL", 5))
+REPLICA_HEALTH_TIMEOUT = float(os.getenv("REPLICA_HEALTH_TIMEOUT", 2))
+REPLICA_MAX_LAG = float(os.getenv("REPLICA_MAX_LAG", 10))
+# Tras escribir, una sesión lee del primario durante este tiempo para ver sus propias escrituras
+READ_YOUR_WRITES_SECONDS = float(os.getenv("READ_YOUR_WRITES_SECONDS", 5))
+
+# Sesión (email) de la petición en curso; la fija la autenticación
+READ_SESSION = contextvars.ContextVar("read_session", default=None)
+# La sesión escribió hace poco (según la tabla sessions) o esta misma petición ya escribió
+WROTE_RECENTLY = contextvars.ContextVar("wrote_recently", default=False)
+
+# Segundos de retraso de replicación; 0 si la réplica está al día o si es un primario
+REPLICA_LAG_QUERY = """
+    SELECT CASE
+        WHEN NOT pg_is_in_recovery() OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+    END
+"""
+
+
+class ReplicaRouter:
+    """
+    Reparte las lecturas entre réplicas sanas en round-robin. Una réplica está sana si responde
+    y su retraso no supera REPLICA_MAX_LAG; se comprueba como mucho cada REPLICA_HEALTH_INTERVAL.
+    Sin réplicas sanas, o si la sesión escribió hace poco, se lee del primario. La marca de escritura
+    reciente no vive en el proceso: llega con la sesión (AsyncDataComponents.get_session/note_write).
+    """
+    def __init__(self, engines):
+        self.engines = list(engines)
+        self._cycle = itertools.count()
+        self._health = {engine: (False, None) for engine in self.engines}  # (sana, comprobada en)
+        self._checks = SingleFlight()
+
+    def note_write(self):
+        """ El resto de la petición en curso lee del primario. """
+        WROTE_RECENTLY.set(True)
+
+    def wrote_recently(self):
+        return WROTE_RECENTLY.get()
+
+    async def _check(self, engine):
+        try:
+            async with engine.connect() as conn:
+                lag = (await asyncio.wait_for(conn.execute(text(REPLICA_LAG_QUERY)), REPLICA_HEALTH_TIMEOUT)).scalar()
+            healthy = float(lag) <= REPLICA_MAX_LAG
+        except Exception:
+            healthy = False
+        self._health[engine] = (healthy, time.monotonic())
+        return healthy
+
+    async def is_healthy(self, engine):
+        healthy, checked_at = self._health[engine]
+        if checked_at is None or time.monotonic() - checked_at > REPLICA_HEALTH_INTERVAL:
+            healthy = await self._checks.do(engine, self._check, engine)
+        return healthy
+
+    async def reader(self, primary):
+        if not self.engines or self.wrote_recently():
+            return primary
+        for _ in range(len(self.engines)):
+            engine = self.engines[next(self._cycle) % len(self.engines)]
+            if await self.is_healthy(engine):
+                return engine
+        return primary
+
+    def stats(self):
+        return [{"replica": engine.url.render_as_string(hide_password=True), "healthy": healthy}
+                for engine, (healthy, _) in self._health.items()]
+
+
+replica_router = ReplicaRouter(get_replica_engines())
+
+
+# --------------- UNIDAD DE TRABAJO POR PETICIÓN -----------------#
+
+class UnitOfWork:
+    """
+    Conexiones de una petición: una al primario y otra de lectura (réplica o el mismo primario),
+    abiertas la primera vez que se usan y devueltas al pool al terminar la petición. Cada bloque
+    confirma su transacción implícita si termina bien y la deshace si falla, así la conexión no queda
+    inactiva dentro de una transacción.
+    """
+    def __init__(self, engine: AsyncEngine):
+        self.engine = engine
+        self._connections = {}
+        self._locks = {}
+        self._reader = None
+
+    async def reader(self):
+        # La réplica se fija para toda la petición, salvo que la sesión acabe de escribir
+        if self._reader is None or (self._reader is not self.engine and replica_router.wrote_recently()):
+            self._reader = await replica_router.reader(self.engine)
+        return self._reader
+
+    async def _connection(self, engine):
+        if engine not in self._connections:
+            self._connections[engine] = await engine.connect()
+        return self._connections[engine]
+
+    @asynccontextmanager
+    async def use(self, engine):
+        # Una conexión no admite sentencias concurrentes: los bloques de la petición se turnan
+        async with self._locks.setdefault(engine, asyncio.Lock()):
+            conn = await self._connection(engine)
+            try:
+                yield conn
+            except BaseException:
+                # Error, cancelación o statement_timeout: nunca se confirma una transacción abortada
+                await self._rollback(engine, conn)
+                raise
+            if conn.in_transaction():
+                await conn.commit()
+
+    async def _rollback(self, engine, conn):
+        """ Deshace la transacción en curso; si la conexión quedó inutilizable se descarta del pool. """
+        try:
+            if conn.in_transaction():
+                await conn.rollback()
+        except Exception:
+            del self._connections[engine]
+            await conn.invalidate()
+
+    @asynccontextmanager
+    async def transaction(self):
+        async with self._locks.setdefault(self.engine, asyncio.Lock()):
+            conn = await self._connection(self.engine)
+            if conn.in_transaction():
+                await conn.commit()
+            async with conn.begin():
+                yield conn
+
+    async def close(self):
+        """ Devuelve las conexiones al pool; si la petición vuelve a consultar, se piden de nuevo. """
+        for engine in list(self._connections):
+            async with self._locks.setdefault(engine, asyncio.Lock()):
+                conn = self._connections.pop(engine, None)
+                if conn is not None:
+                    await conn.close()
+
+
+# --------------- MOTOR COLUMNAR -----------------#
+
+# Foto en memoria de main para responder agregados sin ir a Postgres (COLUMNAR_ENGINE=1)
+COLUMNAR_ENABLED = os.getenv("COLUMNAR_ENGINE", "0") == "1"
+COLUMNAR_MAX_STALENESS = float(os.getenv("COLUMNAR_MAX_STALENESS", 5))
+COLUMNAR_CHUNK_ROWS = int(os.getenv("COLUMNAR_CHUNK_ROWS", 500_000))
+# Ids recientes que se vuelven a leer por si una transacción anterior confirmó después que otra posterior
+COLUMNAR_OVERLAP_IDS = int(os.getenv("COLUMNAR_OVERLAP_IDS", 1000))
+
+COLUMNAR_REFRESH_QUERY = """
+    SELECT main.id, main.date, crime_types.name AS crimecodedesc, areas.name AS areaname
+    FROM main
+    LEFT JOIN crime_types ON crime_types.id = main.crime_id
+    LEFT JOIN areas ON areas.id = main.area_id
+    WHERE main.id > :since
+    ORDER BY main.id
+    LIMIT :limit
+"""
+COLUMNAR_FREQUENCIES = ('month', 'week', 'quarter', 'day', 'Custom')
+
+
+class ColumnDictionary:
+    """ Codificación por diccionario de una columna de texto: cada valor distinto recibe un código entero. """
+    def __init__(self, values=()):
+        self.values = list(values)
+        self.codes = {value: code for code, value in enumerate(self.values)}
+
+    def copy(self):
+        return ColumnDictionary(self.values)
+
+    def encode(self, column):
+        local_codes, uniques = pd.factorize(pd.Series(column, dtype=object), use_na_sentinel=False)
+        for value in uniques:
+            if value not in self.codes:
+                self.codes[value] = len(self.values)
+                self.values.append(value)
+        mapping = np.array([self.codes[value] for value in uniques], dtype=np.int32)
+        dtype = np.int16 if len(self.values) <= np.iinfo(np.int16).max else np.int32
+        return mapping[local_codes].astype(dtype)
+
+    def allowed(self, values):
+        """ Tabla booleana indexada por código, para filtrar con una sola indexación vectorizada. """
+        table = np.zeros(len(self.values), dtype=bool)
+        table[[self.codes[value] for value in values if value in self.codes]] = True
+        return table
+
+    def decode(self, codes):
+        return np.array(self.values, dtype=object)[codes]
+
+
+def period_ordinals(days, freq):
+    """ Trunca días desde 1970 al periodo de DATE_TRUNC, como ordinal entero contiguo. """
+    if freq == 'day':
+        return days.astype(np.int64)
+    if freq == 'week':
+        return (days.astype(np.int64) + 3) // 7  # 1970-01-01 fue jueves; las semanas empiezan en lunes
+    if len(days) == 0:
+        return days.astype(np.int64)
+    # Convertir a meses solo el rango de días distintos y aplicarlo como tabla de búsqueda
+    first = days.min()
+    months = np.arange(first, days.max() + 1).astype('datetime64[D]').astype('datetime64[M]').astype(np.int64)
+    months = months // 3 if freq == 'quarter' else months
+    return np.take(months, days - first)
+
+
+def period_starts(ordinals, freq):
+    """ Inverso de period_ordinals: fecha de inicio de cada periodo. """
+    if freq == 'day':
+        starts = ordinals.astype('datetime64[D]')
+    elif freq == 'week':
+        starts = (ordinals * 7 - 3).astype('datetime64[D]')
+    else:
+        starts = (ordinals * 3 if freq == 'quarter' else ordinals).astype('datetime64[M]')
+    return starts.astype('datetime64[ns]')
+
+
+def group_counts(keys, sizes, weights=None):
+    """
+    Conteo por combinación de claves enteras (0..size-1) con una clave compuesta y bincount.
+    Con weights (una fila de pesos por medida) devuelve, en vez del conteo, la suma de cada medida.
+    """
+    composite = keys[0].astype(np.int64, copy=len(keys) > 1)
+    for key, size in zip(keys[1:], sizes[1:]):
+        composite *= size
+        composite += key
+    if np.prod(sizes, dtype=np.float64) <= 2 ** 24:
+        length = int(np.prod(sizes))
+        counts = np.bincount(composite, minlength=length)
+        groups = np.flatnonzero(counts)
+        counts = counts[groups]
+        if weights is not None:
+            counts = np.array([np.bincount(composite, weights=w, minlength=length)[groups] for w in weights])
+    else:
+        groups, inverse, counts = np.unique(composite, return_inverse=True, return_counts=True)
+        if weights is not None:
+            counts = np.array([np.bincount(inverse, weights=w, minlength=len(groups)) for w in weights])
+
+    digits = []
+    for size in reversed(sizes):
+        digits.append(groups % size)
+        groups = groups // size
+    return digits[::-1], counts
+
+
+class ColumnarState:
+    """
+    Foto inmutable de main: fechas como días desde 1970 (int32) y crimen/área codificados
+    por diccionario. Cada refresco publica una nueva, así las consultas en curso no se ven afectadas.
+    """
+    def __init__(self, days=None, crime_codes=None, area_codes=None, crimes=None, areas=None,
+                 watermark=0, recent_ids=frozenset()):
+        self.days = days if days is not None else np.empty(0, dtype=np.int32)
+        self.crime_codes = crime_codes if crime_codes is not None else np.empty(0, dtype=np.int16)
+        self.area_codes = area_codes if area_codes is not None else np.empty(0, dtype=np.int16)
+        self.crimes = crimes or ColumnDictionary()
+        self.areas = areas or ColumnDictionary()
+        self.watermark = watermark
+        self.recent_ids = recent_ids
+
+    def __len__(self):
+        return len(self.days)
+
+    def date_range(self):
+        return (np.datetime64(int(self.days.min()), 'D').astype(object),
+                np.datetime64(int(self.days.max()), 'D').astype(object))
+
+    def extend(self, chunks, crimes, areas, watermark, recent_ids):
+        """ Nueva foto con los bloques codificados añadidos al final. """
+        if not chunks:
+            return ColumnarState(self.days, self.crime_codes, self.area_codes, crimes, areas, watermark, recent_ids)
+        return ColumnarState(np.concatenate([self.days] + [chunk[0] for chunk in chunks]),
+                             np.concatenate([self.crime_codes] + [chunk[1] for chunk in chunks]),
+                             np.concatenate([self.area_codes] + [chunk[2] for chunk in chunks]),
+                             crimes, areas, watermark, recent_ids)
+
+    def query(self, chosen_crime, chosen_place, freq, init_time, end_time, breakdown_by=None):
+        """ Misma respuesta que grouped_data_query, resuelta con máscaras y group-bys vectorizados. """
+        return self.aggregate(self.mask(chosen_crime, chosen_place, init_time, end_time), freq, breakdown_by)
+
+    def mask(self, chosen_crime, chosen_place, init_time, end_time):
+        start = (np.datetime64(init_time, 'D') - np.datetime64(0, 'D')).astype(np.int64)
+        end = (np.datetime64(end_time, 'D') - np.datetime64(0, 'D')).astype(np.int64)
+        mask = (self.days >= start) & (self.days <= end)
+        if chosen_crime:
+            mask &= self.crimes.allowed([category_map[crime] for crime in chosen_crime])[self.crime_codes]
+        if chosen_place:
+            mask &= self.areas.allowed(chosen_place)[self.area_codes]
+        return mask
+
+    def aggregate(self, mask, freq, breakdown_by=None, measures=None):
+        """ Agrupa las filas de mask; measures ({columna: pesos}) sustituye al conteo de filas. """
+        keys, sizes = [], []
+        if freq != "Custom":
+            ordinals = period_ordinals(self.days[mask], freq)
+            if len(ordinals) == 0:
+                return None
+            first = ordinals.min()
+            keys.append(ordinals - first)
+            sizes.append(int(ordinals.max() - first) + 1)
+        dimensions = {"areaname": (self.area_codes, self.areas), "crimecodedesc": (self.crime_codes, self.crimes)}
+        for dimension in breakdown_by or []:
+            codes, dictionary = dimensions[dimension]
+            keys.append(codes[mask].astype(np.int64))
+            sizes.append(max(len(dictionary.values), 1))
+
+        if not keys:
+            if measures is not None:
+                return pd.DataFrame({name: [weights[mask].sum()] for name, weights in measures.items()})
+            return pd.DataFrame({'count': [int(mask.sum())]})
+        if len(keys[0]) == 0:
+            return None
+
+        weights = None if measures is None else [values[mask] for values in measures.values()]
+        digits, counts = group_counts(keys, sizes, weights)
+        columns = {}
+        if freq != "Custom":
+            columns['period'] = period_starts(digits.pop(0) + first, freq)
+        for dimension in breakdown_by or []:
+            columns[dimension] = dimensions[dimension][1].decode(digits.pop(0))
+        if measures is None:
+            columns['count'] = counts.astype(np.int64)
+        else:
+            columns.update(zip(measures, counts))
+        df = pd.DataFrame(columns)
+        order = [column for column in ('period', *(breakdown_by or [])) if column in df.columns]
+        return df.sort_values(order, kind='stable').reset_index(drop=True)
+
+
+def encode_chunk(rows, crimes, areas):
+    """ Codifica un bloque de filas (id, date, crimecodedesc, areaname) de main. """
+    frame = pd.DataFrame(rows, columns=['id', 'date', 'crimecodedesc', 'areaname'])
+    days = pd.to_datetime(frame['date']).values.astype('datetime64[D]').astype(np.int32)
+    return days, crimes.encode(frame['crimecodedesc']), areas.encode(frame['areaname'])
+
+
+class ColumnarSnapshot:
+    """
+    Foto columnar de main que se refresca de forma incremental desde una marca de agua (main.id).
+    Asume que main solo recibe inserciones, como ocurre a través de esta API.
+    """
+    def __init__(self):
+        self.state = ColumnarState()
+        self.refreshed_at = None
+        self.stale = True
+        self._lock = asyncio.Lock()
+
+    def mark_stale(self):
+        """ Fuerza un refresco antes de la siguiente consulta (p. ej. tras una escritura propia). """
+        self.stale = True
+
+    def is_fresh(self):
+        return (not self.stale and self.refreshed_at is not None
+                and time.monotonic() - self.refreshed_at <= COLUMNAR_MAX_STALENESS)
+
+    async def ensure_fresh(self, engine):
+        if not self.is_fresh():
+            async with self._lock:
+                if not self.is_fresh():
+                    await self._refresh(engine)
+
+    async def refresh(self, engine):
+        async with self._lock:
+            await self._refresh(engine)
+
+    async def _refresh(self, engine):
+        self.stale = False
+        state = self.state
+        crimes, areas = state.crimes.copy(), state.areas.copy()
+        watermark, recent_ids = state.watermark, set(state.recent_ids)
+        since = max(watermark - COLUMNAR_OVERLAP_IDS, 0)
+        chunks = []
+        while True:
+            async with engine.connect() as conn:
+                result = await conn.execute(text(COLUMNAR_REFRESH_QUERY),
+                                            {'since': since, 'limit': COLUMNAR_CHUNK_ROWS})
+                rows = result.fetchall()
+            if not rows:
+                break
+            since = rows[-1][0]
+            new_rows = [row for row in rows if row[0] not in recent_ids]
+            if new_rows:
+                chunks.append(await run_cpu_bound(encode_chunk, new_rows, crimes, areas))
+                watermark = max(watermark, since)
+                recent_ids.update(row[0] for row in new_rows if row[0] > watermark - COLUMNAR_OVERLAP_IDS)
+            if len(rows) < COLUMNAR_CHUNK_ROWS:
+                break
+
+        recent_ids = frozenset(row_id for row_id in recent_ids if row_id > watermark - COLUMNAR_OVERLAP_IDS)
+        self.state = await run_cpu_bound(state.extend, chunks, crimes, areas, watermark, recent_ids)
+        self.refreshed_at = time.monotonic()
+
+    async def query(self, engine, chosen_crime, chosen_place, freq, init_time, end_time, breakdown_by=None):
+        """ Resuelve un agregado desde la foto; NotImplemented si no puede (datos crudos o foto vacía). """
+        if freq not in COLUMNAR_FREQUENCIES:
+            return NotImplemented
+        await self.ensure_fresh(engine)
+        state = self.state
+        if not len(state):
+            return NotImplemented
+        build_conditions(chosen_crime, chosen_place)  # Misma validación de crímenes que la ruta SQL
+        min_date, max_date = state.date_range()
+        init_time, end_time = validate_date_range(init_time, end_time, min_date, max_date)
+        return await run_cpu_bound(state.query, chosen_crime, chosen_place, freq, init_time, end_time, breakdown_by)
+
+
+columnar_snapshot = ColumnarSnapshot()
+
+
+# --------------- ARCHIVO HISTÓRICO -----------------#
+
+# Incidentes anteriores al corte, movidos de main a Parquet por archive.py
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", "archive")
+
+ARCHIVE_RUNS_QUERY = "SELECT cutoff FROM archive_runs ORDER BY cutoff"
+
+
+def archive_rows_path(cutoff, year, month):
+    """ Filas de una ejecución del archivado, particionadas por año y mes. """
+    return os.path.join(ARCHIVE_DIR, "rows", f"year={year}", f"month={month:02d}", f"part-{cutoff}.parquet")
+
+
+def archive_counts_path(cutoff):
+    """ Conteos diarios preagregados de una ejecución del archivado. """
+    return os.path.join(ARCHIVE_DIR, "counts", f"part-{cutoff}.parquet")
+
+
+def as_date(value):
+    return pd.Timestamp(value).date() if value is not None else None
+
+
+def as_datetime(value):
+    return datetime(value.year, value.month, value.day)
+
+
+def combine_date_ranges(*ranges):
+    """ Rango que cubre todos los dados; los extremos None (sin datos) se ignoran. """
+    starts = [as_date(start) for start, _ in ranges if start is not None]
+    ends = [as_date(end) for _, end in ranges if end is not None]
+    return (min(starts) if starts else None), (max(ends) if ends else None)
+
+
+class ArchiveState(ColumnarState):
+    """ Conteos diarios archivados por (día, crimen, área), con la suma de pond para las series ponderadas. """
+    def __init__(self, days=None, crime_codes=None, area_codes=None, crimes=None, areas=None,
+                 counts=None, pond_sums=None):
+        super().__init__(days, crime_codes, area_codes, crimes, areas)
+        self.counts = counts if counts is not None else np.empty(0)
+        self.pond_sums = pond_sums if pond_sums is not None else np.empty(0)
+
+    def query(self, chosen_crime, chosen_place, freq, init_time, end_time, breakdown_by=None):
+        """ Como ColumnarState.query, con count y pond_sum sumados sobre los conteos diarios. """
+        return self.aggregate(self.mask(chosen_crime, chosen_place, init_time, end_time), freq, breakdown_by,
+                              {'count': self.counts, 'pond_sum': self.pond_sums})
+
+
+class ArchiveUnavailable(RuntimeError):
+    """ Faltan ficheros de ejecuciones registradas en archive_runs. """
+
+
+def load_archive_counts(cutoffs):
+    """ Carga los conteos diarios de las ejecuciones registradas en archive_runs. """
+    paths = [archive_counts_path(cutoff) for cutoff in cutoffs]
+    missing = [path for path in paths if not os.path.exists(path)]
+    if missing:
+        # Sin estos ficheros las series saldrían incompletas sin avisar
+        raise ArchiveUnavailable(f"Faltan ficheros del archivo en {ARCHIVE_DIR}: {', '.join(missing)}")
+    if not paths:
+        return ArchiveState()
+    frame = pd.concat([pd.read_parquet(path) for path in paths], ignore_index=True)
+    crimes, areas = ColumnDictionary(), ColumnDictionary()
+    return ArchiveState(pd.to_datetime(frame['date']).values.astype('datetime64[D]').astype(np.int32),
+                        crimes.encode(frame['crimecodedesc']), areas.encode(frame['areaname']), crimes, areas,
+                        frame['count'].to_numpy(np.float64), frame['pond_sum'].to_numpy(np.float64))
+
+
+def read_archived_rows(cutoffs, chosen_crime, chosen_place, init_time, end_time):
+    """ Filas archivadas (period, crimecodedesc, areaname) del rango; solo se abren los meses que lo cruzan. """
+    first, last = (init_time.year, init_time.month), (end_time.year, end_time.month)
+    paths = []
+    for cutoff in cutoffs:
+        for path in glob.glob(os.path.join(ARCHIVE_DIR, "rows", "year=*", "month=*", f"part-{cutoff}.parquet")):
+            year, month = (int(part.split("=")[1]) for part in path.split(os.sep)[-3:-1])
+            if first <= (year, month) <= last:
+                paths.append(path)
+    if not paths:
+        return None
+
+    date = pa_dataset.field('date')
+    condition = (date >= pd.Timestamp(init_time)) & (date <= pd.Timestamp(end_time))
+    if chosen_crime:
+        condition &= pa_dataset.field('crimecodedesc').isin([category_map[crime] for crime in chosen_crime])
+    if chosen_place:
+        condition &= pa_dataset.field('areaname').isin(list(chosen_place))
+    table = pa_dataset.dataset(paths, format="parquet").to_table(
+        columns=['date', 'crimecodedesc', 'areaname'], filter=condition)
+    frame = table.to_pandas().rename(columns={'date': 'period'})
+    return frame.sort_values('period', kind='stable').reset_index(drop=True)
+
+
+def merge_tiers(parts, freq, breakdown_by=None, weighted=False):
+    """
+    Une los resultados del archivo y de main. Los periodos que cruzan el corte aparecen en ambos
+    y se suman; con weighted, el reescalado de pond se hace sobre la serie ya unida.
+    """
+    parts = [part for part in parts if part is not None and len(part)]
+    if not parts:
+        return None
+    frame = pd.concat(parts, ignore_index=True)
+    if 'period' in frame.columns:
+        frame['period'] = pd.to_datetime(frame['period'], utc=True).dt.tz_localize(None)
+    if freq is None:
+        return frame.sort_values('period', kind='stable').reset_index(drop=True)
+
+    keys = [column for column in ('period', *(breakdown_by or [])) if column in frame.columns]
+    measures = [column for column in ('count', 'pond_sum', 'margin') if column in frame.columns]
+    if 'margin' in frame.columns:
+        # Los errores de partes independientes se suman en cuadratura; lo archivado es exacto
+        frame['margin'] = frame['margin'].fillna(0).astype(float) ** 2
+    if keys:
+        frame = frame.groupby(keys, as_index=False, sort=True, observed=True)[measures].sum()
+    else:
+        frame = frame[measures].sum().to_frame().T
+    if weighted and 'pond_sum' in frame.columns:
+        frame['count'] = frame['pond_sum'] * frame['count'].sum() / frame['pond_sum'].sum()
+    else:
+        frame['count'] = frame['count'].round().astype(np.int64)
+    if 'margin' in frame.columns:
+        frame['margin'] = np.sqrt(frame['margin']).round().astype(np.int64)
+    return frame.drop(columns='pond_sum', errors='ignore')
+
+
+def series_kpis(series):
+    """ Los mismos KPIs que kpi_query, sobre una serie ya agregada (p. ej. la unión con el archivo). """
+    if series is None or series.empty:
+        return {"total": 0, "mean": 0, "periods": 0, "peak_period": None, "peak_count": None,
+                "lowest_period": None, "lowest_count": None}
+    counts = series['count']
+    peak, lowest = counts.idxmax(), counts.idxmin()
+    return {"total": int(counts.sum()), "mean": float(counts.mean()), "periods": len(series),
+            "peak_period": series['period'][peak].to_pydatetime(), "peak_count": int(counts[peak]),
+            "lowest_period": series['period'][lowest].to_pydatetime(), "lowest_count": int(counts[lowest])}
+
+
+class ArchiveTier:
+    """
+    Corte y conteos del archivo histórico. archive_runs se consulta en cada petición (las concurrentes
+    comparten la consulta): con un corte cacheado, las consultas a main no verían las filas que
+    archive.py acaba de borrar. Los conteos se recargan cuando archive.py registra una ejecución.
+    Si faltan ficheros, solo fallan las consultas que necesitan fechas archivadas.
+    """
+    def __init__(self):
+        self.cutoffs = ()
+        self.state = ArchiveState()
+        self.unavailable = None
+        self._flight = SingleFlight()
+
+    @property
+    def cutoff(self):
+        """ Primer día que sigue en main; lo anterior está en el archivo. """
+        return self.cutoffs[-1] if self.cutoffs else None
+
+    async def refresh(self, engine):
+        await self._flight.do("archive_runs", self._check, engine)
+        return self
+
+    async def _check(self, engine):
+        async with engine.connect() as conn:
+            result = await conn.execute(text(ARCHIVE_RUNS_QUERY))
+            cutoffs = tuple(row[0] for row in result.fetchall())
+        if cutoffs != self.cutoffs or self.unavailable:
+            try:
+                self.state, self.unavailable = await run_cpu_bound(load_archive_counts, cutoffs), None
+            except ArchiveUnavailable as e:
+                print(e)
+                self.state, self.unavailable = ArchiveState(), str(e)
+            self.cutoffs = cutoffs
+
+    def covers(self, init_time):
+        """ Si una consulta desde init_time (None: todo el rango) necesita datos archivados. """
+        return self.cutoff is not None and (init_time is None or init_time.date() < self.cutoff)
+
+    def require(self):
+        """ Para las consultas que leen el archivo: 503 si faltan sus ficheros. """
+        if self.unavailable:
+            raise HTTPException(status_code=503,
+                                detail=f"El archivo histórico no está disponible; consulta desde {self.cutoff}")
+
+    def date_range(self):
+        return self.state.date_range() if len(self.state) else (None, None)
+
+
+archive_tier = ArchiveTier()
+
+
+# --------------- ACTUALIZACIONES EN VIVO -----------------#
+
+LIVE_CHANNEL = "incident_counts"
+# Postgres limita el payload de un NOTIFY a 8000 bytes
+LIVE_NOTIFY_BYTES = 7000
+LIVE_QUEUE_SIZE = int(os.getenv("LIVE_QUEUE_SIZE", 100))
+LIVE_MAX_SUBSCRIBERS = int(os.getenv("LIVE_MAX_SUBSCRIBERS", 500))
+LIVE_HEARTBEAT = float(os.getenv("LIVE_HEARTBEAT", 15))
+LIVE_FREQUENCIES = ('month', 'week', 'quarter', 'day', 'Custom')
+# Aviso al suscriptor de que se perdieron deltas y debe volver a pedir la serie
+LIVE_RESYNC = object()
+
+
+def incident_count_payloads(df):
+    """ Conteos (día, crimen, área, n) de un lote insertado, en payloads JSON que caben en un NOTIFY. """
+    counts = (df.assign(day=pd.to_datetime(df['date']).dt.strftime('%Y-%m-%d'))
+              .groupby(['day', 'crimecodedesc', 'areaname']).size())
+    payloads, chunk, size = [], [], 2
+    for (day, crime, area), count in counts.items():
+        row = [day, crime, area, int(count)]
+        encoded = len(json.dumps(row)) + 2
+        if chunk and size + encoded > LIVE_NOTIFY_BYTES:
+            payloads.append(json.dumps(chunk))
+            chunk, size = [], 2
+        chunk.append(row)
+        size += encoded
+    if chunk:
+        payloads.append(json.dumps(chunk))
+    return payloads
+
+
+def live_deltas(batch, days, freq, crimes, places):
+    """ Delta por periodo de un lote para un filtro; None si el lote no le afecta. """
+    mask = np.ones(len(batch), dtype=bool)
+    if crimes is not None:
+        mask &= batch['crimecodedesc'].isin(crimes).to_numpy()
+    if places is not None:
+        mask &= batch['areaname'].isin(places).to_numpy()
+    if not mask.any():
+        return None
+    counts = batch['count'].to_numpy()[mask]
+    if freq == "Custom":
+        return [{"count": int(counts.sum())}]
+    periods, inverse = np.unique(period_ordinals(days[mask], freq), return_inverse=True)
+    totals = np.bincount(inverse, weights=counts)
+    return [{"period": str(start), "count": int(total)}
+            for start, total in zip(period_starts(periods, freq).astype('datetime64[D]'), totals)]
+
+
+class LiveSubscription:
+    """ Filtro ya autorizado de un suscriptor y su cola de deltas pendientes de enviar. """
+    def __init__(self, chosen_crime, chosen_place, freq):
+        self.crimes = frozenset(category_map[crime] for crime in chosen_crime) if chosen_crime else None
+        self.places = frozenset(chosen_place) if chosen_place else None
+        self.freq = freq
+        self.queue = asyncio.Queue(maxsize=LIVE_QUEUE_SIZE)
+
+    @property
+    def key(self):
+        return self.freq, self.crimes, self.places
+
+    def push(self, delta):
+        if self.queue.full():
+            # El cliente va atrasado: se descartan sus deltas y tendrá que volver a pedir la serie
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            delta = LIVE_RESYNC
+        self.queue.put_nowait(delta)
+
+
+class LiveUpdates:
+    """
+    Reparte los conteos de cada lote ingresado entre los suscriptores en vivo. Los lotes llegan por
+    LISTEN, así que cada worker recibe también lo que ingresan los demás. Los deltas de cada filtro
+    distinto se calculan una vez por lote; la escucha se abre con el primer suscriptor y su conexión
+    se cierra cuando se va el último.
+    """
+    def __init__(self):
+        self.subscribers = set()
+        self.batches = 0
+        self._listener = None
+        self._listening = asyncio.Event()
+
+    async def subscribe(self, engine, chosen_crime, chosen_place, freq):
+        if len(self.subscribers) >= LIVE_MAX_SUBSCRIBERS:
+            raise HTTPException(status_code=503, detail="Demasiadas suscripciones en vivo, inténtalo más tarde")
+        if self._listener is None or self._listener.done():
+            self._listener = asyncio.create_task(self._listen(engine))
+        subscription = LiveSubscription(chosen_crime, chosen_place, freq)
+        self.subscribers.add(subscription)
+        try:
+            await asyncio.wait_for(self._listening.wait(), LIVE_HEARTBEAT)
+        except asyncio.TimeoutError:
+            self.unsubscribe(subscription)
+            raise HTTPException(status_code=503, detail="No se pudo abrir la escucha en vivo")
+        return subscription
+
+    def unsubscribe(self, subscription):
+        self.subscribers.discard(subscription)
+        if not self.subscribers:
+            # Sin suscriptores no se escucha: la conexión LISTEN no queda ocupada
+            self._stop_listening()
+
+    def publish(self, rows):
+        if not self.subscribers:
+            return
+        self.batches += 1
+        batch = pd.DataFrame(rows, columns=['day', 'crimecodedesc', 'areaname', 'count'])
+        days = pd.to_datetime(batch['day']).values.astype('datetime64[D]').astype(np.int64)
+        deltas = {}
+        for subscription in list(self.subscribers):
+            if subscription.key not in deltas:
+                deltas[subscription.key] = live_deltas(batch, days, *subscription.key)
+            if deltas[subscription.key]:
+                subscription.push(deltas[subscription.key])
+
+    def resync(self, reason):
+        """ Se han perdido lotes: todos los suscriptores deben volver a pedir la serie. """
+        print(f"Actualizaciones en vivo perdidas, se pide resincronizar: {reason}")
+        for subscription in list(self.subscribers):
+            subscription.push(LIVE_RESYNC)
+
+    async def _listen(self, engine):
+        def on_notify(connection, pid, channel, payload):
+            try:
+                self.publish(json.loads(payload))
+            except Exception as e:
+                self.resync(e)
+
+        while True:
+            try:
+                # Siempre en el primario: los NOTIFY no se replican
+                async with engine.connect() as conn:
+                    try:
+                        raw = (await conn.get_raw_connection()).driver_connection
+                        await raw.add_listener(LIVE_CHANNEL, on_notify)
+                        self._listening.set()
+                        while True:
+                            await asyncio.sleep(LIVE_HEARTBEAT)
+                            # Un ida y vuelta detecta también las conexiones medio abiertas que no se ven cerradas
+                            await asyncio.wait_for(raw.execute("SELECT 1"), LIVE_HEARTBEAT)
+                    finally:
+                        # La conexión no vuelve al pool con el LISTEN activo
+                        await conn.invalidate()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # Lo ingresado mientras no se escuchaba se ha perdido
+                self._listening.clear()
+                self.resync(f"escucha de {LIVE_CHANNEL} interrumpida: {e}")
+            await asyncio.sleep(1)
+
+    def _stop_listening(self):
+        if self._listener is not None:
+            self._listener.cancel()
+            self._listener = None
+        self._listening.clear()
+
+    async def stop(self):
+        self._stop_listening()
+
+
+live_updates = LiveUpdates()
+
+
+# --------------- BUFFER DE INGESTA -----------------#
+
+INGEST_BUFFER_ENABLED = os.getenv("INGEST_BUFFER", "0") == "1"
+INGEST_LOG_DIR = os.getenv("INGEST_LOG_DIR", "ingest")
+# Un registro por proceso; con varios workers cada uno reclama uno libre, y en una recarga los
+# workers viejos y los nuevos conviven: con gunicorn hacen falta al menos dos por worker
+INGEST_LOG_SLOTS = int(os.getenv("INGEST_LOG_SLOTS", 16))
+INGEST_FLUSH_ROWS = int(os.getenv("INGEST_FLUSH_ROWS", 500))
+INGEST_FLUSH_INTERVAL = float(os.getenv("INGEST_FLUSH_INTERVAL", 1))
+
+# Registros que main rechaza por sus datos: se apartan aquí (uno por registro de ingesta) para revisarlos a mano
+INGEST_DEAD_LETTER_DIR = os.getenv("INGEST_DEAD_LETTER_DIR", os.path.join(INGEST_LOG_DIR, "dead-letter"))
+
+INGEST_CHECKPOINT_QUERY = "SELECT seq FROM ingest_checkpoints WHERE log = :log"
+INGEST_CHECKPOINT_UPSERT = """
+    INSERT INTO ingest_checkpoints (log, seq) VALUES (:log, :seq)
+    ON CONFLICT (log) DO UPDATE SET seq = EXCLUDED.seq, flushed_at = now()
+"""
+
+
+def normalize_incident(record):
+    """
+    Incidente listo para el registro: fecha sin zona horaria (convertida a UTC) y crimen y área no
+    vacíos. Lanza ValueError si no es válido, mientras el cliente aún espera la respuesta.
+    """
+    date = pd.Timestamp(record['date'])
+    if pd.isna(date):
+        raise ValueError("Fecha no válida")
+    if date.tzinfo is not None:
+        date = date.tz_convert("UTC").tz_localize(None)
+    for field in ('crimecodedesc', 'areaname'):
+        if not isinstance(record.get(field), str) or not record[field].strip():
+            raise ValueError(f"{field} no válido")
+    return {'date': date.isoformat(), 'crimecodedesc': record['crimecodedesc'], 'areaname': record['areaname']}
+
+
+def is_bad_record(exc):
+    """ Errores debidos a los datos de un registro, que reintentar no arregla (a diferencia de una caída de conexión). """
+    if isinstance(exc, sa.exc.DBAPIError):
+        return isinstance(exc, (sa.exc.DataError, sa.exc.IntegrityError)) and not exc.connection_invalidated
+    return isinstance(exc, (ValueError, TypeError, KeyError))
+
+
+class IngestLog:
+    """
+    Fichero local de solo-añadido con una línea JSON por incidente. El proceso que lo abre lo
+    bloquea con flock, así que el registro de un proceso caído lo recupera el siguiente que arranque.
+    """
+    def __init__(self, directory, slots):
+        self.directory = directory
+        self.slots = slots
+        self.name = None
+        self._file = None
+
+    def open(self):
+        os.makedirs(self.directory, exist_ok=True)
+        for slot in range(self.slots):
+            file = open(os.path.join(self.directory, f"ingest-{slot}.log"), "a+b")
+            try:
+                fcntl.flock(file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                file.close()
+                continue
+            self.name, self._file = f"ingest-{slot}", file
+            return
+        raise RuntimeError("No quedan registros de ingesta libres, aumenta INGEST_LOG_SLOTS")
+
+    def read(self):
+        """ Registros completos; una última línea cortada por una caída se descarta del fichero. """
+        self._file.seek(0)
+        records, valid_bytes = [], 0
+        for line in self._file.read().splitlines(keepends=True):
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                break
+            if not line.endswith(b"\n"):
+                records.pop()
+                break
+            valid_bytes += len(line)
+        self._file.truncate(valid_bytes)
+        return records
+
+    def write(self, data):
+        size = os.fstat(self._file.fileno()).st_size
+        try:
+            self._file.write(data)
+            self._file.flush()
+            os.fsync(self._file.fileno())
+        except OSError:
+            # Sin líneas a medias que invaliden lo que se escriba después
+            self._file.truncate(size)
+            raise
+
+    def truncate(self):
+        self._file.truncate(0)
+        os.fsync(self._file.fileno())
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def append_durably(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "ab") as file:
+        file.write(data)
+        file.flush()
+        os.fsync(file.fileno())
+
+
+class IngestBuffer:
+    """
+    Ingesta write-behind: cada incidente se confirma al cliente en cuanto está en el registro local
+    (las escrituras concurrentes comparten un fsync) y un volcador lo inserta en main por lotes de
+    INGEST_FLUSH_ROWS o cada INGEST_FLUSH_INTERVAL segundos. El lote y el punto de control
+    (ingest_checkpoints) se confirman en la misma transacción; al arrancar se reinsertan los
+    registros posteriores al punto de control. Si un lote falla se reintenta fila a fila, y las filas
+    que main rechaza por sus datos se apartan en INGEST_DEAD_LETTER_DIR para no bloquear las siguientes.
+    """
+    def __init__(self):
+        self.log = IngestLog(INGEST_LOG_DIR, INGEST_LOG_SLOTS)
+        self.engine = None
+        self.replayed = 0
+        self.flushed_rows = 0
+        self.dead_letters = 0
+        self.flush_seconds = []
+        self.last_flush_at = None
+        self.last_error = None
+        self._seq = 0
+        self._durable_seq = 0
+        self._flushed_seq = 0
+        self._queue = []
+        self._pending = []
+        self._io_lock = asyncio.Lock()
+        self._flush_lock = asyncio.Lock()
+        self._wakeup = asyncio.Event()
+        self._writer = None
+        self._flusher = None
+
+    async def start(self, engine):
+        """ Reclama un registro, recupera lo no volcado y arranca el volcador. """
+        self.engine = engine
+        await asyncio.to_thread(self.log.open)
+        records = await asyncio.to_thread(self.log.read)
+        async with engine.connect() as conn:
+            row = (await conn.execute(text(INGEST_CHECKPOINT_QUERY), {'log': self.log.name})).fetchone()
+        self._flushed_seq = row[0] if row else 0
+        self._queue = [record for record in records if record['seq'] > self._flushed_seq]
+        self._seq = self._durable_seq = max([self._flushed_seq] + [record['seq'] for record in records])
+        self.replayed = len(self._queue)
+        self._flusher = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """ Vuelca lo pendiente y libera el registro; lo que no se pueda volcar queda en él. """
+        if self._flusher is not None:
+            self._flusher.cancel()
+            self._flusher = None
+            try:
+                await self.flush()
+            except Exception as e:
+                print(f"No se pudo volcar la ingesta al parar: {e}")
+        self.log.close()
+
+    async def submit(self, record):
+        """ Añade un incidente (date, crimecodedesc, areaname) y vuelve cuando está en disco. """
+        record = normalize_incident(record)
+        self._seq += 1
+        seq = self._seq
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append(({'seq': seq, **record}, future))
+        if self._writer is None or self._writer.done():
+            self._writer = asyncio.create_task(self._write_pending())
+        await asyncio.shield(future)
+        return seq
+
+    async def _write_pending(self):
+        while self._pending:
+            batch, self._pending = self._pending, []
+            records = [record for record, _ in batch]
+            data = b"".join(json.dumps(record, default=str).encode() + b"\n" for record in records)
+            try:
+                async with self._io_lock:
+                    await asyncio.to_thread(self.log.write, data)
+                    self._durable_seq = records[-1]['seq']
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            # Solo lo que ya está en disco entra en la cola, en orden de secuencia
+            self._queue.extend(records)
+            for _, future in batch:
+                future.set_result(None)
+            if len(self._queue) >= INGEST_FLUSH_ROWS:
+                self._wakeup.set()
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), INGEST_FLUSH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                # Los registros siguen en la cola y en disco; se reintenta en la siguiente vuelta
+                self.last_error = str(e)
+                print(f"Error al volcar la ingesta: {e}")
+
+    async def flush(self):
+        async with self._flush_lock:
+            # Filas que quedan por reintentar de una en una tras el fallo de su lote
+            single_rows = 0
+            while self._queue:
+                batch = self._queue[:1 if single_rows else INGEST_FLUSH_ROWS]
+                start = time.perf_counter()
+                try:
+                    await self._insert(batch)
+                except Exception as e:
+                    if len(batch) > 1:
+                        # Un registro inválido no puede bloquear el buffer: se busca fila a fila
+                        single_rows = len(batch)
+                        continue
+                    if not is_bad_record(e):
+                        raise
+                    await self._dead_letter(batch[0], e)
+                else:
+                    self.flushed_rows += len(batch)
+                    self.flush_seconds = (self.flush_seconds + [time.perf_counter() - start])[-100:]
+                    self.last_flush_at = datetime.now()
+                    self.last_error = None
+                    dimension_catalog.invalidate()
+                    columnar_snapshot.mark_stale()
+                    dataset_version.bump()
+                del self._queue[:len(batch)]
+                self._flushed_seq = batch[-1]['seq']
+                single_rows = max(single_rows - len(batch), 0)
+            # Con todo lo escrito ya en main, el registro se vacía para no crecer sin límite
+            async with self._io_lock:
+                if self._durable_seq == self._flushed_seq:
+                    await asyncio.to_thread(self.log.truncate)
+
+    async def _insert(self, batch):
+        """ Inserta un lote en main y avanza el punto de control, en la misma transacción. """
+        frame = pd.DataFrame(batch)
+        # submit ya guarda fechas sin zona en UTC; utc=True admite también registros anteriores con zona
+        frame['date'] = pd.to_datetime(frame['date'], utc=True).dt.tz_localize(None)
+        frame = apply_pond(frame)
+        async with self.engine.begin() as conn:
+            await insert_incidents(conn, frame)
+            await conn.execute(text(INGEST_CHECKPOINT_UPSERT), {'log': self.log.name, 'seq': batch[-1]['seq']})
+
+    async def _dead_letter(self, record, error):
+        """ Aparta un registro que main rechaza y avanza el punto de control más allá de él. """
+        line = json.dumps({'record': record, 'error': str(error), 'at': datetime.now()}, default=str).encode() + b"\n"
+        path = os.path.join(INGEST_DEAD_LETTER_DIR, f"{self.log.name}.log")
+        await asyncio.to_thread(append_durably, path, line)
+        async with self.engine.begin() as conn:
+            await conn.execute(text(INGEST_CHECKPOINT_UPSERT), {'log': self.log.name, 'seq': record['seq']})
+        self.dead_letters += 1
+        self.last_error = f"Registro {record['seq']} apartado en {path}: {error}"
+        print(self.last_error)
+
+    def stats(self):
+        latencies = sorted(self.flush_seconds)
+        return {
+            "log": self.log.name,
+            "depth": len(self._queue) + len(self._pending),
+            "replayed": self.replayed,
+            "flushed_rows": self.flushed_rows,
+            "flushed_seq": self._flushed_seq,
+            "dead_letters": self.dead_letters,
+            "last_flush_at": self.last_flush_at,
+            "flush_ms_p50": round(latencies[len(latencies) // 2] * 1000, 1) if latencies else None,
+            "flush_ms_max": round(latencies[-1] * 1000, 1) if latencies else None,
+            "last_error": self.last_error,
+        }
+
+
+ingest_buffer = IngestBuffer()
+
+
+# --------------- PERFILADO POR PETICIÓN -----------------#
+
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+PROFILE_SAMPLE_INTERVAL = float(os.getenv("PROFILE_SAMPLE_INTERVAL", 0.005))
+# Perfiles guardados que se conservan; los más antiguos se borran
+PROFILE_KEEP = int(os.getenv("PROFILE_KEEP", 50))
+PROFILE_ID_PATTERN = re.compile(r"^[0-9a-f]{32}$")
+
+
+@contextmanager
+def profile_span(name):
+    """ Suma la duración del bloque al apartado name del perfil de la petición, si se está perfilando. """
+    profile = CURRENT_PROFILE.get()
+    if profile is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        profile.add_span(name, time.perf_counter() - start)
+
+
+def fold_stack(frame):
+    """ Pila en formato plegado (raíz;...;hoja), el que leen flamegraph.pl y speedscope. """
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+class RequestProfile:
+    """
+    Perfil de una petición: tiempo por apartado (SQL, Prophet, pandas, serialización), cada sentencia
+    SQL y muestras de pila de los hilos que ejecutan su trabajo de CPU. El event loop lo comparten
+    todas las peticiones, así que no se muestrea: su parte aparece como tiempo "otros".
+    """
+    def __init__(self, method, path):
+        self.id = uuid.uuid4().hex
+        self.method = method
+        self.path = path
+        self.user = None
+        self.allowed = False
+        self.status = None
+        self.started_at = datetime.now()
+        self.spans = {}
+        self.statements = []
+        self.stacks = Counter()
+        self.samples = 0
+        self._start = time.perf_counter()
+        self._elapsed = None
+        self._threads = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._sampler = None
+
+    def add_span(self, name, seconds):
+        with self._lock:
+            self.spans[name] = self.spans.get(name, 0) + seconds
+
+    def add_statement(self, statement, seconds, rows):
+        with self._lock:
+            self.statements.append({"statement": " ".join(statement.split())[:500],
+                                    "ms": round(seconds * 1000, 2), "rows": rows})
+
+    def sampled(self, func):
+        """ Envuelve func para muestrear el hilo que la ejecute mientras dure. """
+        @functools.wraps(func)
+        def run(*args):
+            thread_id = threading.get_ident()
+            self._threads.add(thread_id)
+            try:
+                return func(*args)
+            finally:
+                self._threads.discard(thread_id)
+        return run
+
+    def _sample(self):
+        while not self._stop.wait(PROFILE_SAMPLE_INTERVAL):
+            frames = sys._current_frames()
+            for thread_id in list(self._threads):
+                frame = frames.get(thread_id)
+                if frame is not None:
+                    with self._lock:
+                        self.stacks[fold_stack(frame)] += 1
+                        self.samples += 1
+
+    def start(self):
+        self._sampler = threading.Thread(target=self._sample, name=f"profile-{self.id[:8]}", daemon=True)
+        self._sampler.start()
+
+    def finish(self):
+        self._elapsed = time.perf_counter() - self._start
+        self._stop.set()
+        if self._sampler is not None:
+            self._sampler.join()
+
+    def to_dict(self):
+        breakdown = {name: round(seconds * 1000, 2) for name, seconds in self.spans.items()}
+        breakdown["db"] = round(sum(statement["ms"] for statement in self.statements), 2)
+        total = round(self._elapsed * 1000, 2)
+        breakdown["otros"] = round(max(total - sum(breakdown.values()), 0), 2)
+        return {
+            "id": self.id,
+            "method": self.method,
+            "path": self.path,
+            "status": self.status,
+            "user": self.user,
+            "started_at": self.started_at.isoformat(),
+            "total_ms": total,
+            "breakdown_ms": breakdown,
+            "sql": self.statements,
+            "sample_interval_ms": PROFILE_SAMPLE_INTERVAL * 1000,
+            "samples": self.samples,
+            "stacks": dict(self.stacks.most_common()),
+        }
+
+    def save(self):
+        """ Guarda el perfil en PROFILE_DIR y borra los más antiguos por encima de PROFILE_KEEP. """
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        with open(profile_path(self.id), "w") as file:
+            json.dump(self.to_dict(), file, default=str)
+        saved = sorted((entry for entry in os.scandir(PROFILE_DIR) if entry.name.endswith(".json")),
+                       key=lambda entry: entry.stat().st_mtime)
+        for entry in saved[:-PROFILE_KEEP]:
+            os.remove(entry.path)
+
+
+def profile_path(profile_id):
+    return os.path.join(PROFILE_DIR, f"{profile_id}.json")
+
+
+def wants_profile(scope):
+    """ La petición pide perfil con la cabecera X-Profile: 1 o el parámetro ?profile=1. """
+    query = urllib.parse.parse_qs(scope.get("query_string", b"").decode("latin-1"))
+    if "1" in query.get("profile", []):
+        return True
+    return any(name == b"x-profile" and value == b"1" for name, value in scope["headers"])
+
+
+class ProfilingMiddleware:
+    """
+    Middleware ASGI que perfila las peticiones que lo piden. Sin la marca, la petición pasa sin
+    más coste que la comprobación. El muestreo de pilas solo arranca cuando la autenticación marca el
+    perfil como permitido (administradores), y solo esos perfiles se guardan; el id va en la cabecera
+    X-Profile-Id de la respuesta.
+    """
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not wants_profile(scope):
+            await self.app(scope, receive, send)
+            return
+
+        profile = RequestProfile(scope["method"], scope["path"])
+
+        async def send_with_profile(message):
+            if message["type"] == "http.response.start":
+                profile.status = message["status"]
+                if profile.allowed:
+                    message["headers"] = [*message.get("headers", []), (b"x-profile-id", profile.id.encode())]
+            await send(message)
+
+        token = CURRENT_PROFILE.set(profile)
+        try:
+            await self.app(scope, receive, send_with_profile)
+        finally:
+            CURRENT_PROFILE.reset(token)
+            profile.finish()
+            if profile.allowed:
+                await run_cpu_bound(profile.save)
+
+
 # --------------- FUNCIONES AUXILIARES -----------------#
 
+PERMISSIONS_QUERY = """
+    SELECT p.resource
+    FROM usuarios u
+    JOIN user_roles ur ON u.id = ur.user_id
+    JOIN roles r ON ur.role_id = r.id
+    JOIN role_permissions rp ON r.id = rp.role_id
+    JOIN permissions p ON rp.permission_id = p.id
+    WHERE u.email = :email
+    GROUP BY p.resource
+"""
+
+DATE_RANGE_QUERY = "SELECT MIN(date) AS min_date, MAX(date) AS max_date FROM main"
+
+
+def validate_date_range(init_time, end_time, min_date, max_date):
+    """ Completa y valida el rango de fechas contra el rango disponible en main. """
+    if init_time is None or end_time is None:
+        init_time = min_date
+        end_time = max_date
+    else:
+        init_time = init_time.date()
+        end_time = end_time.date()
+
+    if init_time > end_time:
+        raise HTTPException(status_code=400, detail="La fecha inicial no puede ser mayor que la fecha final")
+    if end_time > max_date:
+        raise HTTPException(status_code=400, detail=f"La fecha final no puede ser mayor que la fecha máxima ({max_date})")
+    if init_time < min_date:
+        raise HTTPException(status_code=400, detail=f"La fecha inicial no puede ser menor que la fecha mínima ({min_date})")
+    return init_time, end_time
+
+
+BREAKDOWN_DIMENSIONS = ("areaname", "crimecodedesc")
+# Dimensión -> (columna de código en main, tabla de la dimensión)
+DIMENSION_TABLES = {"areaname": ("area_id", "areas"), "crimecodedesc": ("crime_id", "crime_types")}
+BREAKDOWN_LAYOUTS = ("long", "wide")
+
+
+def check_breakdown(breakdown_by, layout):
+    if breakdown_by and any(dimension not in BREAKDOWN_DIMENSIONS for dimension in breakdown_by):
+        raise HTTPException(status_code=400, detail=f"breakdown_by no válido, use {BREAKDOWN_DIMENSIONS}")
+    if layout not in BREAKDOWN_LAYOUTS:
+        raise HTTPException(status_code=400, detail=f"Layout no válido, use uno de {BREAKDOWN_LAYOUTS}")
+
+
+def grouped_data_query(crime_conditions, place_conditions, freq, init_time, end_time, breakdown_by=None,
+                       weighted=False, pond_sums=False):
+    """
+    Construye la consulta agrupada (o de datos crudos) para main. Con breakdown_by se agrupa
+    además por esas dimensiones, obteniendo los conteos de todos sus miembros en un solo recorrido.
+    Con weighted, count es SUM(pond) reescalado para que el total coincida con el conteo sin ponderar,
+    como apply_ponderation_to_data pero en la misma pasada. Con pond_sums se devuelve SUM(pond) sin
+    reescalar, para reescalar después junto con el archivo histórico.
+    """
+    date_filter = f"AND date BETWEEN '{init_time}' AND '{end_time}'"
+    breakdown_by = list(breakdown_by or [])
+    # Se agrupa por los códigos smallint y solo el resultado agregado se une a las dimensiones
+    keys = "".join(f", {DIMENSION_TABLES[dimension][0]}" for dimension in breakdown_by)
+    names = "".join(f", {DIMENSION_TABLES[dimension][1]}.name AS {dimension}" for dimension in breakdown_by)
+    joins = " ".join(f"LEFT JOIN {table} ON {table}.id = g.{key}"
+                     for key, table in (DIMENSION_TABLES[dimension] for dimension in breakdown_by))
+    order = "".join(f", {dimension}" for dimension in breakdown_by)
+    pond_sum = ", SUM(pond) AS pond_sum" if weighted or pond_sums else ""
+    if pond_sums:
+        count = "g.count, g.pond_sum"
+    elif weighted:
+        count = "g.pond_sum * SUM(g.count) OVER () / NULLIF(SUM(g.pond_sum) OVER (), 0) AS count"
+    else:
+        count = "g.count"
+    if freq in['month', 'week', 'quarter', 'day']:
+        return f"""
+            SELECT g.period{names}, {count}
+            FROM (
+                SELECT DATE_TRUNC('{freq}', date) AS period{keys}, COUNT(*) AS count{pond_sum}
+                FROM main
+                WHERE ({crime_conditions}) AND ({place_conditions}) {date_filter}
+                GROUP BY period{keys}
+            ) g {joins}
+            ORDER BY g.period{order}
+        """
+    elif freq == "Custom" and init_time is not None and end_time is not None:
+        if not breakdown_by:
+            # Un único total: ponderar y reescalar devuelve el mismo conteo
+            return f"""
+                SELECT COUNT(*) AS count
+                FROM main
+                WHERE ({crime_conditions}) AND ({place_conditions}) {date_filter}
+            """
+        return f"""
+            SELECT {names[2:]}, {count}
+            FROM (
+                SELECT {keys[2:]}, COUNT(*) AS count{pond_sum}
+                FROM main
+                WHERE ({crime_conditions}) AND ({place_conditions}) {date_filter}
+                GROUP BY {keys[2:]}
+            ) g {joins}
+            ORDER BY {order[2:]}
+        """
+    elif freq is None and init_time is not None and end_time is not None:
+        if breakdown_by:
+            raise HTTPException(status_code=400, detail="breakdown_by requiere una frecuencia de agrupación")
+        if weighted:
+            raise HTTPException(status_code=400, detail="weighted requiere una frecuencia de agrupación")
+        return f"""
+            SELECT main.date AS period, crime_types.name AS crimecodedesc, areas.name AS areaname
+            FROM main
+            LEFT JOIN crime_types ON crime_types.id = main.crime_id
+            LEFT JOIN areas ON areas.id = main.area_id
+            WHERE ({crime_conditions}) AND ({place_conditions}) {date_filter}
+            ORDER BY period"""
+    raise HTTPException(status_code=400, detail="Frecuencia no válida o no soportada")
+
+
+def approximate_grouped_query(crime_conditions, place_conditions, freq, init_time, end_time, breakdown_by, fraction):
+    """
+    Versión muestreada de grouped_data_query: lee una fracción de los bloques de main con
+    TABLESAMPLE SYSTEM y escala los conteos por 1/fraction. Como se muestrean bloques enteros,
+    margin (95 %) sale de la varianza del muestreo por conglomerados, (1 - f) / f² · Σ n_bloque².
+    """
+    if freq not in ['month', 'week', 'quarter', 'day', 'Custom']:
+        raise HTTPException(status_code=400, detail="Frecuencia no válida o no soportada")
+    date_filter = f"AND date BETWEEN '{init_time}' AND '{end_time}'"
+    breakdown_by = list(breakdown_by or [])
+    periods = [] if freq == "Custom" else ["period"]
+    keys = periods + [DIMENSION_TABLES[dimension][0] for dimension in breakdown_by]
+    columns = ([] if freq == "Custom" else [f"DATE_TRUNC('{freq}', date) AS period"]) + keys[len(periods):]
+    names = [f"g.{column}" for column in periods] + [f"{DIMENSION_TABLES[dimension][1]}.name AS {dimension}"
+                                                     for dimension in breakdown_by]
+    joins = " ".join(f"LEFT JOIN {table} ON {table}.id = g.{key}"
+                     for key, table in (DIMENSION_TABLES[dimension] for dimension in breakdown_by))
+    order = [f"g.{column}" for column in periods] + breakdown_by
+    return f"""
+        SELECT {"".join(f"{name}, " for name in names)}g.count, g.margin
+        FROM (
+            SELECT {"".join(f"{key}, " for key in keys)}ROUND(COALESCE(SUM(n), 0) / {fraction})::bigint AS count,
+                   ROUND({APPROX_Z} * SQRT({1 - fraction} * COALESCE(SUM(n * n), 0)) / {fraction})::bigint AS margin
+            FROM (
+                SELECT {"".join(f"{column}, " for column in columns)}(ctid::text::point)[0] AS block, COUNT(*) AS n
+                FROM main TABLESAMPLE SYSTEM ({fraction * 100}) REPEATABLE ({APPROX_SEED})
+                WHERE ({crime_conditions}) AND ({place_conditions}) {date_filter}
+                GROUP BY {"".join(f"{key}, " for key in keys)}block
+            ) b
+            {f"GROUP BY {', '.join(keys)}" if keys else ""}
+        ) g {joins}
+        {f"ORDER BY {', '.join(order)}" if order else ""}
+    """
+
+
+def kpi_query(crime_conditions, place_conditions, freq, init_time, end_time):
+    """
+    Agrega la serie por periodo y, sobre ese mismo resultado, obtiene total, media y los periodos
+    con más y menos crímenes (en empate, el primero, como idxmax/idxmin en pandas).
+    """
+    if freq not in ['month', 'week', 'quarter', 'day']:
+        raise HTTPException(status_code=400, detail="Frecuencia no válida o no soportada")
+    return f"""
+        WITH series AS (
+            SELECT DATE_TRUNC('{freq}', date) AS period, COUNT(*) AS count
+            FROM main
+            WHERE ({crime_conditions}) AND ({place_conditions}) AND date BETWEEN '{init_time}' AND '{end_time}'
+            GROUP BY period
+        )
+        SELECT COALESCE(SUM(count), 0) AS total,
+               COALESCE(AVG(count), 0) AS mean,
+               COUNT(*) AS periods,
+               (ARRAY_AGG(period ORDER BY count DESC, period))[1] AS peak_period,
+               MAX(count) AS peak_count,
+               (ARRAY_AGG(period ORDER BY count, period))[1] AS lowest_period,
+               MIN(count) AS lowest_count
+        FROM series
+    """
+
+
+def format_period(date, freq):
+    """ Etiqueta legible de un periodo, como en los KPIs de la app. """
+    if date is None:
+        return None
+    return format_quarter(date) if freq[0] == 'quarter' else date.strftime(freq[4])
+
+
+BATCH_FREQUENCIES = ('month', 'week', 'quarter', 'day', 'Custom')
+# Consultas por lote: la sentencia compilada lleva una columna por consulta y Postgres admite
+# como mucho 1664 columnas en un SELECT, así que el tope nunca pasa de 1600
+BATCH_MAX_SPECS = min(int(os.getenv("BATCH_MAX_SPECS", 100)), 1600)
+# Consultas no compatibles de un lote que se ejecutan a la vez, cada una con su conexión
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", 4))
+
+
+def batch_grouped_query(compiled):
+    """
+    Compila varias consultas (condiciones de crimen y lugar, frecuencia, rango de fechas) en una sola
+    sentencia: un grouping set por frecuencia (y () para los totales 'Custom') y una columna
+    COUNT(*) FILTER por consulta, todo sobre un único recorrido de main.
+    """
+    frequencies = sorted({freq for _, _, freq, _, _ in compiled if freq != "Custom"})
+    periods = {freq: f"DATE_TRUNC('{freq}', date)" for freq in frequencies}
+    conditions = [f"({crime}) AND ({place}) AND date BETWEEN '{init_time}' AND '{end_time}'"
+                  for crime, place, _, init_time, end_time in compiled]
+
+    columns = [f"{period} AS period_{freq}, GROUPING({period}) AS grouping_{freq}" for freq, period in periods.items()]
+    columns += [f"COUNT(*) FILTER (WHERE {condition}) AS count_{i}" for i, condition in enumerate(conditions)]
+    grouping_sets = [f"({period})" for period in periods.values()]
+    if any(freq == "Custom" for _, _, freq, _, _ in compiled):
+        grouping_sets.append("()")
+
+    min_date = min(init_time for _, _, _, init_time, _ in compiled)
+    max_date = max(end_time for _, _, _, _, end_time in compiled)
+    return f"""
+        SELECT {", ".join(columns)}
+        FROM main
+        WHERE date BETWEEN '{min_date}' AND '{max_date}'
+          AND ({" OR ".join(f"({condition})" for condition in conditions)})
+        GROUP BY GROUPING SETS ({", ".join(grouping_sets)})
+    """
+
+
+def split_batch_result(frame, position, freq):
+    """ Extrae del resultado compilado las filas de una consulta, con la misma forma que la consulta individual. """
+    grouping_columns = [column for column in frame.columns if column.startswith("grouping_")]
+    count = f"count_{position}"
+    if freq == "Custom":
+        totals = frame[(frame[grouping_columns] == 1).all(axis=1)] if grouping_columns else frame
+        return pd.DataFrame({'count': [int(totals[count].iloc[0]) if len(totals) else 0]})
+
+    rows = frame[(frame[f"grouping_{freq}"] == 0) & (frame[count] > 0)]
+    if rows.empty:
+        return None
+    return (rows[[f"period_{freq}", count]]
+            .rename(columns={f"period_{freq}": 'period', count: 'count'})
+            .sort_values('period')
+            .reset_index(drop=True))
+
+
+def widen_breakdown(df, breakdown_by):
+    """ Pasa un desglose largo (una fila por periodo y miembro) a una columna por miembro. """
+    index = 'period' if 'period' in df.columns else None
+    wide = df.assign(_total=0).pivot_table(index=index or '_total', columns=list(breakdown_by),
+                                           values='count', aggfunc='sum', fill_value=0, observed=True)
+    if len(breakdown_by) > 1:
+        wide.columns = [" | ".join(column) for column in wide.columns]
+    wide.columns.name = None
+    return wide.reset_index(drop=index is None)
+
+
+def downsample_breakdown(df, breakdown_by, max_points, method, layout):
+    """ En formato largo reduce cada miembro por separado; en ancho, las filas según el total. """
+    if layout == "wide":
+        totals = df.drop(columns='period').sum(axis=1).rename('count')
+        kept = downsample(pd.concat([df['period'], totals], axis=1), 'period', 'count', max_points, method)
+        return df.loc[kept.index]
+    members = [downsample(member, 'period', 'count', max_points, method)
+               for _, member in df.groupby(list(breakdown_by), sort=False, observed=True)]
+    return pd.concat(members).sort_values(['period'] + list(breakdown_by))
+
+
 def format_quarter(date):
     quarter = (date.month - 1) // 3 + 1
     return f"T{quarter} {date.year}"
 
 
+RESPONSE_FORMATS = ("records", "columns")
+
+
+def check_response_format(fmt):
+    if fmt not in RESPONSE_FORMATS:
+        raise HTTPException(status_code=400, detail=f"Formato no válido, use uno de {RESPONSE_FORMATS}")
+
+
+def format_response(df, fmt):
+    """ 'records': lista de filas; 'columns': un array por columna, más compacto para series largas. """
+    with profile_span("serialization"):
+        return df.to_dict(orient="list") if fmt == "columns" else df.to_dict(orient="records")
+
+
+def empty_response(fmt):
+    return {} if fmt == "columns" else []
+
+
+def normalize_filter(values):
+    """ Normaliza una lista de filtros (orden y duplicados) para usarla como clave. """
+    return tuple(sorted(set(values))) if values else None
+
+
+def grouped_data_key(chosen_crime, chosen_place, freq, init_time, end_time, scope, breakdown_by=None, weighted=False):
+    return (normalize_filter(chosen_crime), normalize_filter(chosen_place), freq, init_time, end_time, scope,
+            tuple(breakdown_by) if breakdown_by else None, weighted)
+
+
+def series_version(grouped):
+    """ Huella del contenido de una serie: cambia si y solo si cambian sus datos. """
+    hashed = pd.util.hash_pandas_object(grouped[['period', 'count']], index=False)
+    return hashlib.sha1(hashed.values.tobytes()).hexdigest()
+
+
+async def cached_forecast(grouped, freq, n_steps):
+    """
+    Ajusta Prophet una sola vez por serie y versión de datos, al horizonte máximo de la
+    frecuencia, y sirve cualquier horizonte menor recortando el resultado cacheado.
+    Ajustes concurrentes de la misma serie se agrupan en uno solo fuera del event loop.
+    """
+    horizon = max(freq[2], n_steps)
+    key = (freq[0], horizon, series_version(grouped))
+    forecast = forecast_cache.get(key)
+    if forecast is None:
+        forecast = await within_deadline(forecast_flight.do(key, run_cpu_bound, forecast_data, grouped, freq, horizon))
+        forecast_cache.put(key, forecast)
+    return slice_forecast(forecast, n_steps)
+
+
 def build_conditions(chosen_crime, chosen_place):
     if chosen_crime is not None:
         if any(crime not in category_map.keys() for crime in chosen_crime):
             raise HTTPException(status_code=400, detail="Crimen no válido")
-    crime_conditions = " OR ".join(
-        [f"crimecodedesc = '{category_map[crime]}'" for crime in chosen_crime]
+    # main guarda códigos: los nombres se resuelven contra las tablas de dimensiones
+    crime_conditions = "crime_id IN (SELECT id FROM crime_types WHERE name IN ({}))".format(
+        ", ".join(f"'{category_map[crime]}'" for crime in chosen_crime)
     ) if chosen_crime else "1=1"
 
-    place_conditions = " OR ".join(
-        [f"areaname = '{place}'" for place in chosen_place]
+    place_conditions = "area_id IN (SELECT id FROM areas WHERE name IN ({}))".format(
+        ", ".join(f"'{place}'" for place in chosen_place)
     ) if chosen_place else "1=1"
 
     return crime_conditions, place_conditions
@@ -249,19 +2801,35 @@ def forecast_data(grouped, freq, n_steps):
     prophet_data = grouped[['period', 'count']].rename(columns={'period': 'ds', 'count': 'y'})
     prophet_data['ds'] = pd.to_datetime(prophet_data['ds'], utc=True).dt.tz_localize(None)
 
-    model = Prophet(yearly_seasonality=freq[5][0],
-                    weekly_seasonality=freq[5][1],
-                    daily_seasonality=False)
-    model.fit(prophet_data)
+    with profile_span("prophet"):
+        model = Prophet(yearly_seasonality=freq[5][0],
+                        weekly_seasonality=freq[5][1],
+                        daily_seasonality=False)
+        check_cancelled()
+        model.fit(prophet_data)
 
-    future = model.make_future_dataframe(periods=n_steps, freq=freq[3])
-    forecast = model.predict(future)
+        check_cancelled()
+        future = model.make_future_dataframe(periods=n_steps, freq=freq[3])
+        forecast = model.predict(future)
     last_date = prophet_data['ds'].max()
     forecast['tipo'] = forecast['ds'].apply(lambda x: 'Histórico' if x <= last_date else 'Predicción')
 
     return forecast
 
 
+def check_downsampling(max_points, method):
+    if method not in DOWNSAMPLE_METHODS:
+        raise HTTPException(status_code=400, detail=f"Método de reducción no válido, use uno de {DOWNSAMPLE_METHODS}")
+    if max_points is not None and max_points < 3:
+        raise HTTPException(status_code=400, detail="max_points debe ser al menos 3")
+
+
+def slice_forecast(forecast, n_steps):
+    """ Recorta un pronóstico al histórico más los primeros n_steps periodos predichos. """
+    n_history = (forecast['tipo'] == 'Histórico').sum()
+    return forecast.iloc[:n_history + n_steps].copy()
+
+
 def apply_pond(df):
     df['rawpond'] = df.apply(
             lambda row: 0.035 if 'ATTEMPT' in row['crimecodedesc'] or 'PETTY' in row['crimecodedesc'] or 'THROWING' in row[
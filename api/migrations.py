@@ -0,0 +1,118 @@
+"""
+Migraciones de esquema de la base de datos.
+
+Cada migración se aplica una sola vez, en orden, y queda registrada en schema_migrations.
+Las que solo añaden se ejecutan al arrancar la API; las que reescriben o borran datos de main
+(MANUAL_MIGRATIONS) solo se aplican a mano, y mientras estén pendientes la API no arranca:
+    python migrations.py
+"""
+import asyncio
+
+from lib import *
+
+# (versión, sentencias); nunca se modifica una migración ya publicada, se añade una nueva
+MIGRATIONS = [
+    ("001_main_id", [
+        # Marca de agua monótona para el refresco incremental del motor columnar
+        "ALTER TABLE main ADD COLUMN IF NOT EXISTS id BIGSERIAL",
+        "CREATE UNIQUE INDEX IF NOT EXISTS main_id_idx ON main (id)",
+    ]),
+    ("002_dimensions", [
+        # Crímenes y áreas pasan a tablas de dimensiones; main guarda sus códigos smallint
+        "CREATE TABLE IF NOT EXISTS crime_types (id SMALLSERIAL PRIMARY KEY, name TEXT NOT NULL UNIQUE)",
+        "CREATE TABLE IF NOT EXISTS areas (id SMALLSERIAL PRIMARY KEY, name TEXT NOT NULL UNIQUE)",
+        """INSERT INTO crime_types (name)
+           SELECT DISTINCT crimecodedesc FROM main WHERE crimecodedesc IS NOT NULL ORDER BY 1
+           ON CONFLICT (name) DO NOTHING""",
+        """INSERT INTO areas (name)
+           SELECT DISTINCT areaname FROM main WHERE areaname IS NOT NULL ORDER BY 1
+           ON CONFLICT (name) DO NOTHING""",
+        """ALTER TABLE main
+           ADD COLUMN crime_id SMALLINT REFERENCES crime_types (id),
+           ADD COLUMN area_id SMALLINT REFERENCES areas (id)""",
+        """UPDATE main SET
+           crime_id = (SELECT id FROM crime_types WHERE name = main.crimecodedesc),
+           area_id = (SELECT id FROM areas WHERE name = main.areaname)""",
+        "ALTER TABLE main DROP COLUMN crimecodedesc, DROP COLUMN areaname",
+        "CREATE INDEX IF NOT EXISTS main_area_date_idx ON main (area_id, date)",
+        # El espacio de las columnas de texto se recupera con VACUUM FULL main (fuera de una transacción)
+    ]),
+    ("003_ingest_checkpoints", [
+        # Último incidente de cada registro local de ingesta ya volcado en main
+        """CREATE TABLE IF NOT EXISTS ingest_checkpoints (
+               log TEXT PRIMARY KEY,
+               seq BIGINT NOT NULL,
+               flushed_at TIMESTAMPTZ NOT NULL DEFAULT now()
+           )""",
+    ]),
+    ("004_archive_runs", [
+        # Ejecuciones de archive.py: main solo guarda los incidentes desde el último corte
+        """CREATE TABLE IF NOT EXISTS archive_runs (
+               cutoff DATE PRIMARY KEY,
+               archived_rows BIGINT NOT NULL,
+               archived_at TIMESTAMPTZ NOT NULL DEFAULT now()
+           )""",
+    ]),
+    ("005_sessions", [
+        # Sesiones de login compartidas por todos los workers; se guarda el hash del token, no el token
+        """CREATE TABLE IF NOT EXISTS sessions (
+               token_hash TEXT PRIMARY KEY,
+               email TEXT NOT NULL,
+               created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+           )""",
+        "CREATE INDEX IF NOT EXISTS sessions_created_at_idx ON sessions (created_at)",
+    ]),
+    ("006_sessions_last_write", [
+        # Última escritura de la sesión: sus lecturas van al primario durante READ_YOUR_WRITES_SECONDS
+        "ALTER TABLE sessions ADD COLUMN IF NOT EXISTS last_write_at TIMESTAMPTZ",
+    ]),
+]
+
+# Migraciones que reescriben o borran datos de main: bloquean la tabla mientras duran y no tienen
+# vuelta atrás, así que no se lanzan solas al arrancar un worker
+MANUAL_MIGRATIONS = {"002_dimensions"}
+
+# Clave del advisory lock que serializa migraciones lanzadas por varios procesos a la vez
+MIGRATIONS_LOCK = 7_260_001
+
+
+async def run_migrations(engine: AsyncEngine, manual: bool = False):
+    """
+    Aplica las migraciones pendientes, cada una en su propia transacción. Sin manual, se detiene con
+    un error ante una de MANUAL_MIGRATIONS pendiente, sin aplicar las posteriores.
+    """
+    async with engine.begin() as conn:
+        await conn.execute(text("""
+            CREATE TABLE IF NOT EXISTS schema_migrations (
+                version TEXT PRIMARY KEY,
+                applied_at TIMESTAMPTZ NOT NULL DEFAULT now()
+            )
+        """))
+
+    applied = []
+    for version, statements in MIGRATIONS:
+        async with engine.begin() as conn:
+            await conn.execute(text("SELECT pg_advisory_xact_lock(:key)"), {'key': MIGRATIONS_LOCK})
+            done = await conn.execute(text("SELECT 1 FROM schema_migrations WHERE version = :version"),
+                                      {'version': version})
+            if done.fetchone():
+                continue
+            if version in MANUAL_MIGRATIONS and not manual:
+                raise RuntimeError(f"La migración {version} reescribe main y está pendiente: "
+                                   f"aplícala con python migrations.py")
+            for statement in statements:
+                await conn.execute(text(statement))
+            await conn.execute(text("INSERT INTO schema_migrations (version) VALUES (:version)"),
+                               {'version': version})
+            applied.append(version)
+    return applied
+
+
+if __name__ == "__main__":
+    async def main():
+        engine = get_async_engine()
+        applied = await run_migrations(engine, manual=True)
+        await engine.dispose()
+        print(f"Migraciones aplicadas: {', '.join(applied) if applied else 'ninguna'}")
+
+    asyncio.run(main())
@@ -0,0 +1,72 @@
+"""
+Servidor de producción: gunicorn con workers de uvicorn.
+
+La aplicación se carga en el proceso maestro (preload) antes de crear los workers con fork, de modo
+que Prophet, pandas y el backend de Stan se comparten copy-on-write. Cada worker ejecuta su propio
+lifespan: las migraciones se serializan con un advisory lock, el buffer de ingesta toma su propio
+slot de log y las actualizaciones en vivo abren su propia conexión LISTEN. Las sesiones de login
+viven en Postgres, así que cualquier worker atiende a cualquier cliente; las cachés en memoria de
+cada worker (versión de datos, foto columnar, catálogo, archivo) se revalidan contra Postgres por TTL. Uso:
+    python server.py
+Recarga sin cortar peticiones: kill -HUP <pid del maestro> crea workers nuevos y los viejos terminan
+las peticiones en curso. Con preload el código no se relee con HUP; para desplegar código nuevo:
+kill -USR2 <pid del maestro> y, cuando el maestro nuevo responda, kill -QUIT al viejo.
+"""
+import os
+
+from gunicorn.app.base import BaseApplication
+
+WORKERS = int(os.getenv("WEB_CONCURRENCY", os.cpu_count() or 1))
+# Los hilos de CPU de cada worker se reparten los núcleos en lugar de multiplicarlos por el número de workers
+os.environ.setdefault("CPU_WORKERS", str(max(1, (os.cpu_count() or 1) // WORKERS)))
+
+from lib import *
+
+SERVER_OPTIONS = {
+    "bind": os.getenv("BIND", "0.0.0.0:8000"),
+    "workers": WORKERS,
+    "worker_class": "uvicorn_worker.UvicornWorker",
+    "preload_app": True,
+    # Reciclar cada worker tras MAX_REQUESTS peticiones contiene la memoria que dejan los ajustes repetidos;
+    # el jitter evita que todos se reciclen a la vez
+    "max_requests": int(os.getenv("MAX_REQUESTS", 1000)),
+    "max_requests_jitter": int(os.getenv("MAX_REQUESTS_JITTER", 100)),
+    # Al parar o recargar, un worker espera a sus peticiones en curso hasta el plazo más largo
+    "graceful_timeout": int(os.getenv("GRACEFUL_TIMEOUT", max(DEADLINES.values()))),
+    "timeout": int(os.getenv("WORKER_TIMEOUT", 30)),
+    "keepalive": int(os.getenv("KEEPALIVE", 5)),
+    "forwarded_allow_ips": os.getenv("FORWARDED_ALLOW_IPS", "127.0.0.1"),
+    "accesslog": "-",
+}
+
+
+def prewarm_prophet():
+    """ Carga el backend de Stan de Prophet en el maestro para que todos los workers lo hereden. """
+    try:
+        Prophet()
+    except Exception as e:
+        print(f"No se pudo precargar Prophet: {e}")
+
+
+class Server(BaseApplication):
+    def __init__(self, options):
+        self.options = options
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        from api import app
+        prewarm_prophet()
+        return app
+
+
+if __name__ == "__main__":
+    # Durante un HUP o un reciclado los workers viejos conservan su registro hasta terminar sus
+    # peticiones mientras arrancan los nuevos: hacen falta dos registros por worker
+    if INGEST_BUFFER_ENABLED and INGEST_LOG_SLOTS < 2 * WORKERS:
+        raise SystemExit(f"INGEST_LOG_SLOTS ({INGEST_LOG_SLOTS}) debe ser al menos el doble del número "
+                         f"de workers ({WORKERS}) para recargar con HUP")
+    Server(SERVER_OPTIONS).run()
@@ -18,29 +18,21 @@ def get_engine():
     return sa.engine.create_engine(DB,pool_pre_ping=True)
 
 
-def main():
-    engine = get_engine()
-    data_components = DataComponents(engine)
-
-    if "authentication_status" not in st.session_state:
-            st.session_state["authentication_status"] = None
-    st.markdown("<h1 style='font-size: 6em; text-align: center;'>Foresee</h1>", unsafe_allow_html=True)
-    st.container(height=20, border=False)
-    if not st.session_state.get("authentication_status"):
-            handle_authentication(data_components)
-    else:
-        user_email = st.session_state["mail"]
-        perms = data_components.get_user_permissions(user_email)
-
-        create_data = "Nuevos datos SI" in perms
-        create_users = "Nuevos usuarios SI" in perms
-        KPI = "KPI SI" in perms
-        Predict_perms = 'PREDICT SI' in perms
-        see_perms = [perm for perm in perms if "SEE" in perm][0]
-
-        places = data_components.get_secure_unique_places(user_email, see_perms)
-        predict, pond, chosen_crime, chosen_place = InteractionComponents.create_filters(places, Predict_perms)
-
+def get_data_components():
+    # Con FORESEE_API_URL (o [API] url en secrets.toml) la app consume la API; si no, va directo a la base
+    api_url = os.getenv("FORESEE_API_URL")
+    if not api_url and os.path.exists(".streamlit/secrets.toml"):
+        api_url = toml.load(".streamlit/secrets.toml").get("API", {}).get("url")
+    if api_url:
+        return ApiDataComponents(get_api_client(api_url))
+    return DataComponents(get_engine())
+
+
+@st.fragment
+def filters_fragment(data_components, places, predict_perms, kpi):
+    # Los filtros solo vuelven a ejecutar esta región (y el gráfico que depende de ella)
+    with rerun_timer("filtros"):
+        predict, pond, chosen_crime, chosen_place = InteractionComponents.create_filters(places, predict_perms)
 
         # Configuración de frecuencia
         freq_choice = st.radio("Predicción de crimen a futuro",
@@ -49,11 +41,30 @@ def main():
                                horizontal=True,
                                key="freq_choice")
 
-        # Obtener y procesar datos
-        crime_cond, place_cond = build_conditions(chosen_crime, chosen_place)
-        grouped = data_components.secure_fetch_grouped_data(crime_cond, place_cond, freqmap[freq_choice])
-        apply_ponderation_to_data(grouped, pond)
-
+        # Obtener y procesar datos: primero una vista previa muestreada, que se sustituye por la serie exacta
+        preview = st.empty()
+        grouped = None
+        if data_components.approximate_preview and not pond:
+            approx = data_components.secure_fetch_grouped_data(chosen_crime, chosen_place, freqmap[freq_choice],
+                                                               approximate=True)
+            if approx is not None and not approx['margin'].any():
+                grouped = approx.drop(columns='margin')  # La API ya respondió con conteos exactos
+            elif approx is not None:
+                with preview.container():
+                    st.caption("Vista previa aproximada (margen de error al 95 %); cargando los conteos exactos…")
+                    st.altair_chart(create_preview_chart(approx), use_container_width=True)
+        if grouped is None:
+            grouped = data_components.secure_fetch_grouped_data(chosen_crime, chosen_place, freqmap[freq_choice],
+                                                                weighted=pond)
+        preview.empty()
+
+    chart_fragment(data_components, grouped, chosen_crime, chosen_place, freq_choice, predict, pond, kpi)
+
+
+@st.fragment
+def chart_fragment(data_components, grouped, chosen_crime, chosen_place, freq_choice, predict, pond, kpi):
+    # El slider de horizonte solo vuelve a ejecutar el gráfico y los KPIs, sin volver a consultar datos
+    with rerun_timer("gráfico"):
         if predict:
             st.header("Predicción de Crimen a Futuro")
             n_steps = st.slider("Número de etapas a predecir",
@@ -61,34 +72,74 @@ def main():
                                 max_value=freqmap[freq_choice][2],
                                 value=(freqmap[freq_choice][1] + freqmap[freq_choice][2]) // 2,
                                 label_visibility="collapsed")
-            forecast = forecast_data(grouped, freqmap[freq_choice], n_steps)
+            forecast = data_components.forecast_data(grouped, chosen_crime, chosen_place, freqmap[freq_choice], n_steps,
+                                                     weighted=pond)
             chart, combined = create_combined_chart(grouped, forecast)
         else:
             chart, grouped = create_historical_chart(grouped)
 
         # Mostrar gráficos y KPIs
         st.altair_chart(chart, use_container_width=True)
-        if KPI:
+        if kpi:
             display_kpis(combined if predict else grouped, freqmap[freq_choice])
 
-        st.container(height=20, border=False)
 
-        if create_data:
-            if "new_data" not in st.session_state:
-                st.session_state["new_data"] = pd.DataFrame()
+@st.fragment
+def data_input_fragment(data_components, user_email):
+    with rerun_timer("ingreso de datos"):
+        if "new_data" not in st.session_state:
+            st.session_state["new_data"] = pd.DataFrame()
+        InteractionComponents.create_data_input(
+            lambda: data_components.get_secure_unique_places(user_email, "SEE_ALL"), data_components)
+
+
+@st.fragment
+def user_admin_fragment(data_components, user_email):
+    with rerun_timer("usuarios"):
+        InteractionComponents.user_create_form(data_components,
+                                               lambda: data_components.get_secure_unique_places(user_email, "SEE_ALL"))
+
+
+def main():
+    data_components = get_data_components()
+
+    if "authentication_status" not in st.session_state:
+            st.session_state["authentication_status"] = None
+    st.markdown("<h1 style='font-size: 6em; text-align: center;'>Foresee</h1>", unsafe_allow_html=True)
+    st.container(height=20, border=False)
+    if not st.session_state.get("authentication_status"):
+            handle_authentication(data_components)
+    else:
+        with rerun_timer("app"):
+            user_email = st.session_state["mail"]
+            perms = data_components.get_user_permissions(user_email)
+
+            create_data = "Nuevos datos SI" in perms
+            create_users = "Nuevos usuarios SI" in perms
+            KPI = "KPI SI" in perms
+            Predict_perms = 'PREDICT SI' in perms
+            see_perms = [perm for perm in perms if "SEE" in perm][0]
+
+            places = data_components.get_secure_unique_places(user_email, see_perms)
+            filters_fragment(data_components, places, Predict_perms, KPI)
+
+            st.container(height=20, border=False)
+
             # Componentes de administración
-            InteractionComponents.create_data_input(
-                lambda: data_components.get_secure_unique_places(user_email, "SEE_ALL"), data_components.engine)
-        if create_users:
-            InteractionComponents.user_create_form(data_components,
-                                                   lambda: data_components.get_secure_unique_places(user_email, "SEE_ALL"))
-
-        # Botón de logout
-        _,col,_ = st.columns((4, 1, 4))
-        with col:
-            if st.button("Cerrar sesión", on_click= data_components.secure_fetch_grouped_data.clear):
-                st.session_state["authentication_status"] = None
-                st.rerun()
+            if create_data:
+                data_input_fragment(data_components, user_email)
+            if create_users:
+                user_admin_fragment(data_components, user_email)
+
+            # Botón de logout
+            _,col,_ = st.columns((4, 1, 4))
+            with col:
+                if st.button("Cerrar sesión"):
+                    data_components.logout()
+                    st.session_state["authentication_status"] = None
+                    st.rerun()
+
+        show_rerun_timings()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,60 @@
+"""
+Reducción de series para gráficos: Largest-Triangle-Three-Buckets y mínimo/máximo por bucket.
+
+Solo depende de numpy y pandas: la usan la API (max_points en /retrieve-data) y los gráficos de la app
+de Streamlit. La API y la app se despliegan por separado, así que app/downsampling.py es una copia
+idéntica de este módulo: cualquier cambio se hace en los dos.
+"""
+import numpy as np
+import pandas as pd
+
+
+def lttb_indices(x, y, max_points):
+    """ Índices que conserva Largest-Triangle-Three-Buckets: la forma de la serie con sus picos. """
+    n = len(x)
+    if max_points >= n or max_points < 3:
+        return np.arange(n)
+    bucket_size = (n - 2) / (max_points - 2)
+    indices = np.empty(max_points, dtype=np.int64)
+    indices[0], indices[-1] = 0, n - 1
+    a = 0
+    for i in range(max_points - 2):
+        start = int(i * bucket_size) + 1
+        end = int((i + 1) * bucket_size) + 1
+        next_end = min(int((i + 2) * bucket_size) + 1, n)
+        avg_x = x[end:next_end].mean()
+        avg_y = y[end:next_end].mean()
+        # Área del triángulo formado por el punto elegido antes, cada candidato y la media del siguiente bucket
+        area = np.abs((x[a] - avg_x) * (y[start:end] - y[a]) - (x[a] - x[start:end]) * (avg_y - y[a]))
+        a = start + int(np.argmax(area))
+        indices[i + 1] = a
+    return indices
+
+
+def minmax_indices(y, max_points):
+    """ Índices del mínimo y el máximo de cada bucket. """
+    n = len(y)
+    if max_points >= n or max_points < 2:
+        return np.arange(n)
+    edges = np.linspace(0, n, max_points // 2 + 1).astype(int)
+    indices = set()
+    for start, end in zip(edges[:-1], edges[1:]):
+        if end > start:
+            indices.update((start + int(np.argmin(y[start:end])), start + int(np.argmax(y[start:end]))))
+    return np.array(sorted(indices))
+
+
+DOWNSAMPLE_METHODS = ("lttb", "minmax")
+
+
+def downsample(df, x_col, y_col, max_points, method="lttb"):
+    """ Reduce una serie a como mucho max_points puntos preservando los picos visualmente importantes. """
+    if max_points is None or len(df) <= max_points:
+        return df
+    y = df[y_col].to_numpy(dtype=float)
+    if method == "minmax":
+        indices = minmax_indices(y, max_points)
+    else:
+        x = pd.to_datetime(df[x_col]).to_numpy(dtype="datetime64[ns]").astype(np.int64).astype(float)
+        indices = lttb_indices(x, y, max_points)
+    return df.iloc[indices]
@@ -1,15 +1,24 @@
+import os
 import time
+import threading
+from collections import deque
+from contextlib import contextmanager
 import streamlit as st
 import altair as alt
+import numpy as np
 import pandas as pd
 from prophet import Prophet
 from sqlalchemy import text
 import uuid
 import sqlalchemy as sa
 import toml
+import httpx
 from argon2 import PasswordHasher
+from argon2.exceptions import VerificationError
 from datetime import datetime
 
+from downsampling import downsample
+
 ph = PasswordHasher()
 
 # Mapas de categorías y configuraciones de frecuencia
@@ -32,12 +41,62 @@ freqmap = {
     "Por trimestre": ["quarter", 1, 16, "QS", None, [True, False]]
 }
 
+class CacheGenerations:
+    """
+    Contadores de generación por etiqueta, compartidos por todas las sesiones del proceso.
+    Las funciones cacheadas reciben las generaciones de sus etiquetas como argumento, así que
+    incrementar una etiqueta invalida solo las entradas que dependen de ella.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._generations = {}
+
+    def get(self, *tags):
+        return tuple(self._generations.get(tag, 0) for tag in tags)
+
+    def bump(self, *tags):
+        with self._lock:
+            for tag in tags:
+                self._generations[tag] = self._generations.get(tag, 0) + 1
+
+
+@st.cache_resource
+def cache_generations():
+    return CacheGenerations()
+
+
+def data_tags(chosen_crime, chosen_place):
+    """ Etiquetas de las que depende un agregado: área x crimen, con '*' para 'todos'. """
+    places = sorted(chosen_place) if chosen_place else ["*"]
+    crimes = sorted(category_map[crime] for crime in chosen_crime) if chosen_crime else ["*"]
+    return [f"data:{place}|{crime}" for place in places for crime in crimes]
+
+
+def invalidate_saved_data(new_data, known_places):
+    """ Invalida solo los agregados afectados por las filas guardadas. """
+    tags = set()
+    for place, crime in new_data[['areaname', 'crimecodedesc']].drop_duplicates().itertuples(index=False):
+        tags.update({f"data:{place}|{crime}", f"data:{place}|*", f"data:*|{crime}", "data:*|*"})
+    if not set(new_data['areaname']).issubset(known_places):
+        tags.add("places")
+    cache_generations().bump(*tags)
+
+
 class DataComponents:
+    guest_access = True
+    approximate_preview = False
+
     def __init__(self, engine):
         self.engine = engine
 
+    def logout(self):
+        pass
+
+    def get_user_permissions(self, email):
+        return self._get_user_permissions(email, cache_generations().get(f"user:{email}"))
+
     @st.cache_data(ttl=600)
-    def get_user_permissions(_self, email):
+    def _get_user_permissions(_self, email, generation):
         """ Obtiene los permisos de un usuario en función de sus roles """
         query = """
             SELECT p.resource
@@ -56,8 +115,11 @@ class DataComponents:
         permissions = [row[0] for row in rows]
         return permissions
 
+    def get_user_area(self, email):
+        return self._get_user_area(email, cache_generations().get(f"user:{email}"))
+
     @st.cache_data(ttl=600)
-    def get_user_area(_self, email):
+    def _get_user_area(_self, email, generation):
         """ Obtiene los permisos de un usuario en función de sus roles """
         query = """
                 SELECT area FROM usuarios WHERE email = :email
@@ -68,25 +130,36 @@ class DataComponents:
         area = [row[0] for row in rows]
         return area[0]
 
+    def get_secure_unique_places(self, email, see_permissions):
+        return self._get_secure_unique_places(email, see_permissions,
+                                              cache_generations().get(f"user:{email}", "places"))
+
     @st.cache_data(ttl=600)
-    def get_secure_unique_places(_self, email, see_permissions):
+    def _get_secure_unique_places(_self, email, see_permissions, generation):
         """ Obtiene las áreas disponibles según los permisos del usuario. """
         if see_permissions == 'SEE_LOCAL':
-            area_conditions = f"areaname = '{_self.get_user_area(email)}'"
+            area_conditions = f"name = '{_self.get_user_area(email)}'"
         elif see_permissions == 'SEE_ALL':
             area_conditions = "1=1"
         else:
             area_conditions = "1=0"
 
-        query = f"SELECT DISTINCT areaname FROM main WHERE {area_conditions}"
+        # Catálogo de áreas: una tabla pequeña en lugar de un DISTINCT sobre main
+        query = f"SELECT name FROM areas WHERE {area_conditions} ORDER BY name"
         with _self.engine.connect() as conn:
             result = conn.execute(text(query))
         rows = result.fetchall()
         return [row[0] for row in rows]
 
+    def secure_fetch_grouped_data(self, chosen_crime, chosen_place, freq, weighted=False):
+        generation = cache_generations().get(*data_tags(chosen_crime, chosen_place))
+        grouped = self._secure_fetch_grouped_data(chosen_crime, chosen_place, freq, generation)
+        return apply_ponderation_to_data(grouped, weighted) if grouped is not None else None
+
     @st.cache_data(ttl=600)
-    def secure_fetch_grouped_data(_self, crime_conditions, place_conditions, freq):
+    def _secure_fetch_grouped_data(_self, chosen_crime, chosen_place, freq, generation):
         """ Obtiene datos agrupados según los permisos del usuario. """
+        crime_conditions, place_conditions = build_conditions(chosen_crime, chosen_place)
         query = f"""
             SELECT DATE_TRUNC(:freq, date) AS period, COUNT(*) AS count, AVG(pond) AS pond
             FROM main
@@ -161,8 +234,11 @@ class DataComponents:
         columns = result.keys()
         return pd.DataFrame(rows, columns=columns) if rows else None
 
+    def verify_login(self, email, plain_password):
+        return self._verify_login(email, plain_password, cache_generations().get(f"user:{email}"))
+
     @st.cache_data(ttl=600)
-    def verify_login(_self, email, plain_password):
+    def _verify_login(_self, email, plain_password, generation):
         """ Verifica la contraseña de un usuario. """
         query = "SELECT password FROM usuarios WHERE email = :email"
         with _self.engine.connect() as conn:
@@ -173,8 +249,144 @@ class DataComponents:
                 return False
 
         stored_hash = row[0]
-        return ph.verify(stored_hash, plain_password,)
+        try:
+            return ph.verify(stored_hash, plain_password,)
+        except VerificationError:
+            return False
 
+    def forecast_data(self, grouped, chosen_crime, chosen_place, freq, n_steps, weighted=False):
+        # Se ajusta una vez al horizonte máximo; mover el slider solo recorta el resultado cacheado
+        return slice_forecast(fit_full_forecast(grouped, freq), n_steps)
+
+    def save_data(self, new_data):
+        """ Agrega los registros nuevos a main. """
+        with self.engine.begin() as conn:
+            insert_incidents(conn, new_data)
+
+
+# Equivalencia entre las frecuencias de la app y los grupos de la API
+API_GROUPS = {"month": "mes", "week": "semana", "quarter": "trimestre"}
+
+
+@st.cache_resource
+def get_api_client(base_url):
+    """ Cliente HTTP con pool de conexiones keep-alive, compartido por todas las sesiones. """
+    return httpx.Client(base_url=base_url,
+                        limits=httpx.Limits(max_connections=50, max_keepalive_connections=20),
+                        timeout=httpx.Timeout(10.0, read=120.0))
+
+
+class UserExistsError(Exception):
+    """ El email ya pertenece a un usuario registrado. """
+
+
+class ApiError(RuntimeError):
+    """ Respuesta de error de la API, con su código de estado. """
+    def __init__(self, status_code, detail):
+        super().__init__(detail)
+        self.status_code = status_code
+
+
+def api_error_detail(response):
+    """ Mensaje de una respuesta de error: el detail de la API o, si no es JSON (500 sin manejar, proxy), el texto. """
+    try:
+        body = response.json()
+    except ValueError:
+        return response.text or response.reason_phrase
+    return body.get("detail", response.text) if isinstance(body, dict) else response.text
+
+
+class ApiDataComponents:
+    """
+    Misma interfaz que DataComponents, pero contra la API de Foresee: aprovecha sus cachés
+    compartidas y sus predicciones en lugar de consultar Postgres desde cada proceso de la app.
+    """
+    guest_access = False
+    # La API puede responder primero desde una muestra de main (approximate)
+    approximate_preview = True
+
+    def __init__(self, client):
+        self.client = client
+
+    def _request(self, method, url, **kwargs):
+        headers = {"X-Token": st.session_state.get("api_token", "")}
+        response = self.client.request(method, url, headers=headers, **kwargs)
+        if response.status_code >= 400:
+            raise ApiError(response.status_code, api_error_detail(response))
+        return response.json()
+
+    def get_user_permissions(self, email):
+        return self._request("GET", "/permissions")["permissions"]
+
+    def get_secure_unique_places(self, email, see_permissions):
+        return self._request("GET", "/secure-places", params={"see": see_permissions})["places"]
+
+    def secure_fetch_grouped_data(self, chosen_crime, chosen_place, freq, weighted=False, approximate=False):
+        # Sin fechas, la API usa todo el rango disponible
+        data = self._request("POST", "/retrieve-data", json={
+            "crime": [",".join(chosen_crime)] if chosen_crime else None,
+            "place": chosen_place or None,
+            "group": API_GROUPS[freq[0]],
+            "format": "columns",
+            # La API pondera en la propia consulta agrupada
+            "weighted": weighted,
+            "approximate": approximate,
+        })
+        if not data:
+            return None
+        grouped = pd.DataFrame(data)
+        grouped['period'] = pd.to_datetime(grouped['period'])
+        return grouped
+
+    def forecast_data(self, grouped, chosen_crime, chosen_place, freq, n_steps, weighted=False):
+        data = self._request("POST", "/predict", json={
+            "crime": [",".join(chosen_crime)] if chosen_crime else None,
+            "place": chosen_place or None,
+            "group": API_GROUPS[freq[0]],
+            "steps": n_steps,
+            "format": "columns",
+            "weighted": weighted,
+        })
+        forecast = pd.DataFrame(data)
+        forecast['ds'] = pd.to_datetime(forecast['ds'])
+        forecast['tipo'] = 'Predicción'
+        return forecast
+
+    def save_data(self, new_data):
+        crimes = {value: key for key, value in category_map.items()}
+        for row in new_data.itertuples(index=False):
+            self._request("POST", "/new-data", json={
+                "date": pd.Timestamp(row.date).isoformat(),
+                "crime": crimes[row.crimecodedesc],
+                "area": row.areaname,
+            })
+
+    def create_user(self, email, full_name, area, password, role):
+        try:
+            self._request("POST", "/register", json={
+                "email": email, "name": full_name, "area": area, "password": password, "role": role
+            })
+        except ApiError as e:
+            if e.status_code == 409:
+                raise UserExistsError(email) from e
+            raise
+        return True
+
+    def get_user(self, email):
+        # La API no expone usuarios; create_user lanza UserExistsError si /register responde 409
+        return None
+
+    def verify_login(self, email, plain_password):
+        response = self.client.post("/login", json={"email": email, "password": plain_password})
+        if response.status_code != 200:
+            return False
+        st.session_state["api_token"] = response.json()["token"]
+        return True
+
+    def logout(self):
+        token = st.session_state.pop("api_token", None)
+        if token:
+            self.client.post("/logout", cookies={"Authorization": f"Bearer {token}"})
 
 
 class InteractionComponents:
@@ -201,7 +413,7 @@ class InteractionComponents:
         return predict, pond, chosen_crime, chosen_place
 
     @staticmethod
-    def create_data_input(get_places_func, engine):
+    def create_data_input(get_places_func, data_components):
         # Inicializar el estado del expander si no existe
         if "data_input_expanded" not in st.session_state:
             st.session_state["data_input_expanded"] = False
@@ -240,25 +452,18 @@ class InteractionComponents:
                     st.session_state["data_input_expanded"] = True
 
             st.dataframe(st.session_state.new_data, height=200)
-            InteractionComponents.save_delete_data(engine)
+            InteractionComponents.save_delete_data(data_components, get_places_func())
 
     @staticmethod
-    def save_delete_data(engine):
+    def save_delete_data(data_components, known_places):
         col_btn1, col_btn2, _ = st.columns((1, 1, 6))
         with col_btn1:
-            if st.button("Guardar datos",on_click=st.cache_data.clear):
+            if st.button("Guardar datos"):
                 if not st.session_state.new_data.empty:
                     with st.spinner("Guardando datos..."):
                         try:
-                            with engine.connect() as conn:
-                                # Crear la tabla si no existe
-                                st.session_state.new_data.to_sql(
-                                    'main',
-                                    conn,
-                                    if_exists='replace',
-                                    index=False
-                                )
-                                conn.commit()
+                            data_components.save_data(st.session_state.new_data)
+                            invalidate_saved_data(st.session_state.new_data, known_places)
                             st.session_state.new_data = pd.DataFrame()
                             st.rerun()
                         except Exception as e:
@@ -282,7 +487,7 @@ class InteractionComponents:
                     confirm_password = st.text_input("Confirmar contraseña*", type="password")
                     new_area = st.selectbox("Área", get_places_func())
 
-                if st.form_submit_button("🎯 Registrar usuario", on_click=st.cache_data.clear):
+                if st.form_submit_button("🎯 Registrar usuario"):
                     if data_components.get_user(new_email) is not None:
                         st.error("❌ El usuario ya existe")
                     elif not all([ new_name, new_email, new_password]):
@@ -302,17 +507,44 @@ class InteractionComponents:
                                 new_password,
                                 new_role
                             )
+                            cache_generations().bump(f"user:{new_email}")
                             st.success("✅ Usuario registrado exitosamente")
                             time.sleep(2)
+                        except UserExistsError:
+                            st.error("❌ El usuario ya existe")
                         except Exception as e:
                             st.error(f"❌ Error al registrar: {str(e)}")
 
+@contextmanager
+def rerun_timer(region):
+    """ Mide cuánto tarda en ejecutarse una región de la app (la app completa o un fragmento). """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings = st.session_state.setdefault("rerun_timings", {})
+        timings.setdefault(region, deque(maxlen=50)).append(time.perf_counter() - start)
+
+
+def show_rerun_timings():
+    """ Con ?timings=1 en la URL, muestra la latencia de cada región en la barra lateral. """
+    if not st.query_params.get("timings"):
+        return
+    timings = st.session_state.get("rerun_timings", {})
+    st.sidebar.dataframe(pd.DataFrame([
+        {"región": region,
+         "ejecuciones": len(values),
+         "última (ms)": round(values[-1] * 1000, 1),
+         "media (ms)": round(sum(values) / len(values) * 1000, 1)}
+        for region, values in timings.items()
+    ]), hide_index=True)
+
+
 def leave_open():
     st.session_state["data_input_expanded"] = True
 
 def login_callback(data_components,mail,password):
-    user = data_components.get_user(mail)
-    if user is not None and data_components.verify_login(mail, password):
+    if data_components.verify_login(mail, password):
         st.session_state["authentication_status"] = True
         st.session_state["mail"] = mail
     else:
@@ -340,8 +572,9 @@ def handle_authentication(data_components):
             col1,_,col2 = st.columns((1,4,1))
             with col1:
                 st.button("Iniciar Sesión",on_click=login_callback, args=(data_components,mail, password))
-            with col2:
-                st.button("Ingresar como invitado",on_click=outsider_callback)
+            if data_components.guest_access:
+                with col2:
+                    st.button("Ingresar como invitado",on_click=outsider_callback)
 
 # --------------- FUNCIONES AUXILIARES -----------------#
 
@@ -351,18 +584,43 @@ def format_quarter(date):
 
 
 def build_conditions(chosen_crime, chosen_place):
-    crime_conditions = " OR ".join(
-        [f"crimecodedesc = '{category_map[crime]}'" for crime in chosen_crime]
+    # main guarda códigos: los nombres se resuelven contra las tablas de dimensiones
+    crime_conditions = "crime_id IN (SELECT id FROM crime_types WHERE name IN ({}))".format(
+        ", ".join(f"'{category_map[crime]}'" for crime in chosen_crime)
     ) if chosen_crime else "1=1"
 
-    place_conditions = " OR ".join(
-        [f"areaname = '{place}'" for place in chosen_place]
+    place_conditions = "area_id IN (SELECT id FROM areas WHERE name IN ({}))".format(
+        ", ".join(f"'{place}'" for place in chosen_place)
     ) if chosen_place else "1=1"
 
     return crime_conditions, place_conditions
 
+
+def insert_dimension_members(table):
+    """ Alta solo de los nombres que faltan: un INSERT descartado por ON CONFLICT gasta igualmente un valor de la secuencia SMALLSERIAL. """
+    return text(f"""
+        INSERT INTO {table} (name)
+        SELECT incoming.name FROM unnest(CAST(:names AS TEXT[])) AS incoming (name)
+        WHERE NOT EXISTS (SELECT 1 FROM {table} WHERE {table}.name = incoming.name)
+        ON CONFLICT (name) DO NOTHING
+    """)
+
+
+def insert_incidents(conn, df):
+    """ Inserta filas (date, crimecodedesc, areaname, rawpond, pond) en main, dando de alta crímenes y áreas nuevos. """
+    conn.execute(insert_dimension_members("crime_types"), {'names': sorted(set(df['crimecodedesc']))})
+    conn.execute(insert_dimension_members("areas"), {'names': sorted(set(df['areaname']))})
+    conn.execute(text("""
+        INSERT INTO main (date, crime_id, area_id, rawpond, pond)
+        VALUES (:date,
+                (SELECT id FROM crime_types WHERE name = :crimecodedesc),
+                (SELECT id FROM areas WHERE name = :areaname),
+                :rawpond, :pond)
+    """), df[['date', 'crimecodedesc', 'areaname', 'rawpond', 'pond']].to_dict(orient="records"))
+
 def apply_ponderation_to_data(grouped, apply_ponder):
-    if apply_ponder:
+    # En modo API la serie llega ya ponderada y sin la columna pond
+    if apply_ponder and 'pond' in grouped.columns:
         total_original = grouped['count'].sum()
         total_ponderado = (grouped['count'] * grouped['pond']).sum()
         normalization_factor = total_original / total_ponderado
@@ -387,7 +645,23 @@ def forecast_data(grouped, freq, n_steps):
     return forecast
 
 
-def create_combined_chart(grouped, forecast):
+@st.cache_data(ttl=600, max_entries=50)
+def fit_full_forecast(grouped, freq):
+    """ Pronóstico al horizonte máximo de la frecuencia; la clave incluye el contenido de la serie. """
+    return forecast_data(grouped, freq, freq[2])
+
+
+def slice_forecast(forecast, n_steps):
+    """ Recorta un pronóstico al histórico más los primeros n_steps periodos predichos. """
+    n_history = (forecast['tipo'] == 'Histórico').sum()
+    return forecast.iloc[:n_history + n_steps].copy()
+
+
+# Máximo de puntos que se envían al navegador por serie (None para no reducir)
+MAX_CHART_POINTS = 1000
+
+
+def create_combined_chart(grouped, forecast, max_points=MAX_CHART_POINTS):
     # Concatenar los datos históricos y las predicciones
     historical_data = grouped[['period', 'count']].rename(columns={'period': 'ds', 'count': 'yhat'})
     historical_data['ds'] = pd.to_datetime(historical_data['ds'], utc=True).dt.tz_localize(None)
@@ -399,6 +673,9 @@ def create_combined_chart(grouped, forecast):
     forecast_data_filtered = forecast_data[forecast_data['ds'] > last_historical_date]
 
     combined_data = pd.concat([historical_data, forecast_data_filtered], ignore_index=True)
+    # Al gráfico solo va el histórico reducido; los KPIs se calculan sobre la serie completa
+    chart_data = pd.concat([downsample(historical_data, 'ds', 'yhat', max_points), forecast_data_filtered],
+                           ignore_index=True)
 
     # Definir el rango de valores en el eje Y
     y_min = combined_data['yhat'].min()
@@ -411,7 +688,7 @@ def create_combined_chart(grouped, forecast):
 
     scale_y = alt.Scale(domain=domain, nice=True)
 
-    line_chart = alt.Chart(combined_data).mark_line(point=True).encode(
+    line_chart = alt.Chart(chart_data).mark_line(point=True).encode(
         x=alt.X('ds:T', title='Fecha'),
         y=alt.Y('yhat:Q', title='Valor', scale=scale_y),
         color=alt.Color('tipo:N', scale=alt.Scale(domain=['Histórico', 'Predicción'],
@@ -419,7 +696,7 @@ def create_combined_chart(grouped, forecast):
                         legend=None)
     ).properties(width=700, height=500)
 
-    band_chart = alt.Chart(combined_data[combined_data["tipo"] == "Predicción"]).mark_area(opacity=0.3).encode(
+    band_chart = alt.Chart(chart_data[chart_data["tipo"] == "Predicción"]).mark_area(opacity=0.3).encode(
         x=alt.X('ds:T', title='Fecha'),
         y=alt.Y('yhat_lower:Q', title='Valor', scale=scale_y),
         y2="yhat_upper:Q"
@@ -428,10 +705,10 @@ def create_combined_chart(grouped, forecast):
     return band_chart + line_chart, combined_data
 
 
-def create_historical_chart(grouped):
+def create_historical_chart(grouped, max_points=MAX_CHART_POINTS):
     # Definir dominio para el eje Y
     grouped = grouped[['period', 'count']].rename(columns={'period': 'ds', 'count': 'yhat'})
-    return alt.Chart(grouped).mark_line(point=True).encode(
+    return alt.Chart(downsample(grouped, 'ds', 'yhat', max_points)).mark_line(point=True).encode(
         x=alt.X('ds:T', title='Fecha'),
         y=alt.Y('yhat:Q', title='Valor',
                 scale=alt.Scale(domain=[grouped['yhat'].min(), grouped['yhat'].max()])),
@@ -439,6 +716,25 @@ def create_historical_chart(grouped):
     ).properties(width=700, height=500), grouped
 
 
+def create_preview_chart(grouped, max_points=MAX_CHART_POINTS):
+    """ Serie aproximada con su margen de error al 95 %, mientras llega la exacta. """
+    grouped = grouped.rename(columns={'period': 'ds', 'count': 'yhat'}).assign(
+        low=lambda df: (df['yhat'] - df['margin']).clip(lower=0),
+        high=lambda df: df['yhat'] + df['margin'])
+    grouped = downsample(grouped, 'ds', 'yhat', max_points)
+    band = alt.Chart(grouped).mark_area(opacity=0.3, color='lightgray').encode(
+        x=alt.X('ds:T', title='Fecha'),
+        y=alt.Y('low:Q', title='Valor'),
+        y2='high:Q'
+    )
+    line = alt.Chart(grouped).mark_line(point=True, strokeDash=[4, 4]).encode(
+        x='ds:T',
+        y='yhat:Q',
+        color=alt.value('lightblue')
+    )
+    return (band + line).properties(width=700, height=500)
+
+
 def display_kpis(grouped, freq):
     max_date = grouped.loc[grouped['yhat'].idxmax(), 'ds']
     min_date = grouped.loc[grouped['yhat'].idxmin(), 'ds']